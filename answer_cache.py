@@ -0,0 +1,233 @@
+# Two-tier answer cache in front of the RAG chain.
+#
+# Tier 1 is keyed on the normalized question text. Tier 2 reuses an answer
+# when the new question's embedding is within a cosine threshold of a cached
+# one. Both tiers share LRU + TTL eviction and a byte budget.
+#
+# With a shared store (multi-worker mode) exact answers and the invalidation
+# generation are also kept there, so an answer computed by one worker is an
+# exact hit in every other one and an invalidation reaches all of them. The
+# semantic tier stays per process. Those are blocking SQLite calls, so async
+# callers use the a* methods, which run them in a thread.
+
+import asyncio
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from shared_store import shared_store
+
+
+def normalize_query(text):
+    # "Dengue symptoms?" and "  dengue   SYMPTOMS " map to the same key
+    text = re.sub(r"[^\w\s]", " ", text.lower())
+    return " ".join(text.split())
+
+
+class LRUTTLCache:
+    def __init__(self, max_entries=1000, ttl=3600, max_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.bytes_used = 0
+        self._data = OrderedDict()  # key -> (expires_at, size, value)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+
+        expires_at, size, value = item
+        if expires_at < time.monotonic():
+            self.pop(key)
+            return None
+
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value, size):
+        self.pop(key)
+        self._data[key] = (time.monotonic() + self.ttl, size, value)
+        self.bytes_used += size
+
+        while self._data and (len(self._data) > self.max_entries or self.bytes_used > self.max_bytes):
+            oldest = next(iter(self._data))
+            self.pop(oldest)
+
+    def pop(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.bytes_used -= item[1]
+        return item
+
+    def items(self):
+        # Live (key, value) pairs, expired entries are dropped on the way
+        now = time.monotonic()
+        for key, (expires_at, _, value) in list(self._data.items()):
+            if expires_at < now:
+                self.pop(key)
+            else:
+                yield key, value
+
+    def clear(self):
+        self._data.clear()
+        self.bytes_used = 0
+
+
+class AnswerCache:
+    def __init__(self, similarity=0.95, max_entries=1000, ttl=3600, max_bytes=16 * 1024 * 1024, shared=None):
+        self.similarity = similarity
+        self.ttl = ttl
+        self.shared = shared
+        self.exact = LRUTTLCache(max_entries, ttl, max_bytes // 2)
+        self.semantic = LRUTTLCache(max_entries, ttl, max_bytes // 2)
+        self.generation = 0  # bumped on every invalidation
+        self.stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "invalidations": 0}
+        self._lock = threading.Lock()
+        self._matrix = None  # stacked unit vectors of the semantic tier, rebuilt lazily
+        self._matrix_keys = []
+
+    def get_exact(self, query):
+        key = normalize_query(query)
+        with self._lock:
+            self._sync_generation()
+            answer = self.exact.get(key)
+            if answer is None and self.shared is not None:
+                value = self.shared.get("answer", f"{self.generation}:{key}")
+                if value is not None:
+                    answer = value.decode("utf-8")
+                    self.exact.put(key, answer, sys.getsizeof(answer))
+            if answer is not None:
+                self.stats["exact_hits"] += 1
+            return answer
+
+    def get_similar(self, query, vector):
+        vector = self._unit(vector)
+        with self._lock:
+            self._sync_generation()
+            if self._matrix is None:
+                self._rebuild_matrix()
+
+            if not self._matrix_keys:
+                self.stats["misses"] += 1
+                return None
+
+            scores = self._matrix @ vector
+            best = int(np.argmax(scores))
+            answer = None
+            if scores[best] >= self.similarity:
+                entry = self.semantic.get(self._matrix_keys[best])
+                if entry is not None:
+                    answer = entry[1]
+
+            if answer is None:
+                self.stats["misses"] += 1
+                return None
+
+            self.stats["semantic_hits"] += 1
+            # Promote so the next identical phrasing is an exact hit
+            self.exact.put(normalize_query(query), answer, sys.getsizeof(answer))
+            return answer
+
+    def put(self, query, vector, answer, generation=None):
+        key = normalize_query(query)
+        vector = self._unit(vector)
+        with self._lock:
+            self._sync_generation()
+            # Answer computed against an index that has since been invalidated
+            if generation is not None and generation != self.generation:
+                return
+
+            size = sys.getsizeof(answer)
+            self.exact.put(key, answer, size)
+            self.semantic.put(key, (vector, answer), size + vector.nbytes)
+            self._matrix = None
+            if self.shared is not None:
+                self.shared.put("answer", f"{self.generation}:{key}", answer.encode("utf-8"), self.ttl)
+
+    def invalidate(self):
+        with self._lock:
+            self._clear_local()
+            if self.shared is not None:
+                self.generation = self.shared.incr("answer_meta", "generation")
+                self.shared.delete("answer")
+            else:
+                self.generation += 1
+            self.stats["invalidations"] += 1
+
+    async def aget_exact(self, query):
+        return await self._off_loop(self.get_exact, query)
+
+    async def aget_similar(self, query, vector):
+        return await self._off_loop(self.get_similar, query, vector)
+
+    async def aput(self, query, vector, answer, generation=None):
+        await self._off_loop(self.put, query, vector, answer, generation)
+
+    async def ainvalidate(self):
+        await self._off_loop(self.invalidate)
+
+    async def _off_loop(self, fn, *args):
+        # Purely in-memory without a shared store: not worth a thread hop
+        if self.shared is None:
+            return fn(*args)
+        return await asyncio.to_thread(fn, *args)
+
+    def _clear_local(self):
+        self.exact.clear()
+        self.semantic.clear()
+        self._matrix = None
+
+    def _sync_generation(self):
+        # Another worker may have invalidated the cache
+        if self.shared is None:
+            return
+        value = self.shared.get("answer_meta", "generation")
+        generation = int(value) if value is not None else 0
+        if generation != self.generation:
+            self._clear_local()
+            self.generation = generation
+
+    def snapshot(self):
+        with self._lock:
+            lookups = self.stats["exact_hits"] + self.stats["semantic_hits"] + self.stats["misses"]
+            hits = self.stats["exact_hits"] + self.stats["semantic_hits"]
+            return {
+                **self.stats,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "exact_entries": len(self.exact),
+                "semantic_entries": len(self.semantic),
+                "bytes_used": self.exact.bytes_used + self.semantic.bytes_used,
+                "generation": self.generation,
+            }
+
+    def _rebuild_matrix(self):
+        entries = list(self.semantic.items())
+        self._matrix_keys = [key for key, _ in entries]
+        if entries:
+            self._matrix = np.stack([vector for _, (vector, _) in entries])
+        else:
+            self._matrix = np.empty((0, 0), dtype=np.float32)
+
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+answer_cache = AnswerCache(
+    similarity=float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95")),
+    max_entries=int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000")),
+    ttl=float(os.getenv("ANSWER_CACHE_TTL", "3600")),
+    max_bytes=int(os.getenv("ANSWER_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+    shared=shared_store,
+)
@@ -1,26 +1,58 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
-import requests
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, Response, stream_with_context, g
+import json
+import uuid
+from backend_client import create_backend_client
 
 BASE_URL = "http://127.0.0.1:8000"
 
+# Shared keep-alive connection pool to the FastAPI backend
+backend = create_backend_client(BASE_URL)
+
 app = Flask(__name__)
 app.secret_key = "Ajay@1234"
 
+
+@app.before_request
+def assign_trace_id():
+    # Propagated to the backend so both sides log the same id
+    g.trace_id = request.headers.get("X-Trace-Id") or uuid.uuid4().hex
+
+
+@app.after_request
+def return_trace_id(response):
+    response.headers["X-Trace-Id"] = g.get("trace_id", "")
+    return response
+
 @app.route("/", methods=["GET", "POST"])
 def index():
     return redirect(url_for("medical_assistant"))
 
+def conversation_id():
+    # The conversation itself lives in the backend; the cookie only holds its id
+    if "conversation_id" not in session:
+        session["conversation_id"] = uuid.uuid4().hex
+    return session["conversation_id"]
+
+
 @app.route("/assistant", methods=["GET", "POST"])
 def medical_assistant():
-    if "messages" not in session:
-        session["messages"] = []
+    session_id = conversation_id()
 
     # Only handle the "clear" button
     if request.method == "POST" and request.form.get("clear"):
-        session["messages"] = []
+        try:
+            backend.delete(f"/conversation/{session_id}", trace_id=g.trace_id)
+        except Exception:
+            pass
+        session["conversation_id"] = uuid.uuid4().hex
         return redirect(url_for("medical_assistant"))
 
-    return render_template("assistant.html")
+    try:
+        messages = backend.get(f"/conversation/{session_id}", trace_id=g.trace_id).json().get("messages", [])
+    except Exception:
+        messages = []
+
+    return render_template("assistant.html", messages=messages)
 
 
 @app.route("/assistant-ajax", methods=["POST"])
@@ -31,11 +63,9 @@ def assistant_ajax():
     if not question:
         return jsonify({"reply": "⚠️ No question received."})
 
-    messages = session.get("messages", [])
-    messages.append({"role": "user", "content": question})
-
     try:
-        response = requests.post(f"{BASE_URL}/ask", json={"question": question}, timeout=20)
+        response = backend.post("/ask", name="ask", trace_id=g.trace_id,
+                                json={"question": question, "session_id": conversation_id()})
         if response.status_code == 200:
             answer = response.json().get("answer", "No response from backend.")
         else:
@@ -43,24 +73,62 @@ def assistant_ajax():
     except Exception as e:
         answer = f"Backend error: {e}"
 
-    messages.append({"role": "assistant", "content": answer})
-    session["messages"] = messages[-10:]
-
     return jsonify({"reply": answer})
 
 
+@app.route("/assistant-stream", methods=["POST"])
+def assistant_stream():
+    # Same as /assistant-ajax but relays the backend's server-sent events as
+    # they arrive, so the page can render tokens while the answer is generated
+    data = request.get_json()
+    question = data.get("question", "").strip()
+
+    if not question:
+        return jsonify({"reply": "⚠️ No question received."})
+
+    # The backend records the turn once the answer has streamed
+    payload = {"question": question, "session_id": conversation_id()}
+    trace_id = g.trace_id
+
+    def relay():
+        try:
+            with backend.post("/ask/stream", name="ask_stream", trace_id=trace_id, json=payload, stream=True) as response:
+                if response.status_code != 200:
+                    yield f"data: {json.dumps({'token': f'Error: {response.status_code}'})}\n\n"
+                    yield "event: done\ndata: {}\n\n"
+                    return
+                for chunk in response.iter_content(chunk_size=None):
+                    yield chunk
+        except Exception as e:
+            yield f"data: {json.dumps({'token': f'Backend error: {e}'})}\n\n"
+            yield "event: done\ndata: {}\n\n"
+
+    return Response(stream_with_context(relay()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 
 
 
 
 
+PAGE_SIZE = 50
+
+
 @app.route("/view", methods=["GET"])
 def view_patients():
+    cursor = request.args.get("cursor")
+    next_cursor = None
+
     try:
-        response = requests.get(f"{BASE_URL}/view", timeout=10)
+        params = {"limit": PAGE_SIZE}
+        if cursor:
+            params["cursor"] = cursor
+        response = backend.get("/view", name="view", trace_id=g.trace_id, params=params)
         if response.status_code == 200:
-            patients_dict = response.json()
-            patients_list = list(patients_dict.values())
+            page = response.json()
+            patients_list = page.get("patients", [])
+            next_cursor = page.get("next_cursor")
         else:
             patients_list = []
     except Exception as e:
@@ -68,31 +136,37 @@ def view_patients():
         patients_list = []
 
     # print(f"DEBUG patients list: {patients_list}")
-    return render_template("view.html", patients=patients_list)
+    return render_template("view.html", patients=patients_list, next_cursor=next_cursor)
 
 
 
 @app.route("/sort", methods=["GET", "POST"])
 def sort_patients():
     patients_list = []
-    sort_by = None
-    order = None
+    next_cursor = None
 
-    if request.method == "POST":
-        sort_by = request.form.get("sort_by")
-        order = request.form.get("order")
-        
+    # POST comes from the sort form, GET with a cursor is the "next page" link
+    source = request.form if request.method == "POST" else request.args
+    sort_by = source.get("sort_by")
+    order = source.get("order")
+    cursor = source.get("cursor")
+
+    if sort_by:
         try:
-            url = f"{BASE_URL}/sort?sort_by={sort_by}&order={order}"
-            response = requests.get(url, timeout=10)
+            params = {"sort_by": sort_by, "order": order or "desc", "limit": PAGE_SIZE}
+            if cursor:
+                params["cursor"] = cursor
+            response = backend.get("/sort", name="sort", trace_id=g.trace_id, params=params)
             if response.status_code == 200:
-                patients_list = response.json()  # Directly use as list of dicts
+                page = response.json()
+                patients_list = page.get("patients", [])
+                next_cursor = page.get("next_cursor")
             else:
                 print(f"Backend returned error: {response.status_code}")
         except Exception as e:
             print(f"Error fetching sorted patients: {e}")
     
-    return render_template("sort.html", patients=patients_list, sort_by=sort_by, order=order)
+    return render_template("sort.html", patients=patients_list, sort_by=sort_by, order=order, next_cursor=next_cursor)
 
 
 
@@ -110,7 +184,7 @@ def register_patient():
             "weight": float(request.form.get("weight")),
         }
         try:
-            response = requests.post(f"{BASE_URL}/create", json=payload, timeout=10)
+            response = backend.post("/create", name="create", trace_id=g.trace_id, json=payload)
             if response.status_code in (200, 201):
                 return render_template("register.html", success="Patient registered successfully!")
             else:
@@ -132,7 +206,7 @@ def update_patient():
 
         if action == "fetch" and search_id:
             try:
-                resp = requests.get(f"{BASE_URL}/patient/{search_id}", timeout=10)
+                resp = backend.get(f"/patient/{search_id}", name="patient", trace_id=g.trace_id)
                 if resp.status_code == 200:
                     patient = resp.json()
                 else:
@@ -159,7 +233,7 @@ def update_patient():
                 return render_template("update.html", error="No fields changed.", search_id=search_id)
 
             try:
-                resp = requests.put(f"{BASE_URL}/edit/{search_id}", json=payload, timeout=10)
+                resp = backend.put(f"/edit/{search_id}", name="edit", trace_id=g.trace_id, json=payload)
                 if resp.status_code == 200:
                     return render_template("update.html", success="Patient updated successfully!", search_id=search_id)
                 else:
@@ -181,7 +255,7 @@ def delete_patient():
 
         if action == "fetch" and delete_id:
             try:
-                resp = requests.get(f"{BASE_URL}/patient/{delete_id}", timeout=10)
+                resp = backend.get(f"/patient/{delete_id}", name="patient", trace_id=g.trace_id)
                 if resp.status_code == 200:
                     patient = resp.json()
                 else:
@@ -191,7 +265,7 @@ def delete_patient():
 
         elif action == "delete" and delete_id:
             try:
-                resp = requests.delete(f"{BASE_URL}/delete/{delete_id}", timeout=10)
+                resp = backend.delete(f"/delete/{delete_id}", name="delete", trace_id=g.trace_id)
                 if resp.status_code == 200:
                     return render_template("delete.html", success="Patient deleted successfully!")
                 else:
@@ -202,6 +276,12 @@ def delete_patient():
     return render_template("delete.html", patient=patient, delete_id=delete_id)
 
 
+@app.route("/backend-metrics", methods=["GET"])
+def backend_metrics():
+    # Per-endpoint latency of the frontend -> backend hop
+    return jsonify(backend.metrics())
+
+
 def cast_value(field, val):
     if field in ["age"]:
         return int(val)
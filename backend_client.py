@@ -0,0 +1,122 @@
+# Pooled keep-alive HTTP client used by the Flask frontend to call the
+# FastAPI backend. One requests.Session is shared by all Flask threads so
+# connections to BASE_URL are reused instead of set up on every page load.
+
+import os
+import threading
+import time
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) timeouts per endpoint name, "default" for everything else
+DEFAULT_TIMEOUTS = {
+    "default": (3, 10),
+    "ask": (3, 20),
+    "ask_stream": (3, 60),
+}
+
+
+class BackendClient:
+    def __init__(self, base_url, pool_size=20, retries=3, backoff=0.2, timeouts=None, samples=500):
+        self.base_url = base_url.rstrip("/")
+        self.timeouts = {**DEFAULT_TIMEOUTS, **(timeouts or {})}
+
+        # Reads are retried on any failure. Writes (POST, PUT, DELETE) are only
+        # retried when the connection could not be made: after a read timeout
+        # or a 5xx the first attempt may have gone through, and replaying a
+        # DELETE would then report 404 for a patient that was in fact deleted
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=frozenset(["GET", "HEAD", "OPTIONS"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry, pool_block=False)
+
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._samples = samples
+        self._latencies = {}  # name -> deque of recent seconds
+        self._counters = {}  # name -> {"calls", "errors", "total_seconds"}
+        self._lock = threading.Lock()
+
+    def request(self, method, path, name="default", trace_id=None, **kwargs):
+        kwargs.setdefault("timeout", self.timeouts.get(name, self.timeouts["default"]))
+        # The backend stops its upstream calls once this client has given up
+        read_timeout = kwargs["timeout"][1] if isinstance(kwargs["timeout"], tuple) else kwargs["timeout"]
+        if read_timeout:
+            kwargs["headers"] = {**kwargs.get("headers", {}), "X-Request-Timeout": str(read_timeout)}
+        if trace_id:
+            # Lets the backend tie its per-stage timings to this frontend request
+            kwargs["headers"] = {**kwargs.get("headers", {}), "X-Trace-Id": trace_id}
+        start = time.perf_counter()
+        error = False
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+            error = response.status_code >= 500
+            return response
+        except requests.RequestException:
+            error = True
+            raise
+        finally:
+            # For streamed responses this is the time until headers arrived
+            self._record(name, time.perf_counter() - start, error)
+
+    def get(self, path, name="default", **kwargs):
+        return self.request("GET", path, name, **kwargs)
+
+    def post(self, path, name="default", **kwargs):
+        return self.request("POST", path, name, **kwargs)
+
+    def put(self, path, name="default", **kwargs):
+        return self.request("PUT", path, name, **kwargs)
+
+    def delete(self, path, name="default", **kwargs):
+        return self.request("DELETE", path, name, **kwargs)
+
+    def metrics(self):
+        with self._lock:
+            report = {}
+            for name, counters in self._counters.items():
+                recent = sorted(self._latencies[name])
+                report[name] = {
+                    **counters,
+                    "total_seconds": round(counters["total_seconds"], 4),
+                    "p50_ms": round(percentile(recent, 50) * 1000, 2),
+                    "p95_ms": round(percentile(recent, 95) * 1000, 2),
+                    "max_ms": round(recent[-1] * 1000, 2) if recent else 0.0,
+                }
+            return report
+
+    def _record(self, name, seconds, error):
+        with self._lock:
+            counters = self._counters.setdefault(name, {"calls": 0, "errors": 0, "total_seconds": 0.0})
+            counters["calls"] += 1
+            counters["errors"] += int(error)
+            counters["total_seconds"] += seconds
+            self._latencies.setdefault(name, deque(maxlen=self._samples)).append(seconds)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def create_backend_client(base_url):
+    return BackendClient(
+        base_url,
+        pool_size=int(os.getenv("BACKEND_POOL_SIZE", "20")),
+        retries=int(os.getenv("BACKEND_RETRIES", "3")),
+        backoff=float(os.getenv("BACKEND_BACKOFF", "0.2")),
+    )
@@ -0,0 +1,88 @@
+# Throughput of the LLM call path before/after the async rewrite.
+#
+# "sync" reproduces the old handler: a blocking OpenAI call inside FastAPI's
+# threadpool (40 workers by default). "async" awaits AsyncOpenAI on the event
+# loop. Both talk to a local stub completion server with a fixed latency.
+#
+#   python benchmarks/bench_async_ask.py --latency 1.0 --clients 50 200 1000
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from openai import OpenAI, AsyncOpenAI
+from langchain_core.messages import HumanMessage
+
+from custom_llm import CustomAPIChatLLM
+from stubs import make_llm_app, run_server
+
+THREADPOOL_SIZE = 40  # anyio's default limiter used by FastAPI for sync handlers
+
+
+def make_llm(base_url):
+    return CustomAPIChatLLM(
+        client=OpenAI(base_url=base_url, api_key="stub"),
+        async_client=AsyncOpenAI(base_url=base_url, api_key="stub"),
+        model_id="stub-model",
+    )
+
+
+async def run_sync(llm, clients, requests_per_client):
+    loop = asyncio.get_running_loop()
+    pool = ThreadPoolExecutor(max_workers=THREADPOOL_SIZE)
+    messages = [HumanMessage(content="what are symptoms of dengue")]
+
+    async def client():
+        for _ in range(requests_per_client):
+            await loop.run_in_executor(pool, llm.invoke, messages)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    elapsed = time.perf_counter() - start
+    pool.shutdown()
+    return elapsed
+
+
+async def run_async(llm, clients, requests_per_client):
+    messages = [HumanMessage(content="what are symptoms of dengue")]
+
+    async def client():
+        for _ in range(requests_per_client):
+            await llm.ainvoke(messages)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    elapsed = time.perf_counter() - start
+    await llm._async_client.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8901)
+    parser.add_argument("--latency", type=float, default=1.0, help="stub LLM latency in seconds")
+    parser.add_argument("--clients", type=int, nargs="+", default=[50, 200, 1000])
+    parser.add_argument("--requests", type=int, default=2, help="requests per client")
+    args = parser.parse_args()
+
+    server = run_server(make_llm_app, args.port, latency=args.latency)
+    base_url = f"http://127.0.0.1:{args.port}/v1"
+
+    print(f"{'clients':>8} {'mode':>6} {'requests':>9} {'seconds':>8} {'req/s':>8}")
+    for clients in args.clients:
+        total = clients * args.requests
+        for mode, runner in (("sync", run_sync), ("async", run_async)):
+            # Fresh clients per run: AsyncOpenAI is bound to the loop it first ran on
+            elapsed = asyncio.run(runner(make_llm(base_url), clients, args.requests))
+            print(f"{clients:>8} {mode:>6} {total:>9} {elapsed:>8.2f} {total / elapsed:>8.1f}")
+
+    server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# Bursts of identical concurrent requests, as after a health alert or with
+# many dashboards polling the same page.
+#
+#   python benchmarks/bench_coalesce.py --burst 10 100 500
+#
+# Each /ask burst uses a question no earlier burst asked, so the answer cache
+# cannot help and every request would otherwise run the pipeline. LLM calls
+# and coalesced requests are read from /metrics before and after the burst;
+# requests arriving after the leader finished are answer cache hits instead.
+# The fake patient collection answers reads without latency, so few /view
+# requests overlap there; against Mongo each overlapping page read is saved.
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+
+from bench_e2e import percentile
+from stubs import make_backend_app, make_llm_app, run_server
+
+
+def metric_total(text, name, **labels):
+    total = 0.0
+    for line in text.splitlines():
+        if line.startswith(name + "{") or line.startswith(name + " "):
+            if all(f'{k}="{v}"' in line for k, v in labels.items()):
+                total += float(line.rsplit(" ", 1)[1])
+    return total
+
+
+async def burst(client, size, request):
+    async def one():
+        start = time.perf_counter()
+        response = await request()
+        return time.perf_counter() - start, response.status_code == 200 and "error" not in response.json()
+
+    before = (await client.get("/metrics")).text
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one() for _ in range(size)))
+    elapsed = time.perf_counter() - start
+    after = (await client.get("/metrics")).text
+    latencies = sorted(r[0] for r in results)
+    return {
+        "errors": sum(not r[1] for r in results),
+        "seconds": elapsed,
+        "p50": percentile(latencies, 50) * 1000,
+        "p99": percentile(latencies, 99) * 1000,
+        "generate": metric_total(after, "rag_stage_seconds_count", stage="generate")
+        - metric_total(before, "rag_stage_seconds_count", stage="generate"),
+        "coalesced": metric_total(after, "single_flight_calls_total", role="coalesced")
+        - metric_total(before, "single_flight_calls_total", role="coalesced"),
+    }
+
+
+async def run(base_url, sizes):
+    limits = httpx.Limits(max_connections=max(sizes), max_keepalive_connections=max(sizes))
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+        print(f"{'request':>8} {'burst':>6} {'err':>4} {'seconds':>8} {'p50 ms':>8} {'p99 ms':>8} "
+              f"{'llm calls':>9} {'coalesced':>9}")
+        for size in sizes:
+            question = f"what are the early warning signs of outbreak {size}"
+            for label, request in (
+                ("ask", lambda: client.post("/ask", json={"question": question})),
+                ("view", lambda: client.get("/view", params={"limit": 100})),
+            ):
+                r = await burst(client, size, request)
+                print(f"{label:>8} {size:>6} {r['errors']:>4} {r['seconds']:>8.2f} {r['p50']:>8.1f} {r['p99']:>8.1f} "
+                      f"{r['generate']:>9.0f} {r['coalesced']:>9.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--burst", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--port", type=int, default=8960)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--embed-latency", type=float, default=0.05)
+    parser.add_argument("--mongo-latency", type=float, default=0.002)
+    args = parser.parse_args()
+
+    llm_port, api_port = args.port, args.port + 1
+    llm = run_server(make_llm_app, llm_port, latency=args.llm_latency)
+    api = run_server(make_backend_app, api_port, llm_url=f"http://127.0.0.1:{llm_port}/v1",
+                     embed_latency=args.embed_latency, mongo_latency=args.mongo_latency)
+    try:
+        asyncio.run(run(f"http://127.0.0.1:{api_port}", args.burst))
+    finally:
+        api.terminate()
+        llm.terminate()
+
+
+if __name__ == "__main__":
+    main()
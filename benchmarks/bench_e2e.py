@@ -0,0 +1,139 @@
+# Offline end-to-end benchmark of the FastAPI backend.
+#
+# Everything external is replaced by deterministic local stand-ins (see
+# stubs.py): an OpenAI-compatible completion server with configurable
+# latency, a hashing embedder, the in-process LocalVectorStore over a
+# synthetic corpus, and an in-memory Mongo collection. The real app runs
+# under uvicorn in its own process; this script drives it over HTTP at the
+# requested concurrency and reports latency percentiles and throughput.
+#
+#   python benchmarks/bench_e2e.py --concurrency 10 50 --requests 500
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+
+from stubs import make_backend_app, make_llm_app, run_server
+
+QUESTION_TOPICS = ["dengue", "malaria", "diabetes", "hypertension", "tuberculosis", "asthma", "measles", "cholera"]
+QUESTION_FORMS = ["what are the symptoms of {}", "how is {} treated", "how can I prevent {}", "is {} dangerous for children"]
+
+
+def question_pool(size, seed=0):
+    rng = random.Random(seed)
+    return [rng.choice(QUESTION_FORMS).format(rng.choice(QUESTION_TOPICS)) + ("" if i < 32 else f" case {i}")
+            for i in range(size)]
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))]
+
+
+async def ask(client, rng, questions):
+    response = await client.post("/ask", json={"question": rng.choice(questions)})
+    # The RAG functions report failures as answer text, not as HTTP errors
+    return response.status_code == 200 and not response.json().get("answer", "An error").startswith("An error")
+
+
+async def view(client, rng, questions):
+    return (await client.get("/view", params={"limit": 50})).status_code == 200
+
+
+async def sort(client, rng, questions):
+    params = {"sort_by": rng.choice(["height", "weight", "bmi"]), "order": rng.choice(["asc", "desc"]), "limit": 50}
+    return (await client.get("/sort", params=params)).status_code == 200
+
+
+async def crud(client, rng, questions):
+    # create -> read -> edit -> delete of a fresh patient, timed as one operation
+    patient_id = f"B{uuid.uuid4().hex[:10]}"
+    payload = {"id": patient_id, "name": "Bench", "city": "Pune", "age": 40, "gender": "female", "height": 1.6, "weight": 60}
+    ok = (await client.post("/create", json=payload)).status_code == 201
+    ok &= (await client.get(f"/patient/{patient_id}")).status_code == 200
+    ok &= (await client.put(f"/edit/{patient_id}", json={"weight": 65})).status_code == 200
+    ok &= (await client.delete(f"/delete/{patient_id}")).status_code == 200
+    return ok
+
+
+SCENARIOS = {"ask": ask, "view": view, "sort": sort, "crud": crud}
+
+
+async def run_scenario(base_url, scenario, concurrency, total, questions):
+    latencies = []
+    errors = 0
+    remaining = total
+
+    async def worker(seed):
+        nonlocal remaining, errors
+        rng = random.Random(seed)
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            try:
+                ok = await SCENARIOS[scenario](client, rng, questions)
+            except httpx.HTTPError:
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            errors += not ok
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(i) for i in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "ops": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed,
+        "p50": percentile(latencies, 50) * 1000,
+        "p95": percentile(latencies, 95) * 1000,
+        "p99": percentile(latencies, 99) * 1000,
+        "latencies": latencies,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 50])
+    parser.add_argument("--requests", type=int, default=300, help="operations per scenario and concurrency level")
+    parser.add_argument("--port", type=int, default=8920)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--embed-latency", type=float, default=0.05)
+    parser.add_argument("--mongo-latency", type=float, default=0.002)
+    parser.add_argument("--corpus", type=int, default=2000, help="chunks in the local vector store")
+    parser.add_argument("--patients", type=int, default=5000, help="patients seeded into the fake collection")
+    parser.add_argument("--questions", type=int, default=200, help="distinct questions (repeats hit the answer cache)")
+    args = parser.parse_args()
+
+    llm_port, api_port = args.port, args.port + 1
+    llm = run_server(make_llm_app, llm_port, latency=args.llm_latency)
+    api = run_server(make_backend_app, api_port, llm_url=f"http://127.0.0.1:{llm_port}/v1", corpus_size=args.corpus,
+                     embed_latency=args.embed_latency, mongo_latency=args.mongo_latency, seed_patients=args.patients)
+    try:
+        questions = question_pool(args.questions)
+        print(f"{'scenario':>8} {'conc':>5} {'ops':>6} {'err':>4} {'ops/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                r = asyncio.run(run_scenario(f"http://127.0.0.1:{api_port}", scenario, concurrency, args.requests, questions))
+                print(f"{scenario:>8} {concurrency:>5} {r['ops']:>6} {r['errors']:>4} {r['throughput']:>8.1f} "
+                      f"{r['p50']:>8.1f} {r['p95']:>8.1f} {r['p99']:>8.1f}")
+    finally:
+        api.terminate()
+        llm.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# Ingestion throughput (docs/s) against a fake embedder and a local vector store.
+#
+#   python benchmarks/bench_ingest.py --docs 500 --embed-latency 0.2 --upsert-latency 0.05
+#
+# Runs, each from a fresh checkpoint unless noted:
+#   serial     one chunking process, one embedding batch in flight, small batches
+#   pipelined  process pool, concurrent batches, large batches
+#   unchanged  pipelined again on the same checkpoint: every file is skipped
+#   edited     10% of the files changed: only their new chunks are embedded
+
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ingest import Checkpoint, LocalSink, ingest, iter_source_files
+from lexical_index import BM25Index
+from local_index import LocalVectorStore
+from stubs import FakeEmbeddings, fake_corpus
+
+
+class SlowSink(LocalSink):
+    # Stands in for a remote vector store: fixed latency per upsert request
+    def __init__(self, latency, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+
+    def upsert(self, ids, vectors, texts, metadatas):
+        time.sleep(self.latency)
+        super().upsert(ids, vectors, texts, metadatas)
+
+
+def write_corpus(root, docs, paragraphs):
+    corpus = fake_corpus(docs * paragraphs)
+    for i in range(docs):
+        with open(os.path.join(root, f"doc{i:05d}.txt"), "w") as f:
+            f.write("\n\n".join(corpus[i * paragraphs:(i + 1) * paragraphs]))
+
+
+def run(label, root, checkpoint_dir, embeddings, args, **kwargs):
+    sink = SlowSink(args.upsert_latency, vector_store=LocalVectorStore(None, args.dim), lexical=BM25Index())
+    checkpoint = Checkpoint(checkpoint_dir)
+    try:
+        stats = asyncio.run(ingest(list(iter_source_files(root)), embeddings, [sink], checkpoint,
+                                   rate=args.rate, **kwargs))
+    finally:
+        checkpoint.close()
+    print(f"{label:>10} {stats['files']:>6} {stats['chunks']:>7} {stats['embedded']:>8} "
+          f"{stats['chunks_skipped']:>8} {stats['seconds']:>8.2f} {stats['files'] / stats['seconds']:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=300)
+    parser.add_argument("--paragraphs", type=int, default=8, help="~300-character paragraphs per document")
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--embed-latency", type=float, default=0.2, help="seconds per embedding call")
+    parser.add_argument("--upsert-latency", type=float, default=0.05, help="seconds per upsert request")
+    parser.add_argument("--rate", type=float, default=50.0, help="embedding calls per second")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    embeddings = FakeEmbeddings(args.dim, args.embed_latency)
+    root = tempfile.mkdtemp(prefix="ingest-docs-")
+    state = tempfile.mkdtemp(prefix="ingest-state-")
+    try:
+        write_corpus(root, args.docs, args.paragraphs)
+        print(f"{'run':>10} {'files':>6} {'chunks':>7} {'embedded':>8} {'skipped':>8} {'seconds':>8} {'docs/s':>8}")
+        run("serial", root, os.path.join(state, "serial"), embeddings, args,
+            batch_size=16, upsert_batch_size=16, concurrency=1, workers=1)
+        pipelined = os.path.join(state, "pipelined")
+        run("pipelined", root, pipelined, embeddings, args,
+            batch_size=100, upsert_batch_size=100, concurrency=8, workers=args.workers)
+        run("unchanged", root, pipelined, embeddings, args,
+            batch_size=100, upsert_batch_size=100, concurrency=8, workers=args.workers)
+
+        rng = random.Random(1)
+        for name in rng.sample(sorted(os.listdir(root)), max(1, args.docs // 10)):
+            with open(os.path.join(root, name), "a") as f:
+                f.write("\n\nUpdated guidance: " + " ".join(rng.choice(["dose", "fever", "rest"]) for _ in range(40)))
+        run("edited", root, pipelined, embeddings, args,
+            batch_size=100, upsert_batch_size=100, concurrency=8, workers=args.workers)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+        shutil.rmtree(state, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
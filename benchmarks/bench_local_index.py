@@ -0,0 +1,65 @@
+# Recall@k and QPS of the local vector store: exact scan vs IVF at several nprobe.
+#
+#   python benchmarks/bench_local_index.py --n 200000 --dim 768 --nprobe 4 8 16 32
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from local_index import LocalVectorStore
+
+
+def clustered_corpus(n, dim, clusters, rng):
+    # Embeddings of real text are clustered by topic, uniform noise is not representative
+    centers = rng.normal(size=(clusters, dim))
+    return (centers[rng.integers(0, clusters, n)] + 0.35 * rng.normal(size=(n, dim))).astype(np.float32)
+
+
+def measure(store, queries, k):
+    results = []
+    start = time.perf_counter()
+    for q in queries:
+        results.append(set(store.search(q, k)[0].tolist()))
+    return results, len(queries) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 8, 16, 32])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    corpus = clustered_corpus(args.n, args.dim, args.clusters, rng)
+    queries = corpus[rng.integers(0, args.n, args.queries)] + 0.1 * rng.normal(size=(args.queries, args.dim))
+
+    store = LocalVectorStore(None, args.dim, ivf_threshold=0)
+    store.add_vectors(corpus, [""] * args.n, [{}] * args.n)
+
+    start = time.perf_counter()
+    store.build_ivf()
+    print(f"corpus {args.n} x {args.dim}, IVF with {len(store.centroids)} lists built in {time.perf_counter() - start:.1f}s")
+
+    exact = LocalVectorStore(None, args.dim, vectors=store.vectors, texts=store.texts, metadatas=store.metadatas)
+    truth, qps = measure(exact, queries, args.k)
+
+    print(f"{'index':>12} {'recall@' + str(args.k):>10} {'QPS':>10}")
+    print(f"{'exact':>12} {1.0:>10.3f} {qps:>10.1f}")
+    for nprobe in args.nprobe:
+        store.nprobe = nprobe
+        found, qps = measure(store, queries, args.k)
+        recall = np.mean([len(f & t) / args.k for f, t in zip(found, truth)])
+        print(f"{'ivf/' + str(nprobe):>12} {recall:>10.3f} {qps:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# Cost of the rerank stage per question, for several over-fetch sizes.
+#
+#   python benchmarks/bench_rerank.py --fetch-k 20 30 50 --dim 768
+#
+# "store" takes chunk vectors from the local vector store; "cache" goes through
+# CachedEmbeddings (the Pinecone setup) with every chunk already cached, as it
+# is after ingest.py. The context column is the estimated prompt context if
+# all fetched chunks were stuffed instead of the reranked top k.
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from context_builder import estimate_tokens
+from embedding_cache import CachedEmbeddings
+from local_index import LocalVectorStore
+from reranker import Reranker
+from stubs import FakeEmbeddings, fake_corpus
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--fetch-k", type=int, nargs="+", default=[20, 30, 50])
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    texts = fake_corpus(args.corpus)
+    embeddings = CachedEmbeddings(FakeEmbeddings(args.dim), "fake", args.dim, cache_dir=tempfile.mkdtemp())
+    store = LocalVectorStore.from_texts(texts, embeddings)
+    questions = [" ".join(text.split()[:6]) for text in rng.sample(texts, args.queries)]
+    vectors = [embeddings.embed_query(q) for q in questions]
+
+    print(f"{'source':>6} {'fetch_k':>7} {'rerank ms':>9} {'p99 ms':>7} {'context tokens (all -> top k)':>30}")
+    for source, reranker in (("store", Reranker(embeddings, store)), ("cache", Reranker(embeddings))):
+        for fetch_k in args.fetch_k:
+            timings, stuffed, kept = [], 0, 0
+            for question, vector in zip(questions, vectors):
+                docs = store.similarity_search_by_vector(vector, k=fetch_k)
+                reranker.chunk_vectors([d.page_content for d in docs])  # warm the embedding cache
+                start = time.perf_counter()
+                top = reranker.rerank(question, vector, docs, args.k)
+                timings.append(time.perf_counter() - start)
+                stuffed += sum(estimate_tokens(d.page_content) for d in docs)
+                kept += sum(estimate_tokens(d.page_content) for d in top)
+            timings.sort()
+            mean = sum(timings) / len(timings) * 1000
+            p99 = timings[int(0.99 * (len(timings) - 1))] * 1000
+            print(f"{source:>6} {fetch_k:>7} {mean:>9.2f} {p99:>7.2f} "
+                  f"{stuffed // len(questions):>18} -> {kept // len(questions)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+# The upstream-call manager (upstream.py) against the fake OpenAI server with
+# injected faults. Each run gets a fresh server.
+#
+#   python benchmarks/bench_upstream.py --scenarios hedge throttle breaker deadline
+#
+#   hedge     10% of primary calls take --tail-latency; with a fallback model
+#             the slow ones are hedged once they pass the primary's p95
+#   throttle  the server answers 429 beyond 8 calls in flight; a fixed limit
+#             of 64 against the adaptive one (each retries once)
+#   breaker   the primary model always fails; the circuit opens after 5
+#             failures and the fallback serves the rest
+#   deadline  3 s calls under a 1 s request deadline
+#
+# "upstream calls" are counted by the server per model and status.
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+from openai import AsyncOpenAI
+from prometheus_client import REGISTRY
+
+from bench_e2e import percentile
+from custom_llm import CustomAPIChatLLM
+from stubs import make_llm_app, run_server
+from upstream import AdaptiveLimit, Upstream, deadline
+
+PRIMARY, FALLBACK = "primary", "fallback"
+
+
+async def drive(llm, calls, concurrency, request_deadline=None):
+    latencies, errors = [], 0
+    remaining = calls
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            try:
+                if request_deadline:
+                    with deadline(request_deadline):
+                        await llm.ainvoke("what are the symptoms of dengue")
+                else:
+                    await llm.ainvoke("what are the symptoms of dengue")
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    await llm._async_client.close()
+    return sorted(latencies), errors, elapsed
+
+
+def run(label, port, server_kwargs, upstream, calls, concurrency, request_deadline=None):
+    server = run_server(make_llm_app, port, **server_kwargs)
+    try:
+        client = AsyncOpenAI(base_url=f"http://127.0.0.1:{port}/v1", api_key="stub", max_retries=0)
+        llm = CustomAPIChatLLM(client=None, async_client=client, model_id=PRIMARY, upstream=upstream)
+        latencies, errors, elapsed = asyncio.run(drive(llm, calls, concurrency, request_deadline))
+        server_calls = httpx.get(f"http://127.0.0.1:{port}/stats").json()["calls"]
+    finally:
+        server.terminate()
+
+    hedges = {result: REGISTRY.get_sample_value("upstream_hedges_total", {"upstream": upstream.name, "result": result})
+              or 0 for result in ("sent", "won")}
+    upstream_calls = " ".join(f"{model}:{status}x{n}" for model, by_status in sorted(server_calls.items())
+                              for status, n in sorted(by_status.items()))
+    print(f"{label:>22} {len(latencies):>6} {errors:>5} {len(latencies) / elapsed:>7.1f} "
+          f"{percentile(latencies, 50) * 1000:>8.0f} {percentile(latencies, 95) * 1000:>8.0f} "
+          f"{percentile(latencies, 99) * 1000:>8.0f} {hedges['sent']:>5.0f} {hedges['won']:>4.0f} "
+          f"{upstream.limit.limit:>6.1f}  {upstream_calls}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenarios", nargs="+", default=["hedge", "throttle", "breaker", "deadline"],
+                        choices=["hedge", "throttle", "breaker", "deadline"])
+    parser.add_argument("--calls", type=int, default=400)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--tail-latency", type=float, default=2.0)
+    parser.add_argument("--port", type=int, default=8980)
+    args = parser.parse_args()
+
+    print(f"{'run':>22} {'calls':>6} {'err':>5} {'ops/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'hedge':>5} {'won':>4} {'limit':>6}  upstream calls")
+    port = args.port
+    if "hedge" in args.scenarios:
+        server = dict(latency=args.latency, tail_fraction=0.1, tail_latency=args.tail_latency, slow_models=[PRIMARY])
+        run("hedge: off", port, server, Upstream("hedge_off", [PRIMARY]), args.calls, 8)
+        run("hedge: fallback", port + 1, server, Upstream("hedge_on", [PRIMARY, FALLBACK]), args.calls, 8)
+        port += 2
+    if "throttle" in args.scenarios:
+        server = dict(latency=args.latency * 2, max_concurrency=8)
+        fixed = Upstream("throttle_fixed", [PRIMARY], limit=AdaptiveLimit(64, minimum=64, maximum=64))
+        run("throttle: fixed 64", port, server, fixed, args.calls, 64)
+        run("throttle: adaptive", port + 1, server, Upstream("throttle_adaptive", [PRIMARY], concurrency=32),
+            args.calls, 64)
+        port += 2
+    if "breaker" in args.scenarios:
+        server = dict(latency=args.latency, failing_models=[PRIMARY])
+        run("breaker: no fallback", port, server, Upstream("breaker_off", [PRIMARY]), args.calls // 2, 8)
+        run("breaker: fallback", port + 1, server, Upstream("breaker_on", [PRIMARY, FALLBACK]), args.calls // 2, 8)
+        port += 2
+    if "deadline" in args.scenarios:
+        run("deadline: 1s", port, dict(latency=3.0), Upstream("deadline", [PRIMARY]), 16, 8, request_deadline=1.0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+# Throughput of the backend under gunicorn as the worker count grows.
+#
+#   python benchmarks/bench_workers.py --workers 1 2 4 8 --scenarios ask view
+#
+# Each run starts `gunicorn -k uvicorn.workers.UvicornWorker` with the same
+# gunicorn_conf.py as start.sh, every worker building the real app over the
+# fakes in stubs.py. Workers share the answer cache, conversations and rate
+# limits through a fresh SHARED_STATE_PATH, and metrics through
+# PROMETHEUS_MULTIPROC_DIR. Load comes from several client processes so the
+# load generator is not the bottleneck. Each worker has its own in-memory
+# patient collection, so the write scenario (crud) is not offered here.
+# Scaling is bounded by the CPUs on the machine: past os.cpu_count() workers
+# only add context switches.
+
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import httpx
+
+from bench_e2e import percentile, question_pool, run_scenario
+from stubs import make_llm_app, run_server
+
+
+def start_gunicorn(workers, port, llm_url, args, state_dir):
+    metrics_dir = os.path.join(state_dir, "metrics")
+    os.makedirs(metrics_dir)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, BENCH_DIR]),
+               SHARED_STATE_PATH=os.path.join(state_dir, "state.db"), PROMETHEUS_MULTIPROC_DIR=metrics_dir)
+    app = (f"stubs:make_backend_app(llm_url={llm_url!r}, corpus_size={args.corpus}, "
+           f"embed_latency={args.embed_latency}, mongo_latency={args.mongo_latency}, seed_patients={args.patients})")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", app, "-c", os.path.join(ROOT, "gunicorn_conf.py"),
+         "-k", "uvicorn.workers.UvicornWorker", "-w", str(workers), "-b", f"127.0.0.1:{port}", "--log-level", "warning"],
+        cwd=BENCH_DIR, env=env,
+    )
+    # Ready once /health answers; then give the remaining workers time to load the app
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            if httpx.get(f"http://127.0.0.1:{port}/health", timeout=5).status_code == 200:
+                time.sleep(max(1.0, 0.5 * workers))
+                return server
+        except (OSError, httpx.HTTPError):
+            pass
+        if server.poll() is not None:
+            raise RuntimeError("gunicorn exited during startup")
+        time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("gunicorn did not start")
+
+
+def drive(base_url, scenario, concurrency, total, questions):
+    return asyncio.run(run_scenario(base_url, scenario, concurrency, total, questions))
+
+
+def run_load(base_url, scenario, clients, concurrency, total, questions):
+    per_client = max(1, concurrency // clients)
+    with ProcessPoolExecutor(clients) as pool:
+        start = time.perf_counter()
+        futures = [pool.submit(drive, base_url, scenario, per_client, total // clients, questions)
+                   for _ in range(clients)]
+        results = [f.result() for f in futures]
+        elapsed = time.perf_counter() - start
+    latencies = sorted(l for r in results for l in r["latencies"])
+    return {
+        "ops": len(latencies),
+        "errors": sum(r["errors"] for r in results),
+        "throughput": len(latencies) / elapsed,
+        "p50": percentile(latencies, 50) * 1000,
+        "p95": percentile(latencies, 95) * 1000,
+        "p99": percentile(latencies, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--scenarios", nargs="+", default=["ask", "view"], choices=["ask", "view", "sort"])
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--clients", type=int, default=4, help="load generator processes")
+    parser.add_argument("--requests", type=int, default=800, help="operations per scenario and worker count")
+    parser.add_argument("--port", type=int, default=8940)
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    parser.add_argument("--embed-latency", type=float, default=0.0)
+    parser.add_argument("--mongo-latency", type=float, default=0.002)
+    parser.add_argument("--corpus", type=int, default=2000)
+    parser.add_argument("--patients", type=int, default=5000)
+    parser.add_argument("--questions", type=int, default=2000, help="distinct questions (repeats hit the answer cache)")
+    args = parser.parse_args()
+
+    llm_port, api_port = args.port, args.port + 1
+    llm = run_server(make_llm_app, llm_port, latency=args.llm_latency)
+    questions = question_pool(args.questions)
+    print(f"cpus: {os.cpu_count()}")
+    print(f"{'workers':>7} {'scenario':>8} {'ops':>6} {'err':>4} {'ops/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    try:
+        for workers in args.workers:
+            state_dir = tempfile.mkdtemp(prefix="bench-workers-")
+            server = start_gunicorn(workers, api_port, f"http://127.0.0.1:{llm_port}/v1", args, state_dir)
+            try:
+                for scenario in args.scenarios:
+                    r = run_load(f"http://127.0.0.1:{api_port}", scenario, args.clients, args.concurrency,
+                                 args.requests, questions)
+                    print(f"{workers:>7} {scenario:>8} {r['ops']:>6} {r['errors']:>4} {r['throughput']:>8.1f} "
+                          f"{r['p50']:>8.1f} {r['p95']:>8.1f} {r['p99']:>8.1f}")
+            finally:
+                server.terminate()
+                server.wait()
+                shutil.rmtree(state_dir, ignore_errors=True)
+    finally:
+        llm.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# Precision / recall of the query router on a labeled set, plus routing latency.
+#
+#   python benchmarks/eval_router.py                 # Gemini embeddings (needs GOOGLE_API_KEY)
+#   python benchmarks/eval_router.py --offline       # hashing embedder: text rules only are meaningful
+#   python benchmarks/eval_router.py --margin 0.02 0.05 0.1
+#
+# "medical" is the pass-through class: routing a medical question to a canned
+# reply is the costly mistake, so precision of the routed intents matters most.
+# The embedding stage ships off (ROUTER_MARGIN unset); run this against the
+# Gemini embeddings and keep the chosen margin's numbers with the setting.
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from query_router import QueryRouter, canned_responses
+from rag_model import CUSTOM_PROMPT_TEMPLATE
+
+INTENTS = ["greeting", "gratitude", "non_medical", "medical"]
+
+
+def load_labels(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def report(rows, predictions):
+    pairs = Counter((row["intent"], predicted) for row, predicted in zip(rows, predictions))
+    print(f"{'intent':>12} {'precision':>10} {'recall':>8} {'support':>8}")
+    for intent in INTENTS:
+        tp = pairs[(intent, intent)]
+        predicted = sum(n for (_, p), n in pairs.items() if p == intent)
+        actual = sum(n for (a, _), n in pairs.items() if a == intent)
+        precision = tp / predicted if predicted else float("nan")
+        recall = tp / actual if actual else float("nan")
+        print(f"{intent:>12} {precision:>10.3f} {recall:>8.3f} {actual:>8}")
+    mistakes = [(row["query"], row["intent"], p) for row, p in zip(rows, predictions) if row["intent"] != p]
+    for query, actual, predicted in mistakes:
+        print(f"  {actual} -> {predicted}: {query}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--labels", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "router_labels.jsonl"))
+    parser.add_argument("--margin", type=float, nargs="+", default=[0.05])
+    parser.add_argument("--offline", action="store_true")
+    args = parser.parse_args()
+
+    rows = load_labels(args.labels)
+    if args.offline:
+        from stubs import FakeEmbeddings
+        embeddings = FakeEmbeddings(256)
+    else:
+        from rag_model import create_embedding_model
+        embeddings = create_embedding_model()
+
+    router = QueryRouter(canned_responses(CUSTOM_PROMPT_TEMPLATE)).fit(embeddings)
+    queries = [row["query"] for row in rows]
+    if hasattr(embeddings, "embed_queries"):
+        vectors = embeddings.embed_queries(queries)
+    else:
+        vectors = [embeddings.embed_query(q) for q in queries]
+
+    start = time.perf_counter()
+    for _ in range(100):
+        for query in queries:
+            router.route_text(query)
+    text_us = (time.perf_counter() - start) / (100 * len(queries)) * 1e6
+    start = time.perf_counter()
+    for _ in range(100):
+        for vector in vectors:
+            router.margin_for(vector)
+    vector_us = (time.perf_counter() - start) / (100 * len(queries)) * 1e6
+    print(f"{len(rows)} labeled queries; route_text {text_us:.1f} us, route_vector {vector_us:.1f} us per query\n")
+
+    for margin in args.margin:
+        router.margin = margin
+        predictions = [router.route(q, v) or "medical" for q, v in zip(queries, vectors)]
+        print(f"margin {margin}")
+        report(rows, predictions)
+        print()
+
+
+if __name__ == "__main__":
+    main()
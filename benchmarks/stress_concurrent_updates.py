@@ -0,0 +1,105 @@
+# Lost-update stress test for PUT /edit/{id}. Needs a real MongoDB
+# (MONGO_* env vars); uses a throwaway database.
+#
+# One writer per field (name, city, age, height, weight) hammers the same
+# patients in parallel, each writing an increasing sequence of values to its
+# own field. Afterwards every field must hold its writer's last value and
+# bmi/verdict must match the final height/weight. The old read-modify-write
+# update (--legacy) fails this: a writer re-saves a stale copy of the other
+# fields.
+#
+#   python benchmarks/stress_concurrent_updates.py --patients 20 --rounds 200
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import httpx
+
+import mongo_db
+import patients_api
+from patient_stats import verdict_for_bmi
+
+
+def field_value(field, step):
+    return {
+        "name": f"name-{step}",
+        "city": f"city-{step}",
+        "age": 1 + step % 118,
+        "height": round(1.4 + (step % 60) / 100, 2),
+        "weight": round(40 + (step % 80), 1),
+    }[field]
+
+
+FIELDS = ["name", "city", "age", "height", "weight"]
+
+
+async def legacy_update(collection, patient_id, fields):
+    # The pre-atomic implementation: read, merge in Python, write everything back
+    existing = await collection.find_one({"id": patient_id}, {"_id": 0})
+    existing.update(fields)
+    patient = patients_api.Patient(**existing)
+    await collection.update_one({"id": patient_id}, {"$set": patient.model_dump(exclude={"id"})})
+
+
+async def run(args):
+    db_name = f"stress_{int(time.time())}"
+    mongo_db.connect()
+    collection = mongo_db.async_client[db_name]["patients"]
+    mongo_db.use_collections(collection, mongo_db.async_client[db_name]["patient_stats"])
+    await mongo_db.ensure_indexes()
+
+    transport = httpx.ASGITransport(app=patients_api.app)
+    limits = httpx.Limits(max_connections=None)
+    async with httpx.AsyncClient(transport=transport, base_url="http://stress", limits=limits) as client:
+        ids = [f"S{i:04d}" for i in range(args.patients)]
+        for patient_id in ids:
+            await client.post("/create", json={"id": patient_id, "name": "x", "city": "x", "age": 30,
+                                               "gender": "male", "height": 1.7, "weight": 70})
+
+        async def writer(patient_id, field):
+            for step in range(args.rounds):
+                value = field_value(field, step)
+                if args.legacy:
+                    await legacy_update(collection, patient_id, {field: value})
+                else:
+                    response = await client.put(f"/edit/{patient_id}", json={field: value})
+                    response.raise_for_status()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(writer(pid, field) for pid in ids for field in FIELDS))
+        elapsed = time.perf_counter() - start
+
+    lost = 0
+    async for doc in collection.find({}, {"_id": 0}):
+        expected = {field: field_value(field, args.rounds - 1) for field in FIELDS}
+        bmi = round(doc["weight"] / doc["height"] ** 2, 2)
+        if any(doc[f] != v for f, v in expected.items()) or doc["bmi"] != bmi or doc["verdict"] != verdict_for_bmi(bmi):
+            lost += 1
+
+    writes = args.patients * len(FIELDS) * args.rounds
+    print(f"{'legacy' if args.legacy else 'atomic'}: {writes} updates in {elapsed:.2f}s "
+          f"({writes / elapsed:.0f}/s), patients with lost updates: {lost}/{args.patients}")
+
+    await mongo_db.async_client.drop_database(db_name)
+    return lost
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patients", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=100, help="updates per field per patient")
+    parser.add_argument("--legacy", action="store_true", help="use the old read-modify-write update")
+    args = parser.parse_args()
+
+    lost = asyncio.run(run(args))
+    sys.exit(1 if lost and not args.legacy else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# Streaming parsers/writers for bulk patient import and export (NDJSON / CSV).
+# Rows are produced as request bytes arrive, so a 200k-row upload is never
+# held in memory at once.
+
+import codecs
+import csv
+import io
+import json
+
+
+async def iter_lines(chunks):
+    # Async iterator of bytes -> decoded text lines; a leading BOM (Excel
+    # CSV exports) is dropped so it doesn't stick to the first header
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer.rstrip("\r")
+
+
+async def iter_records(chunks, fmt):
+    # Yields (row number, dict) or (row number, ValueError) for unparsable rows.
+    # Row numbers are 1-based data rows (the CSV header is not counted).
+    header = None
+    row = 0
+    async for line in iter_lines(chunks):
+        if not line.strip():
+            continue
+
+        if fmt == "csv":
+            values = next(csv.reader([line]))
+            if header is None:
+                header = [h.strip() for h in values]
+                continue
+            row += 1
+            if len(values) != len(header):
+                yield row, ValueError(f"expected {len(header)} columns, got {len(values)}")
+                continue
+            # Empty cells are treated as missing so validation reports them
+            yield row, {k: v for k, v in zip(header, values) if v != ""}
+        else:
+            row += 1
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield row, ValueError(f"invalid JSON: {e}")
+                continue
+            if not isinstance(record, dict):
+                yield row, ValueError("expected a JSON object")
+                continue
+            yield row, record
+
+
+def csv_line(values):
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerow(values)
+    return buffer.getvalue()
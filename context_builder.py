@@ -0,0 +1,114 @@
+# Context assembly for the "stuff" prompt.
+#
+# Retrieved chunks are split into sentences, duplicates (including the
+# partial sentences that overlapping chunk windows share) are dropped, and
+# the sentences that overlap the question most are kept until the token
+# budget is reached. Kept sentences are emitted in their original order so
+# the context still reads naturally.
+
+import math
+import os
+import re
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "800"))
+
+STOPWORDS = set("""
+a an and are as at be by can do does for from has have how i in is it its me my
+of on or should that the their them there these this to was what when where
+which who why will with you your about into than then also may
+""".split())
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n+")
+_TOKEN = re.compile(r"\w+|[^\w\s]")
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def estimate_tokens(text):
+    # BPE tokenizers average ~1.3 tokens per word for English prose; punctuation
+    # is usually a token of its own
+    pieces = _TOKEN.findall(text)
+    words = sum(1 for p in pieces if p[0].isalnum() or p[0] == "_")
+    return int(math.ceil(words * 1.3)) + (len(pieces) - words)
+
+
+def terms(text):
+    return {w for w in _WORD.findall(text.lower()) if w not in STOPWORDS and len(w) > 1}
+
+
+def split_sentences(text):
+    return [s.strip() for s in _SENTENCE_END.split(text) if s and s.strip()]
+
+
+def _normalized(sentence):
+    return " ".join(_WORD.findall(sentence.lower()))
+
+
+def truncate_to_budget(text, token_budget):
+    # Longest prefix of whole words that fits the budget
+    words = text.split()
+    low, high = 0, len(words)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(" ".join(words[:mid])) <= token_budget:
+            low = mid
+        else:
+            high = mid - 1
+    return " ".join(words[:low])
+
+
+def build_context(docs, query, token_budget=CONTEXT_TOKEN_BUDGET):
+    query_terms = terms(query)
+
+    # (rank, position, text, key, score); duplicates and fragments contained
+    # in a longer sentence (as whole words) collapse into one entry
+    sentences = []
+    for rank, doc in enumerate(docs):
+        for position, text in enumerate(split_sentences(doc.page_content)):
+            key = _normalized(text)
+            if not key:
+                continue
+            key = f" {key} "  # padded so containment only matches whole words
+
+            duplicate = False
+            for i, kept in enumerate(sentences):
+                if key in kept[3]:
+                    duplicate = True
+                    break
+                if kept[3] in key:
+                    # The new sentence is the complete version of a kept fragment
+                    sentences[i] = None
+            sentences = [s for s in sentences if s is not None]
+            if duplicate:
+                continue
+
+            sentence_terms = terms(text)
+            overlap = len(query_terms & sentence_terms)
+            score = overlap / math.sqrt(len(sentence_terms) + 1)
+            sentences.append((rank, position, text, key, score))
+
+    # Most relevant first; without any overlap fall back to retrieval order
+    order = sorted(sentences, key=lambda s: (-s[4], s[0], s[1]))
+    selected = []
+    used = 0
+    for sentence in order:
+        if sentence[4] == 0 and any(s[4] > 0 for s in selected):
+            break
+        cost = estimate_tokens(sentence[2])
+        if used + cost > token_budget:
+            if selected:
+                continue
+            # A single oversized sentence (e.g. an unpunctuated chunk) is cut
+            # rather than blowing the budget
+            text = truncate_to_budget(sentence[2], token_budget)
+            if not text:
+                continue
+            sentence = sentence[:2] + (text,) + sentence[3:]
+            cost = estimate_tokens(text)
+        selected.append(sentence)
+        used += cost
+
+    selected.sort(key=lambda s: (s[0], s[1]))
+    blocks = []
+    for rank in sorted({s[0] for s in selected}):
+        blocks.append(" ".join(s[2] for s in selected if s[0] == rank))
+    return "\n\n".join(blocks)
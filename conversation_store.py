@@ -0,0 +1,187 @@
+# Server-side conversation state for the assistant, keyed by session id.
+#
+# The Flask frontend only keeps the session id in its cookie. For each
+# session we keep the last few messages (for display) and a rolling topic
+# summary: decayed weights of the content words of recent questions. A
+# follow-up such as "what about for children?" is rewritten into a
+# standalone retrieval query by appending the current topic; updating the
+# summary touches only the new question's words, so every turn costs the
+# same regardless of conversation length. Sessions share the LRU + TTL
+# eviction and byte budget of the answer cache; in multi-worker mode they
+# live in the shared store instead, so any worker can continue a session
+# (async callers then use the a* methods, which do the SQLite I/O in a thread).
+
+import asyncio
+import json
+import os
+import threading
+from collections import deque
+
+from answer_cache import LRUTTLCache
+from context_builder import terms
+from shared_store import shared_store
+
+FOLLOW_UP_CUES = {
+    "it", "its", "that", "this", "they", "them", "their", "those", "these", "he", "she", "him", "her",
+    "same", "also", "instead", "else", "more", "other", "another",
+}
+FOLLOW_UP_OPENERS = ("and ", "what about", "how about", "what if", "but ", "also ", "then ")
+# A question made only of these ("dosage?", "side effects?") asks about the
+# current topic; any other lone term ("malaria?") starts a new one
+FOLLOW_UP_ASPECTS = {
+    "symptoms", "symptom", "signs", "causes", "cause", "treatment", "treatments", "treat", "cure", "medicine",
+    "medicines", "medication", "dose", "dosage", "side", "effects", "risks", "risk", "complications",
+    "prevention", "prevent", "diagnosis", "test", "tests", "diet", "precautions", "children", "kids",
+    "pregnancy", "elderly", "adults", "duration", "recovery", "contagious", "serious", "dangerous",
+}
+
+
+class Conversation:
+    def __init__(self, max_messages=10, topic_terms=6, decay=0.8, new_topic_decay=0.1):
+        self.messages = deque(maxlen=max_messages)
+        self.topic_terms = topic_terms
+        self.decay = decay
+        self.new_topic_decay = new_topic_decay
+        self.weights = {}  # term -> weight, insertion order = first mention
+
+    @property
+    def summary(self):
+        if not self.weights:
+            return ""
+        floor = 0.3 * max(self.weights.values())
+        top = sorted(self.weights, key=self.weights.get, reverse=True)[:self.topic_terms]
+        return " ".join(t for t in self.weights if t in top and self.weights[t] >= floor)
+
+    def is_follow_up(self, question):
+        text = question.lower().strip()
+        words = set(text.replace("?", " ").replace(",", " ").split())
+        question_terms = terms(question)
+        return bool(self.weights) and (
+            text.startswith(FOLLOW_UP_OPENERS) or bool(words & FOLLOW_UP_CUES) or question_terms <= FOLLOW_UP_ASPECTS
+        )
+
+    def condense(self, question):
+        if not self.is_follow_up(question):
+            return question
+        return f"{question.rstrip()} (regarding: {self.summary})"
+
+    def update(self, question, answer, topical=True):
+        # Small talk ("thanks") is kept in the transcript but not in the topic
+        if topical:
+            # A new topic fades the old one much faster than a follow-up does
+            decay = self.decay if self.is_follow_up(question) else self.new_topic_decay
+            for term in list(self.weights):
+                self.weights[term] *= decay
+                if self.weights[term] < 0.1:
+                    del self.weights[term]
+            for term in terms(question):
+                self.weights[term] = self.weights.get(term, 0.0) + 1.0
+
+        self.messages.append({"role": "user", "content": question})
+        self.messages.append({"role": "assistant", "content": answer})
+
+    def size(self):
+        return 256 + sum(len(m["content"]) for m in self.messages) + 16 * len(self.weights)
+
+    def dumps(self):
+        return json.dumps({"messages": list(self.messages), "weights": self.weights})
+
+    @classmethod
+    def loads(cls, data, max_messages):
+        state = json.loads(data)
+        conversation = cls(max_messages)
+        conversation.messages.extend(state["messages"])
+        conversation.weights = state["weights"]
+        return conversation
+
+
+class ConversationStore:
+    def __init__(self, max_sessions=10000, ttl=3600, max_bytes=64 * 1024 * 1024, max_messages=10, shared=None):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.shared = shared
+        self._sessions = LRUTTLCache(max_sessions, ttl, max_bytes)
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def __len__(self):
+        if self.shared is not None:
+            return self.shared.count("conversation")
+        return len(self._sessions)
+
+    def _get(self, session_id):
+        if self.shared is None:
+            return self._sessions.get(session_id)
+        data = self.shared.get("conversation", session_id)
+        return Conversation.loads(data, self.max_messages) if data is not None else None
+
+    def condense(self, session_id, question):
+        # Standalone retrieval query for this turn; the question itself when
+        # the session is new or the question doesn't refer back
+        with self._lock:
+            conversation = self._get(session_id)
+            return conversation.condense(question) if conversation is not None else question
+
+    def record(self, session_id, question, answer, topical=True):
+        def updated(conversation):
+            conversation = conversation or Conversation(self.max_messages)
+            conversation.update(question, answer, topical)
+            return conversation
+
+        if self.shared is not None:
+            # One transaction, so two workers handling turns of the same
+            # session concurrently don't drop one of them
+            self.shared.update(
+                "conversation", session_id,
+                lambda data: updated(Conversation.loads(data, self.max_messages) if data is not None else None).dumps(),
+                self.ttl,
+            )
+            self._writes += 1
+            if self._writes % 1000 == 0:
+                self.shared.trim("conversation", self.max_sessions)
+            return
+
+        with self._lock:
+            conversation = updated(self._sessions.get(session_id))
+            # Re-inserting refreshes the TTL and the byte accounting
+            self._sessions.put(session_id, conversation, conversation.size())
+
+    def history(self, session_id):
+        with self._lock:
+            conversation = self._get(session_id)
+            if conversation is None:
+                return {"messages": [], "summary": ""}
+            return {"messages": list(conversation.messages), "summary": conversation.summary}
+
+    def clear(self, session_id):
+        with self._lock:
+            if self.shared is not None:
+                self.shared.delete("conversation", session_id)
+            else:
+                self._sessions.pop(session_id)
+
+    async def acondense(self, session_id, question):
+        return await self._off_loop(self.condense, session_id, question)
+
+    async def arecord(self, session_id, question, answer, topical=True):
+        await self._off_loop(self.record, session_id, question, answer, topical)
+
+    async def ahistory(self, session_id):
+        return await self._off_loop(self.history, session_id)
+
+    async def aclear(self, session_id):
+        await self._off_loop(self.clear, session_id)
+
+    async def _off_loop(self, fn, *args):
+        if self.shared is None:
+            return fn(*args)
+        return await asyncio.to_thread(fn, *args)
+
+
+conversations = ConversationStore(
+    max_sessions=int(os.getenv("CONVERSATION_MAX_SESSIONS", "10000")),
+    ttl=float(os.getenv("CONVERSATION_TTL", "3600")),
+    max_bytes=int(os.getenv("CONVERSATION_MAX_BYTES", str(64 * 1024 * 1024))),
+    shared=shared_store,
+)
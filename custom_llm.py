@@ -0,0 +1,123 @@
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatResult, ChatGeneration, ChatGenerationChunk
+from pydantic import PrivateAttr
+
+
+def delta_text(chunk):
+    # Text carried by one streamed completion chunk (may be empty)
+    if not chunk.choices:
+        return ""
+    return chunk.choices[0].delta.content or ""
+
+
+def usage_metadata(completion):
+    usage = getattr(completion, "usage", None)
+    if not usage:
+        return None
+    return {
+        "input_tokens": usage.prompt_tokens or 0,
+        "output_tokens": usage.completion_tokens or 0,
+        "total_tokens": usage.total_tokens or 0,
+    }
+
+
+def call_kind(kwargs):
+    # Opening a stream returns at the first token, long before a completion
+    # would: the upstream keeps their latencies apart
+    return "stream" if kwargs.get("stream") else "completion"
+
+
+def to_api_messages(messages):
+    # Convert langchain messages to the OpenAI chat format
+    return [
+        {
+            "role": "user" if m.type == "human" else "assistant",
+            "content": m.content
+        }
+        for m in messages
+    ]
+
+
+class CustomAPIChatLLM(BaseChatModel):
+    model_id: str  # Pydantic field
+    _client: any = PrivateAttr()  # Private attribute (not a model field)
+    _async_client: any = PrivateAttr()
+    _upstream: any = PrivateAttr()
+
+    def __init__(self, client, model_id, async_client=None, upstream=None, **kwargs):
+        super().__init__(model_id=model_id, **kwargs)
+        self._client = client  # store in private attr
+        self._async_client = async_client
+        # Optional upstream.Upstream: rate limit, adaptive concurrency,
+        # deadlines, hedging to a fallback model and a circuit breaker
+        self._upstream = upstream
+
+    @property
+    def _llm_type(self) -> str:
+        return "custom_api_chat_llm"
+
+    def _create(self, messages, **kwargs):
+        api_messages = to_api_messages(messages)
+        if self._upstream is None:
+            return self._client.chat.completions.create(model=self.model_id, messages=api_messages, **kwargs)
+        return self._upstream.call(lambda model, timeout: self._client.chat.completions.create(
+            model=model, messages=api_messages, timeout=timeout, **kwargs), kind=call_kind(kwargs))
+
+    async def _acreate(self, messages, **kwargs):
+        api_messages = to_api_messages(messages)
+        if self._upstream is None:
+            return await self._async_client.chat.completions.create(model=self.model_id, messages=api_messages, **kwargs)
+        # A stream is only managed until it opens and is not hedged
+        return await self._upstream.acall(lambda model, timeout: self._async_client.chat.completions.create(
+            model=model, messages=api_messages, timeout=timeout, **kwargs),
+            hedge=not kwargs.get("stream"), kind=call_kind(kwargs))
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        # Call your API
+        completion = self._create(messages)
+
+        content = completion.choices[0].message.content
+        # Return as ChatResult
+        return ChatResult(
+            generations=[ChatGeneration(message=AIMessage(content=content, usage_metadata=usage_metadata(completion)))]
+        )
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        # Without an async client fall back to the default (sync call in an executor)
+        if self._async_client is None:
+            return await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+        completion = await self._acreate(messages)
+
+        content = completion.choices[0].message.content
+        return ChatResult(
+            generations=[ChatGeneration(message=AIMessage(content=content, usage_metadata=usage_metadata(completion)))]
+        )
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        stream = self._create(messages, stream=True)
+
+        for chunk in stream:
+            text = delta_text(chunk)
+            if not text:
+                continue
+            if run_manager:
+                run_manager.on_llm_new_token(text)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=text))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        if self._async_client is None:
+            async for chunk in super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                yield chunk
+            return
+
+        stream = await self._acreate(messages, stream=True)
+
+        async for chunk in stream:
+            text = delta_text(chunk)
+            if not text:
+                continue
+            if run_manager:
+                await run_manager.on_llm_new_token(text)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=text))
@@ -0,0 +1,231 @@
+# Embeddings wrapper that memoizes vectors by content hash + model name.
+#
+# Lookups go through an in-process LRU first, then a shared on-disk store:
+# an append-only float32 file read through np.memmap plus an append-only
+# "key row" index. Appends take an exclusive flock so several uvicorn workers
+# can share (and grow) the same store; the async methods do that disk I/O in
+# a thread so a contended lock never stalls the event loop.
+
+import asyncio
+import fcntl
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+class DiskVectorStore:
+    def __init__(self, path, dimension):
+        os.makedirs(path, exist_ok=True)
+        self.dimension = dimension
+        self.row_bytes = dimension * 4
+        self.vectors_path = os.path.join(path, f"vectors-{dimension}.f32")
+        self.index_path = os.path.join(path, f"index-{dimension}.txt")
+        self.lock_path = os.path.join(path, f"store-{dimension}.lock")
+
+        for p in (self.vectors_path, self.index_path, self.lock_path):
+            open(p, "ab").close()
+
+        self._offsets = {}  # key -> row number
+        self._index_read = 0  # bytes of the index file already parsed
+        self._mmap = None
+        self._mmap_rows = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            row = self._offsets.get(key)
+            if row is None:
+                # Another worker may have appended since we last looked
+                self._refresh_index()
+                row = self._offsets.get(key)
+                if row is None:
+                    return None
+            return self._row(row)
+
+    def put_many(self, items):
+        # items: list of (key, vector)
+        with self._lock, open(self.lock_path, "ab") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._refresh_index()
+                new_items = [(k, v) for k, v in items if k not in self._offsets]
+                if not new_items:
+                    return
+                for _, vector in new_items:
+                    if len(vector) != self.dimension:
+                        raise ValueError(f"vector has {len(vector)} dimensions, store expects {self.dimension}")
+
+                next_row = self._truncate_torn_writes()
+                block = np.asarray([v for _, v in new_items], dtype=np.float32)
+                with open(self.vectors_path, "ab") as f:
+                    f.write(block.tobytes())
+
+                lines = []
+                for i, (key, _) in enumerate(new_items):
+                    lines.append(f"{key} {next_row + i}\n")
+                    self._offsets[key] = next_row + i
+                with open(self.index_path, "a") as f:
+                    f.write("".join(lines))
+                self._index_read = os.path.getsize(self.index_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _truncate_torn_writes(self):
+        # Called under the flock. A writer killed mid-append can leave a
+        # partial vector row or index line at the end; appending after it
+        # would misalign every later row or glue two index lines together.
+        # Partial rows are never indexed (the index is written second), so
+        # cutting them off loses nothing. Returns the next free row.
+        size = os.path.getsize(self.vectors_path)
+        rows = size // self.row_bytes
+        if size % self.row_bytes:
+            os.truncate(self.vectors_path, rows * self.row_bytes)
+
+        index_size = os.path.getsize(self.index_path)
+        if index_size > self._index_read:
+            # _refresh_index just consumed every complete line
+            os.truncate(self.index_path, self._index_read)
+        return rows
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def _refresh_index(self):
+        size = os.path.getsize(self.index_path)
+        if size == self._index_read:
+            return
+
+        with open(self.index_path, "rb") as f:
+            f.seek(self._index_read)
+            chunk = f.read(size - self._index_read)
+
+        # Only consume complete lines, a writer may be mid-append
+        end = chunk.rfind(b"\n") + 1
+        for line in chunk[:end].decode().splitlines():
+            key, row = line.split()
+            self._offsets[key] = int(row)
+        self._index_read += end
+
+    def _row(self, row):
+        if row >= self._mmap_rows:
+            rows = os.path.getsize(self.vectors_path) // self.row_bytes
+            self._mmap = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(rows, self.dimension))
+            self._mmap_rows = rows
+        return self._mmap[row].tolist()
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings, model_name, dimension, cache_dir=None, lru_size=10000,
+                 query_batch_kwargs=None):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        # Extra embed_documents() kwargs that make it produce *query* vectors
+        # (e.g. task_type for Gemini); None means batches fall back to embed_query
+        self.query_batch_kwargs = query_batch_kwargs
+        self.lru_size = lru_size
+        self.store = DiskVectorStore(cache_dir, dimension) if cache_dir else None
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, text, kind):
+        # Query and document embeddings differ (task type), so they are cached apart
+        return hashlib.sha256(f"{self.model_name}\0{kind}\0{text}".encode()).hexdigest()
+
+    def embed_documents(self, texts):
+        keys, vectors, missing = self._lookup(texts, "document")
+        if missing:
+            # All misses go out in one batched call
+            missing_texts = list(missing)
+            vectors.update(self._store(missing, missing_texts, self.embeddings.embed_documents(missing_texts)))
+        return [vectors[k] for k in keys]
+
+    def embed_query(self, text):
+        keys, vectors, missing = self._lookup([text], "query")
+        if missing:
+            vectors.update(self._store(missing, [text], [self.embeddings.embed_query(text)]))
+        return vectors[keys[0]]
+
+    def embed_queries(self, texts):
+        # Many queries at once; all misses go out in a single batched call
+        keys, vectors, missing = self._lookup(texts, "query")
+        if missing:
+            missing_texts = list(missing)
+            if self.query_batch_kwargs is not None:
+                new_vectors = self.embeddings.embed_documents(missing_texts, **self.query_batch_kwargs)
+            else:
+                new_vectors = [self.embeddings.embed_query(t) for t in missing_texts]
+            vectors.update(self._store(missing, missing_texts, new_vectors))
+        return [vectors[k] for k in keys]
+
+    async def aembed_queries(self, texts):
+        return await asyncio.to_thread(self.embed_queries, texts)
+
+    async def aembed_documents(self, texts):
+        keys, vectors, missing = await self._off_loop(self._lookup, texts, "document")
+        if missing:
+            missing_texts = list(missing)
+            new_vectors = await self.embeddings.aembed_documents(missing_texts)
+            vectors.update(await self._off_loop(self._store, missing, missing_texts, new_vectors))
+        return [vectors[k] for k in keys]
+
+    async def aembed_query(self, text):
+        keys, vectors, missing = await self._off_loop(self._lookup, [text], "query")
+        if missing:
+            new_vector = await self.embeddings.aembed_query(text)
+            vectors.update(await self._off_loop(self._store, missing, [text], [new_vector]))
+        return vectors[keys[0]]
+
+    async def _off_loop(self, fn, *args):
+        # Purely in-memory without a disk store: not worth a thread hop
+        if self.store is None:
+            return fn(*args)
+        return await asyncio.to_thread(fn, *args)
+
+    def _lookup(self, texts, kind):
+        # Returns (key per text, key -> cached vector, text -> key for misses)
+        keys = [self.key(t, kind) for t in texts]
+        vectors = {}
+        missing = {}
+        for text, key in zip(texts, keys):
+            if key in vectors or text in missing:
+                continue
+
+            vector = self._lru_get(key)
+            if vector is not None:
+                self.stats["memory_hits"] += 1
+            elif self.store is not None and (vector := self.store.get(key)) is not None:
+                self.stats["disk_hits"] += 1
+                self._lru_put(key, vector)
+            else:
+                self.stats["misses"] += 1
+                missing[text] = key
+                continue
+            vectors[key] = vector
+        return keys, vectors, missing
+
+    def _store(self, missing, texts, new_vectors):
+        items = [(missing[t], v) for t, v in zip(texts, new_vectors)]
+        for key, vector in items:
+            self._lru_put(key, vector)
+        if self.store is not None:
+            self.store.put_many(items)
+        return dict(items)
+
+    def _lru_get(self, key):
+        with self._lock:
+            vector = self._lru.get(key)
+            if vector is not None:
+                self._lru.move_to_end(key)
+            return vector
+
+    def _lru_put(self, key, vector):
+        with self._lock:
+            self._lru[key] = vector
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
@@ -0,0 +1,22 @@
+# gunicorn settings for both apps (see start.sh):
+#   gunicorn patients_api:app -c gunicorn_conf.py -k uvicorn.workers.UvicornWorker -w 4
+#   gunicorn app:app -c gunicorn_conf.py -k gthread -w 2 --threads 8
+
+import os
+
+from prometheus_client import multiprocess
+
+# Every worker imports the app itself, so Mongo / Pinecone / OpenAI clients
+# and HTTP sessions are created after the fork, never shared with the master
+preload_app = False
+
+# Worker heartbeat timeout; streamed answers can keep a request open longer
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
+
+
+def child_exit(server, worker):
+    # Drop the dead worker's live samples from the aggregated /metrics
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,103 @@
+# Hybrid retrieval: BM25 over local chunks fused with vector search by
+# reciprocal rank fusion (RRF).
+#
+# Both sides fetch `fetch_k` candidates; a chunk scores sum(1 / (rrf_k + rank))
+# over the lists it appears in, keyed on its text since Pinecone hits carry no
+# local row id. When BM25 alone is decisive -- its k-th best score reaches
+# `lexical_min_score` and is at least `lexical_margin` times the next one, e.g.
+# a query naming a drug only a few chunks mention -- the vector search is
+# skipped. Few hits on their own are not enough: a query whose words are all
+# common can still match only a handful of short chunks weakly. With a reranker the fused
+# list is cut to `fetch_k` instead of `k` and the reranker picks the final k.
+
+import os
+from typing import Any, List
+
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from metrics import RAG_RETRIEVAL_PATHS, timed_stage
+
+LEXICAL_MARGIN = float(os.getenv("LEXICAL_MARGIN", "2.0"))
+# Roughly one rare term (idf ~ 5+) matched; common words alone stay below it
+LEXICAL_MIN_SCORE = float(os.getenv("LEXICAL_MIN_SCORE", "5.0"))
+
+
+def rrf_merge(ranked_lists, k, rrf_k=60):
+    scores = {}
+    docs = {}
+    for ranked in ranked_lists:
+        for rank, doc in enumerate(ranked):
+            key = doc.page_content
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank + 1)
+            docs.setdefault(key, doc)
+    best = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [docs[key] for key in best]
+
+
+class HybridRetriever(BaseRetriever):
+    vector_store: Any
+    lexical: Any = None
+    k: int = 3
+    fetch_k: int = 20
+    rrf_k: int = 60
+    lexical_margin: float = LEXICAL_MARGIN
+    lexical_min_score: float = LEXICAL_MIN_SCORE
+    reranker: Any = None
+
+    def _lexical(self, query):
+        # (documents, decisive) from the BM25 index
+        if self.lexical is None:
+            return [], False
+        rows, scores = self.lexical.search(query, self.fetch_k)
+        docs = [Document(page_content=self.lexical.texts[r], metadata=self.lexical.metadatas[r]) for r in rows]
+        if len(scores) < self.k or scores[self.k - 1] < self.lexical_min_score:
+            return docs, False
+        runner_up = scores[self.k] if len(scores) > self.k else 0.0
+        decisive = scores[self.k - 1] >= self.lexical_margin * runner_up
+        return docs, decisive
+
+    def _vector_k(self, lexical_docs):
+        return self.fetch_k if lexical_docs or self.reranker is not None else self.k
+
+    def _fuse(self, lexical_docs, vector_docs):
+        keep = self.fetch_k if self.reranker is not None else self.k
+        if not lexical_docs:
+            RAG_RETRIEVAL_PATHS.labels("vector").inc()
+            return vector_docs[:keep]
+        RAG_RETRIEVAL_PATHS.labels("hybrid").inc()
+        return rrf_merge([lexical_docs, vector_docs], keep, self.rrf_k)
+
+    def search(self, query, query_vector):
+        # The query vector is computed once by the caller (it also feeds the answer cache)
+        lexical_docs, decisive = self._lexical(query)
+        if decisive:
+            RAG_RETRIEVAL_PATHS.labels("lexical").inc()
+            return lexical_docs[:self.k]
+        vector_docs = self.vector_store.similarity_search_by_vector(query_vector, k=self._vector_k(lexical_docs))
+        docs = self._fuse(lexical_docs, vector_docs)
+        if self.reranker is None:
+            return docs
+        with timed_stage("rerank"):
+            return self.reranker.rerank(query, query_vector, docs, self.k)
+
+    async def asearch(self, query, query_vector):
+        lexical_docs, decisive = self._lexical(query)
+        if decisive:
+            RAG_RETRIEVAL_PATHS.labels("lexical").inc()
+            return lexical_docs[:self.k]
+        vector_docs = await self.vector_store.asimilarity_search_by_vector(query_vector, k=self._vector_k(lexical_docs))
+        docs = self._fuse(lexical_docs, vector_docs)
+        if self.reranker is None:
+            return docs
+        with timed_stage("rerank"):
+            return await self.reranker.arerank(query, query_vector, docs, self.k)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.search(query, self.vector_store.embeddings.embed_query(query))
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return await self.asearch(query, await self.vector_store.embeddings.aembed_query(query))
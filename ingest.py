@@ -0,0 +1,426 @@
+# Document ingestion into the vector store (and the BM25 index).
+#
+#   python ingest.py docs/ [--batch-size 100] [--concurrency 4] [--rate 5] [--workers 4] [--flush-every 5000]
+#
+# Source files (.txt, .md, .pdf) are read one at a time and chunked in a
+# process pool. Chunk ids are content hashes, so a refresh only embeds chunks
+# that are new or changed. Embedding runs in batches with bounded
+# concurrency, a token-bucket rate limit and retries with backoff; vectors
+# are upserted in sized batches. Progress is checkpointed in CHECKPOINT_DIR:
+#   chunks.log   "<chunk id>\t<source>" per upserted chunk, appended per batch
+#                ("<chunk id>\t" marks a chunk deleted from the vector store)
+#   files.json   {path: {"mtime", "size"}} for fully ingested files
+# so an interrupted run resumes where it stopped and untouched files are not
+# even re-read. Chunks that disappear from an edited file, and all chunks of
+# a file removed from under one of the source directories, are deleted from
+# every sink (in one call per sink at the end of the run).
+#
+# Local sinks (the BM25 index, and the local vector store with --local) are
+# held in memory and saved every `flush_every` chunks and at the end; their
+# chunks are checkpointed only once saved. A running backend keeps serving
+# the index files it loaded -- restart it to pick up an ingest.
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from rate_limit import AsyncTokenBucket
+
+logger = logging.getLogger(__name__)
+
+SOURCE_EXTENSIONS = (".txt", ".md", ".pdf")
+CHUNK_SIZE = int(os.getenv("INGEST_CHUNK_SIZE", "1000"))
+CHUNK_OVERLAP = int(os.getenv("INGEST_CHUNK_OVERLAP", "200"))
+
+
+# ---------------------------------------------------------------- reading
+
+def iter_source_files(root):
+    if os.path.isfile(root):
+        yield root
+        return
+    for directory, _, files in os.walk(root):
+        for name in sorted(files):
+            if name.lower().endswith(SOURCE_EXTENSIONS):
+                yield os.path.join(directory, name)
+
+
+def iter_documents(path):
+    # (text, metadata) per page for PDFs, per file otherwise
+    if path.lower().endswith(".pdf"):
+        from pypdf import PdfReader
+
+        for page_number, page in enumerate(PdfReader(path).pages, 1):
+            text = page.extract_text() or ""
+            if text.strip():
+                yield text, {"source": path, "page": page_number}
+    else:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            yield f.read(), {"source": path}
+
+
+def chunk_id(source, text):
+    # Whitespace-insensitive content hash; the source is included so a chunk
+    # shared by two files is owned (and deleted) by each separately
+    normalized = " ".join(text.split())
+    return hashlib.sha256(f"{source}\0{normalized}".encode("utf-8")).hexdigest()[:32]
+
+
+def chunk_document(document, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    # Runs in a worker process: [(id, text, metadata)]
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    text, metadata = document
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return [(chunk_id(metadata["source"], chunk), chunk, dict(metadata)) for chunk in splitter.split_text(text)]
+
+
+# ------------------------------------------------------------- checkpoint
+
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.chunks = {}  # chunk id -> source
+        self.files = {}
+        log_path = os.path.join(path, "chunks.log")
+        if os.path.exists(log_path):
+            with open(log_path) as f:
+                for line in f:
+                    chunk, _, source = line.rstrip("\n").partition("\t")
+                    if source:
+                        self.chunks[chunk] = source
+                    else:
+                        self.chunks.pop(chunk, None)
+        files_path = os.path.join(path, "files.json")
+        if os.path.exists(files_path):
+            with open(files_path) as f:
+                self.files = json.load(f)
+        self._log = open(log_path, "a")
+
+    @staticmethod
+    def signature(path):
+        stat = os.stat(path)
+        return {"mtime": stat.st_mtime, "size": stat.st_size}
+
+    def file_done(self, path):
+        return self.files.get(path) == self.signature(path)
+
+    def record_chunks(self, ids, sources):
+        self._log.writelines(f"{i}\t{s}\n" for i, s in zip(ids, sources))
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        self.chunks.update(zip(ids, sources))
+
+    def forget_chunks(self, ids):
+        self.record_chunks(ids, [""] * len(ids))
+        for i in ids:
+            self.chunks.pop(i, None)
+
+    def chunks_by_source(self):
+        by_source = {}
+        for chunk, source in self.chunks.items():
+            by_source.setdefault(source, set()).add(chunk)
+        return by_source
+
+    def record_files(self, paths, removed=()):
+        for path in paths:
+            self.files[path] = self.signature(path)
+        for path in removed:
+            self.files.pop(path, None)
+        tmp = os.path.join(self.path, "files.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.files, f)
+        os.replace(tmp, os.path.join(self.path, "files.json"))
+
+    def close(self):
+        self._log.close()
+
+
+# ------------------------------------------------------------------ sinks
+
+class PineconeSink:
+    durable = True  # an upsert is stored once it returns
+
+    def __init__(self, index, text_key="text"):
+        self.index = index
+        self.text_key = text_key
+
+    def upsert(self, ids, vectors, texts, metadatas):
+        self.index.upsert(vectors=[
+            {"id": i, "values": list(map(float, v)), "metadata": {**m, self.text_key: t}}
+            for i, v, t, m in zip(ids, vectors, texts, metadatas)
+        ])
+
+    def delete(self, ids):
+        self.index.delete(ids=list(ids))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class LocalSink:
+    # LocalVectorStore and/or BM25Index, changed in memory and saved by flush()
+    durable = False
+
+    def __init__(self, vector_store=None, vector_path=None, lexical=None, lexical_path=None):
+        self.vector_store = vector_store
+        self.vector_path = vector_path
+        self.lexical = lexical
+        self.lexical_path = lexical_path
+        self._lock = threading.Lock()  # upserts arrive from several worker threads
+        self._dirty = False
+
+    def upsert(self, ids, vectors, texts, metadatas):
+        with self._lock:
+            if self.vector_store is not None:
+                self.vector_store.add_vectors(vectors, texts, metadatas)
+            if self.lexical is not None:
+                self.lexical.add_texts(texts, metadatas)
+            self._dirty = True
+
+    def delete(self, ids):
+        # Rows carry no id; it is recomputed from the source and text
+        ids = set(ids)
+        with self._lock:
+            for target in (self.vector_store, self.lexical):
+                if target is None:
+                    continue
+                rows = [row for row, (text, metadata) in enumerate(zip(target.texts, target.metadatas))
+                        if chunk_id(metadata.get("source", ""), text) in ids]
+                if rows:
+                    target.delete_rows(rows)
+                    self._dirty = True
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            if self.vector_store is not None and self.vector_path:
+                self.vector_store.save(self.vector_path)
+            if self.lexical is not None and self.lexical_path:
+                self.lexical.save(self.lexical_path)
+            self._dirty = False
+
+    def close(self):
+        self.flush()
+
+
+# --------------------------------------------------------------- pipeline
+
+def under_roots(path, roots):
+    return any(path == root or path.startswith(root.rstrip(os.sep) + os.sep) for root in roots)
+
+
+async def with_retries(call, retries=5, backoff=0.5):
+    for attempt in range(retries + 1):
+        try:
+            return await call()
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+            logger.warning("attempt %d failed (%s), retrying in %.1fs", attempt + 1, e, delay)
+            await asyncio.sleep(delay)
+
+
+async def ingest(paths, embeddings, sinks, checkpoint, batch_size=100, upsert_batch_size=100,
+                 concurrency=4, rate=5.0, workers=None, retries=5, flush_every=5000, roots=(), on_change=None):
+    # Returns counters for the run; `on_change` is called once if anything was upserted or deleted.
+    # `roots` are the files / directories `paths` was listed from: checkpointed
+    # sources under them that are no longer in `paths` were removed from disk.
+    stats = {"files": 0, "files_skipped": 0, "documents": 0, "chunks": 0, "chunks_skipped": 0,
+             "embedded": 0, "deleted": 0, "failed": 0}
+    start = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(concurrency)
+    limiter = AsyncTokenBucket(rate)
+    tasks = set()
+    queued = set()  # chunk ids already in a batch during this run
+    seen = {}  # source -> chunk ids it produced in this run
+    failed_sources = set()
+    durable = all(sink.durable for sink in sinks)
+    unsaved = []  # (chunk id, source) upserted into a sink that has not saved it yet
+
+    def record(chunks):
+        if chunks:
+            checkpoint.record_chunks([c[0] for c in chunks], [c[1] for c in chunks])
+
+    async def flush():
+        # Everything upserted before the sinks save is covered by the save
+        saved = list(unsaved)
+        unsaved.clear()
+        for sink in sinks:
+            await asyncio.to_thread(sink.flush)
+        record(saved)
+
+    async def process(batch):
+        ids = [c[0] for c in batch]
+        texts = [c[1] for c in batch]
+        metadatas = [c[2] for c in batch]
+        try:
+            async def embed():
+                await limiter.acquire()
+                return await embeddings.aembed_documents(texts)
+
+            vectors = await with_retries(embed, retries)
+            for start_row in range(0, len(batch), upsert_batch_size):
+                end_row = start_row + upsert_batch_size
+                for sink in sinks:
+                    await with_retries(lambda: asyncio.to_thread(
+                        sink.upsert, ids[start_row:end_row], vectors[start_row:end_row],
+                        texts[start_row:end_row], metadatas[start_row:end_row]), retries)
+            sources = [m["source"] for m in metadatas]
+            if durable:
+                checkpoint.record_chunks(ids, sources)
+            else:
+                unsaved.extend(zip(ids, sources))
+            stats["embedded"] += len(batch)
+        except Exception as e:
+            logger.error("batch of %d chunks failed: %s", len(batch), e)
+            stats["failed"] += len(batch)
+            failed_sources.update(m["source"] for m in metadatas)
+        finally:
+            slots.release()
+
+    async def submit(batch):
+        # Backpressure: at most `concurrency` batches in flight
+        await slots.acquire()
+        if len(unsaved) >= flush_every:
+            await flush()
+        task = asyncio.create_task(process(batch))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    pending = []
+
+    async def collect(chunks):
+        nonlocal pending
+        for chunk in chunks:
+            stats["chunks"] += 1
+            seen.setdefault(chunk[2]["source"], set()).add(chunk[0])
+            if chunk[0] in checkpoint.chunks or chunk[0] in queued:
+                stats["chunks_skipped"] += 1
+                continue
+            queued.add(chunk[0])
+            pending.append(chunk)
+            if len(pending) >= batch_size:
+                await submit(pending)
+                pending = []
+
+    files = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Documents stream through the pool with a bounded window, so reading,
+        # chunking and embedding overlap without loading the corpus
+        window = deque()
+        window_size = 2 * (workers or os.cpu_count() or 1)
+        for path in paths:
+            if checkpoint.file_done(path):
+                stats["files_skipped"] += 1
+                continue
+            stats["files"] += 1
+            files.append(path)
+
+            for document in iter_documents(path):
+                stats["documents"] += 1
+                window.append(loop.run_in_executor(pool, chunk_document, document))
+                if len(window) >= window_size:
+                    await collect(await window.popleft())
+        while window:
+            await collect(await window.popleft())
+
+        if pending:
+            await submit(pending)
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    completed = [p for p in files if p not in failed_sources]
+    by_source = checkpoint.chunks_by_source()
+    listed = set(paths)
+    removed = [source for source in set(by_source) | set(checkpoint.files)
+               if source not in listed and under_roots(source, roots)]
+    deleted = set()
+    for path in completed:
+        deleted |= by_source.get(path, set()) - seen.get(path, set())
+    for path in removed:
+        deleted |= by_source.get(path, set())
+    if deleted:
+        # One call per sink: LocalSink.delete scans every row however many ids it gets
+        for sink in sinks:
+            await with_retries(lambda: asyncio.to_thread(sink.delete, deleted), retries)
+        stats["deleted"] += len(deleted)
+
+    # The checkpoint only moves forward once every sink has saved
+    for sink in sinks:
+        await asyncio.to_thread(sink.close)
+    record(unsaved)
+    if deleted:
+        checkpoint.forget_chunks(list(deleted))
+    checkpoint.record_files(completed, removed)
+    if (stats["embedded"] or stats["deleted"]) and on_change is not None:
+        on_change()
+
+    stats["seconds"] = round(time.perf_counter() - start, 3)
+    stats["docs_per_second"] = round(stats["documents"] / stats["seconds"], 1) if stats["seconds"] else 0.0
+    return stats
+
+
+if __name__ == "__main__":
+    import argparse
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sources", nargs="+", help="files or directories")
+    parser.add_argument("--checkpoint", default=os.getenv("INGEST_CHECKPOINT_DIR", ".ingest_checkpoint"))
+    parser.add_argument("--batch-size", type=int, default=100, help="chunks per embedding call")
+    parser.add_argument("--upsert-batch-size", type=int, default=100, help="vectors per upsert request")
+    parser.add_argument("--concurrency", type=int, default=4, help="embedding batches in flight")
+    parser.add_argument("--rate", type=float, default=5.0, help="embedding calls per second")
+    parser.add_argument("--workers", type=int, default=None, help="chunking processes")
+    parser.add_argument("--flush-every", type=int, default=5000, help="chunks between saves of local indexes")
+    parser.add_argument("--local", action="store_true", help="write LOCAL_INDEX_DIR instead of Pinecone")
+    parser.add_argument("--backend", default=None, help="FastAPI base URL whose answer cache to invalidate")
+    args = parser.parse_args()
+
+    import rag_model
+    from lexical_index import BM25Index
+    from local_index import LocalVectorStore
+
+    embeddings = rag_model.create_embedding_model()
+    lexical_path = rag_model.lexical_index_dir
+    lexical = BM25Index.load(lexical_path) if os.path.isdir(lexical_path) else BM25Index()
+    if args.local:
+        path = rag_model.local_index_dir
+        store = (LocalVectorStore.load(path, embeddings) if os.path.isdir(path)
+                 else LocalVectorStore(embeddings, rag_model.dimension))
+        # Loaded vectors are memory-mapped read-only; appending copies them
+        sinks = [LocalSink(store, path, lexical, lexical_path)]
+    else:
+        sinks = [PineconeSink(rag_model.create_pinecone_index()), LocalSink(lexical=lexical, lexical_path=lexical_path)]
+
+    def invalidate():
+        if args.backend:
+            from backend_client import BackendClient
+            BackendClient(args.backend).post("/cache/invalidate", name="default")
+
+    paths = [p for source in args.sources for p in iter_source_files(source)]
+    checkpoint = Checkpoint(args.checkpoint)
+    try:
+        stats = asyncio.run(ingest(paths, embeddings, sinks, checkpoint, args.batch_size, args.upsert_batch_size,
+                                   args.concurrency, args.rate, args.workers, flush_every=args.flush_every,
+                                   roots=args.sources, on_change=invalidate))
+    finally:
+        checkpoint.close()
+    print(json.dumps(stats, indent=2))
@@ -0,0 +1,235 @@
+# Local BM25 inverted index over the same chunks as the vector index.
+#
+# Exact drug names, ICD-style codes and acronyms are matched by their tokens,
+# which dense embeddings handle poorly. Chunks can be added at any time: new
+# postings go to per-term delta lists that are searched together with the
+# persisted arrays and folded into them on the next save().
+#
+# On disk an index is a directory of compact arrays (postings in CSR layout,
+# memory-mapped at load):
+#   meta.json          document count, vocabulary size, BM25 parameters
+#   vocab.txt          one term per line, line number = term id
+#   offsets.i64        V+1 offsets into the postings arrays
+#   postings_docs.i32  document rows, grouped by term
+#   postings_tfs.u16   term frequencies, parallel to postings_docs
+#   doc_lens.i32       tokens per document
+#   docs.jsonl         one {"text", "metadata"} object per row
+# Files are replaced by rename (see local_index.write_atomic), so a process
+# serving the old index keeps it until it reloads.
+
+import json
+import math
+import os
+import re
+from collections import Counter
+
+import numpy as np
+
+from context_builder import STOPWORDS
+from local_index import top_k, write_atomic
+
+# Keeps "e11.9", "covid-19" and "h1n1" as single tokens
+_TOKEN = re.compile(r"[a-z0-9]+(?:[-.][a-z0-9]+)*")
+
+
+def tokenize(text):
+    return [t for t in _TOKEN.findall(text.lower()) if t not in STOPWORDS]
+
+
+class BM25Index:
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.terms = []
+        self.vocab = {}
+        self.texts = []
+        self.metadatas = []
+        self.doc_lens = np.empty(0, dtype=np.int32)
+        self.total_length = 0
+
+        # Persisted postings (CSR) and postings added since the last save
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.postings_docs = np.empty(0, dtype=np.int32)
+        self.postings_tfs = np.empty(0, dtype=np.uint16)
+        self.delta = {}  # term id -> ([rows], [tfs])
+
+    def __len__(self):
+        return len(self.texts)
+
+    # ------------------------------------------------------------------ build
+
+    def add_texts(self, texts, metadatas=None):
+        texts = list(texts)
+        metadatas = list(metadatas) if metadatas else [{} for _ in texts]
+        start = len(self.texts)
+        lengths = []
+        for row, text in enumerate(texts, start):
+            tokens = tokenize(text)
+            lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                term_id = self.vocab.get(term)
+                if term_id is None:
+                    term_id = self.vocab[term] = len(self.terms)
+                    self.terms.append(term)
+                rows, tfs = self.delta.setdefault(term_id, ([], []))
+                rows.append(row)
+                tfs.append(min(tf, 65535))
+
+        self.texts.extend(texts)
+        self.metadatas.extend(metadatas)
+        self.doc_lens = np.concatenate([self.doc_lens, np.asarray(lengths, dtype=np.int32)])
+        self.total_length += sum(lengths)
+
+    def delete_rows(self, rows):
+        # Drops the rows' postings and renumbers the rest (later rows shift down)
+        keep = np.ones(len(self.texts), dtype=bool)
+        keep[np.asarray(rows, dtype=np.int64)] = False
+        new_rows = np.cumsum(keep) - 1
+        offsets, docs, tfs = self._merged()
+        alive = keep[docs]
+        terms = np.repeat(np.arange(len(self.terms)), np.diff(offsets))[alive]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(terms, minlength=len(self.terms)))]).astype(np.int64)
+        self.postings_docs = new_rows[docs[alive]].astype(np.int32)
+        self.postings_tfs = tfs[alive]
+        self.delta = {}
+
+        self.total_length -= int(self.doc_lens[~keep].sum())
+        self.doc_lens = self.doc_lens[keep]
+        self.texts = [t for t, kept in zip(self.texts, keep) if kept]
+        self.metadatas = [m for m, kept in zip(self.metadatas, keep) if kept]
+
+    @classmethod
+    def from_texts(cls, texts, metadatas=None, **kwargs):
+        index = cls(**kwargs)
+        index.add_texts(texts, metadatas)
+        return index
+
+    @classmethod
+    def from_pinecone(cls, index, text_key="text", batch_size=100, **kwargs):
+        # Same chunks as the Pinecone index, read from its text metadata
+        lexical = cls(**kwargs)
+        for ids in index.list():
+            for start in range(0, len(ids), batch_size):
+                fetched = index.fetch(ids=ids[start:start + batch_size]).vectors
+                texts, metadatas = [], []
+                for vector in fetched.values():
+                    metadata = dict(vector.metadata or {})
+                    texts.append(metadata.pop(text_key, ""))
+                    metadatas.append(metadata)
+                lexical.add_texts(texts, metadatas)
+        return lexical
+
+    # ----------------------------------------------------------------- search
+
+    def postings(self, term_id):
+        rows = tfs = None
+        if term_id + 1 < len(self.offsets):
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            rows, tfs = self.postings_docs[start:end], self.postings_tfs[start:end]
+        extra = self.delta.get(term_id)
+        if extra is None:
+            return rows, tfs
+        extra_rows, extra_tfs = np.asarray(extra[0], dtype=np.int32), np.asarray(extra[1], dtype=np.uint16)
+        if rows is None:
+            return extra_rows, extra_tfs
+        return np.concatenate([rows, extra_rows]), np.concatenate([tfs, extra_tfs])
+
+    def search(self, query, k=4):
+        # Returns (row indices, BM25 scores), best first; rows without any
+        # query term are never returned
+        n = len(self.texts)
+        if n == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        avgdl = self.total_length / n or 1.0
+        scores = np.zeros(n, dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.vocab.get(term)
+            if term_id is None:
+                continue
+            rows, tfs = self.postings(term_id)
+            if rows is None or not len(rows):
+                continue
+            idf = math.log(1 + (n - len(rows) + 0.5) / (len(rows) + 0.5))
+            tfs = tfs.astype(np.float32)
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lens[rows] / avgdl)
+            scores[rows] += idf * tfs * (self.k1 + 1) / (tfs + norm)
+
+        best = top_k(scores, k)
+        best = best[scores[best] > 0]
+        return best, scores[best]
+
+    # ------------------------------------------------------------ persistence
+
+    def _merged(self):
+        offsets = [0]
+        docs, tfs = [], []
+        for term_id in range(len(self.terms)):
+            rows, freqs = self.postings(term_id)
+            if rows is None:
+                rows, freqs = np.empty(0, dtype=np.int32), np.empty(0, dtype=np.uint16)
+            docs.append(rows)
+            tfs.append(freqs)
+            offsets.append(offsets[-1] + len(rows))
+        return (np.asarray(offsets, dtype=np.int64),
+                np.concatenate(docs).astype(np.int32) if docs else np.empty(0, dtype=np.int32),
+                np.concatenate(tfs).astype(np.uint16) if tfs else np.empty(0, dtype=np.uint16))
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.offsets, self.postings_docs, self.postings_tfs = self._merged()
+        self.delta = {}
+
+        write_atomic(os.path.join(path, "offsets.i64"), self.offsets.tofile)
+        write_atomic(os.path.join(path, "postings_docs.i32"), self.postings_docs.tofile)
+        write_atomic(os.path.join(path, "postings_tfs.u16"), self.postings_tfs.tofile)
+        write_atomic(os.path.join(path, "doc_lens.i32"), np.ascontiguousarray(self.doc_lens, dtype=np.int32).tofile)
+        write_atomic(os.path.join(path, "vocab.txt"), lambda f: f.writelines(term + "\n" for term in self.terms), "w")
+        write_atomic(os.path.join(path, "docs.jsonl"), lambda f: f.writelines(
+            json.dumps({"text": text, "metadata": metadata}) + "\n"
+            for text, metadata in zip(self.texts, self.metadatas)
+        ), "w")
+
+        meta = {"count": len(self.texts), "vocab_size": len(self.terms), "total_length": self.total_length,
+                "k1": self.k1, "b": self.b}
+        write_atomic(os.path.join(path, "meta.json"), lambda f: json.dump(meta, f), "w")
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+
+        index = cls(k1=meta["k1"], b=meta["b"])
+        with open(os.path.join(path, "vocab.txt")) as f:
+            index.terms = [line.rstrip("\n") for line in f]
+        index.vocab = {term: i for i, term in enumerate(index.terms)}
+        with open(os.path.join(path, "docs.jsonl")) as f:
+            for line in f:
+                doc = json.loads(line)
+                index.texts.append(doc["text"])
+                index.metadatas.append(doc["metadata"])
+
+        index.total_length = meta["total_length"]
+        index.doc_lens = np.fromfile(os.path.join(path, "doc_lens.i32"), dtype=np.int32)
+        index.offsets = np.fromfile(os.path.join(path, "offsets.i64"), dtype=np.int64)
+        if len(index.offsets) > 1 and index.offsets[-1]:
+            index.postings_docs = np.memmap(os.path.join(path, "postings_docs.i32"), dtype=np.int32, mode="r")
+            index.postings_tfs = np.memmap(os.path.join(path, "postings_tfs.u16"), dtype=np.uint16, mode="r")
+        return index
+
+
+if __name__ == "__main__":
+    # Build the BM25 index from the chunks stored in Pinecone:
+    #   python lexical_index.py [output dir] [index name]
+    import sys
+    from dotenv import load_dotenv
+    from pinecone import Pinecone
+
+    load_dotenv()
+    output = sys.argv[1] if len(sys.argv) > 1 else "lexical_index"
+    index_name = sys.argv[2] if len(sys.argv) > 2 else "rag-index3"
+
+    index = Pinecone(api_key=os.getenv("PINECONE_API_KEY")).Index(index_name)
+    lexical = BM25Index.from_pinecone(index)
+    lexical.save(output)
+    print(f"Indexed {len(lexical)} chunks ({len(lexical.terms)} terms) into {output}")
@@ -0,0 +1,256 @@
+# Local, in-process vector store usable instead of Pinecone (RETRIEVER_BACKEND=local).
+#
+# Vectors are stored unit-normalized in a float32 matrix, so cosine similarity
+# is a single matrix-vector product. Small corpora are searched exactly; once
+# the corpus reaches `ivf_threshold` rows an IVF index (spherical k-means
+# centroids + inverted lists) restricts the scan to the `nprobe` closest lists.
+#
+# On disk a store is a directory of raw arrays that are memory-mapped at load:
+#   meta.json      dimension, row counts, IVF parameters
+#   vectors.f32    N x D unit vectors
+#   docs.jsonl     one {"text", "metadata"} object per row
+#   centroids.f32, ivf_rows.i64, ivf_offsets.i64   (only when IVF is built)
+# save() writes each file next to its target and renames it into place, so a
+# process that has the old files memory-mapped keeps reading the old version
+# (until it reloads) instead of a half-written one.
+
+import json
+import math
+import os
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+
+def normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def write_atomic(path, write, mode="wb"):
+    # write(f) to a temporary file that then replaces `path`
+    tmp = path + ".tmp"
+    with open(tmp, mode) as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+def top_k(scores, k):
+    # Indices of the k largest scores, best first
+    k = min(k, len(scores))
+    if k == 0:
+        return np.empty(0, dtype=np.int64)
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx])]
+
+
+class LocalVectorStore(VectorStore):
+    def __init__(self, embedding, dimension, vectors=None, texts=None, metadatas=None,
+                 ivf_threshold=50000, nprobe=8):
+        self.embedding = embedding
+        self.dimension = dimension
+        self.vectors = vectors if vectors is not None else np.empty((0, dimension), dtype=np.float32)
+        self.texts = texts or []
+        self.metadatas = metadatas or []
+        self.ivf_threshold = ivf_threshold
+        self.nprobe = nprobe
+
+        # IVF state; rows >= ivf_rows were added after training and are always scanned
+        self.centroids = None
+        self.list_rows = None
+        self.list_offsets = None
+        self.ivf_rows = 0
+
+    @property
+    def embeddings(self):
+        return self.embedding
+
+    def __len__(self):
+        return len(self.texts)
+
+    # ------------------------------------------------------------------ build
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        metadatas = list(metadatas) if metadatas else [{} for _ in texts]
+        start = len(self.texts)
+        self.add_vectors(self.embedding.embed_documents(texts), texts, metadatas)
+        return ids or [str(i) for i in range(start, start + len(texts))]
+
+    def add_vectors(self, vectors, texts, metadatas):
+        self.vectors = np.vstack([self.vectors, normalize_rows(vectors)])
+        self.texts.extend(texts)
+        self.metadatas.extend(metadatas)
+
+    def delete_rows(self, rows):
+        # Later rows shift down; the IVF index is dropped and rebuilt by save()
+        keep = np.ones(len(self.texts), dtype=bool)
+        keep[np.asarray(rows, dtype=np.int64)] = False
+        self.vectors = np.asarray(self.vectors)[keep]
+        self.texts = [t for t, kept in zip(self.texts, keep) if kept]
+        self.metadatas = [m for m, kept in zip(self.metadatas, keep) if kept]
+        self.centroids = self.list_rows = self.list_offsets = None
+        self.ivf_rows = 0
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        texts = list(texts)
+        vectors = embedding.embed_documents(texts)
+        store = cls(embedding, dimension=len(vectors[0]), **kwargs)
+        store.add_vectors(vectors, texts, list(metadatas) if metadatas else [{} for _ in texts])
+        return store
+
+    @classmethod
+    def from_pinecone(cls, index, embedding, dimension, text_key="text", batch_size=100, **kwargs):
+        # Copy an existing Pinecone index (vectors + text metadata) into a local store
+        store = cls(embedding, dimension=dimension, **kwargs)
+        for ids in index.list():
+            for start in range(0, len(ids), batch_size):
+                fetched = index.fetch(ids=ids[start:start + batch_size]).vectors
+                vectors, texts, metadatas = [], [], []
+                for vector in fetched.values():
+                    metadata = dict(vector.metadata or {})
+                    texts.append(metadata.pop(text_key, ""))
+                    metadatas.append(metadata)
+                    vectors.append(vector.values)
+                if vectors:
+                    store.add_vectors(vectors, texts, metadatas)
+        return store
+
+    def build_ivf(self, nlist=None, iterations=10, seed=0):
+        n = len(self.vectors)
+        if n == 0:
+            return
+
+        nlist = min(n, nlist or max(1, int(4 * math.sqrt(n))))
+        rng = np.random.default_rng(seed)
+
+        # Spherical k-means on a sample (vectors are unit length, so argmax of dot = nearest)
+        sample = np.asarray(self.vectors[np.sort(rng.choice(n, min(n, nlist * 64), replace=False))])
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            filled = np.bincount(assign, minlength=nlist) > 0
+            centroids[filled] = normalize_rows(sums[filled])
+
+        assign = np.concatenate([
+            np.argmax(self.vectors[i:i + 65536] @ centroids.T, axis=1)
+            for i in range(0, n, 65536)
+        ])
+
+        self.centroids = centroids
+        self.list_rows = np.argsort(assign, kind="stable").astype(np.int64)
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))]).astype(np.int64)
+        self.ivf_rows = n
+
+    # ----------------------------------------------------------------- search
+
+    def search(self, query_vector, k=4):
+        # Returns (row indices, cosine scores), best first
+        query = normalize_rows(query_vector)
+        if self.centroids is not None and len(self.vectors) >= self.ivf_threshold:
+            candidates = self._ivf_candidates(query)
+            scores = self.vectors[candidates] @ query
+            best = top_k(scores, k)
+            return candidates[best], scores[best]
+
+        scores = self.vectors @ query
+        best = top_k(scores, k)
+        return best, scores[best]
+
+    def _ivf_candidates(self, query):
+        probes = top_k(self.centroids @ query, self.nprobe)
+        parts = [self.list_rows[self.list_offsets[c]:self.list_offsets[c + 1]] for c in probes]
+        parts.append(np.arange(self.ivf_rows, len(self.vectors)))
+        # Sorted rows keep memmap reads sequential
+        return np.sort(np.concatenate(parts))
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, **kwargs):
+        rows, scores = self.search(embedding, k)
+        return [
+            (Document(page_content=self.texts[row], metadata=self.metadatas[row]), float(score))
+            for row, score in zip(rows, scores)
+        ]
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k)]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_with_score_by_vector(self.embedding.embed_query(query), k)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector(self.embedding.embed_query(query), k)
+
+    def _select_relevance_score_fn(self):
+        return lambda score: (score + 1) / 2
+
+    # ------------------------------------------------------------ persistence
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        if len(self.vectors) >= self.ivf_threshold and self.ivf_rows != len(self.vectors):
+            self.build_ivf()
+
+        # The arrays may be memory-mapped from the files being replaced
+        write_atomic(os.path.join(path, "vectors.f32"), np.ascontiguousarray(self.vectors, dtype=np.float32).tofile)
+        write_atomic(os.path.join(path, "docs.jsonl"), lambda f: f.writelines(
+            json.dumps({"text": text, "metadata": metadata}) + "\n"
+            for text, metadata in zip(self.texts, self.metadatas)
+        ), "w")
+
+        meta = {"dimension": self.dimension, "count": len(self.texts), "ivf_rows": 0}
+        if self.centroids is not None:
+            write_atomic(os.path.join(path, "centroids.f32"), self.centroids.tofile)
+            write_atomic(os.path.join(path, "ivf_rows.i64"), np.asarray(self.list_rows).tofile)
+            write_atomic(os.path.join(path, "ivf_offsets.i64"), self.list_offsets.tofile)
+            meta.update(ivf_rows=self.ivf_rows, nlist=len(self.centroids))
+
+        # Written last: it holds the row count the other files are read with
+        write_atomic(os.path.join(path, "meta.json"), lambda f: json.dump(meta, f), "w")
+
+    @classmethod
+    def load(cls, path, embedding, **kwargs):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+
+        dimension, count = meta["dimension"], meta["count"]
+        vectors = np.memmap(os.path.join(path, "vectors.f32"), dtype=np.float32, mode="r",
+                            shape=(count, dimension)) if count else None
+
+        texts, metadatas = [], []
+        with open(os.path.join(path, "docs.jsonl")) as f:
+            for line in f:
+                doc = json.loads(line)
+                texts.append(doc["text"])
+                metadatas.append(doc["metadata"])
+
+        store = cls(embedding, dimension, vectors=vectors, texts=texts, metadatas=metadatas, **kwargs)
+        if meta.get("ivf_rows"):
+            store.centroids = np.fromfile(os.path.join(path, "centroids.f32"), dtype=np.float32).reshape(meta["nlist"], dimension)
+            store.list_rows = np.memmap(os.path.join(path, "ivf_rows.i64"), dtype=np.int64, mode="r")
+            store.list_offsets = np.fromfile(os.path.join(path, "ivf_offsets.i64"), dtype=np.int64)
+            store.ivf_rows = meta["ivf_rows"]
+        return store
+
+
+if __name__ == "__main__":
+    # Snapshot the Pinecone index into a local store:
+    #   python local_index.py [output dir] [index name] [dimension]
+    import sys
+    from dotenv import load_dotenv
+    from pinecone import Pinecone
+
+    load_dotenv()
+    output = sys.argv[1] if len(sys.argv) > 1 else "local_index"
+    index_name = sys.argv[2] if len(sys.argv) > 2 else "rag-index3"
+    dimension = int(sys.argv[3]) if len(sys.argv) > 3 else 768
+
+    index = Pinecone(api_key=os.getenv("PINECONE_API_KEY")).Index(index_name)
+    store = LocalVectorStore.from_pinecone(index, None, dimension)
+    store.save(output)
+    print(f"Saved {len(store)} vectors to {output}")
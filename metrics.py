@@ -0,0 +1,173 @@
+# Prometheus metrics and per-request tracing for the FastAPI backend.
+#
+# Every request gets a trace id (taken from the X-Trace-Id header sent by the
+# Flask frontend, or generated here). Pipeline stages timed with
+# timed_stage() feed the rag_stage_seconds histogram and are also collected
+# per request: they are logged with the trace id and returned in a
+# Server-Timing header. Mongo command latencies come from a pymongo command
+# listener attached to the clients in mongo_db.py.
+#
+# Under gunicorn with several workers PROMETHEUS_MULTIPROC_DIR must be set
+# (start.sh does it): every worker writes its samples there and /metrics
+# aggregates all of them, whichever worker serves the scrape.
+
+import logging
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+TRACE_HEADER = "x-trace-id"
+
+trace_id_var = ContextVar("trace_id", default=None)
+stage_timings_var = ContextVar("stage_timings", default=None)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_seconds", "HTTP request latency", ["method", "route", "status"],
+)
+RAG_STAGE_SECONDS = Histogram(
+    "rag_stage_seconds", "Time spent in each RAG pipeline stage", ["stage"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+RAG_TOKENS = Counter("rag_tokens_total", "LLM tokens reported by the provider", ["kind"])
+RAG_CONTEXT_CHARS = Histogram(
+    "rag_context_chars", "Characters of retrieved context stuffed into the prompt",
+    buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000),
+)
+RAG_CONTEXT_TOKENS = Histogram(
+    "rag_context_tokens", "Estimated context tokens before and after compression", ["stage"],
+    buckets=(50, 100, 200, 400, 800, 1600, 3200, 6400, 12800),
+)
+RAG_RETRIEVED_DOCS = Histogram("rag_retrieved_docs", "Chunks retrieved per question", buckets=(0, 1, 2, 3, 5, 10, 20, 50))
+RAG_CACHE_LOOKUPS = Counter("rag_cache_lookups_total", "Answer cache lookups", ["result"])
+RAG_RETRIEVAL_PATHS = Counter("rag_retrieval_paths_total", "Retrievals by path (lexical fast path, hybrid, vector)", ["path"])
+RAG_ROUTED = Counter("rag_routed_total", "Questions answered by the query router", ["intent"])
+RAG_AVOIDED_CALLS = Counter("rag_avoided_calls_total", "Upstream calls skipped because the router answered", ["call"])
+SINGLE_FLIGHT_CALLS = Counter(
+    "single_flight_calls_total", "Calls that ran the work (leader) or joined an identical in-flight call (coalesced)",
+    ["group", "role"],
+)
+UPSTREAM_CALLS = Counter(
+    "upstream_calls_total", "Calls to upstream providers by outcome (ok, throttled, timeout, error, rejected, "
+    "deadline, unavailable)", ["upstream", "model", "outcome"],
+)
+UPSTREAM_SECONDS = Histogram(
+    "upstream_seconds", "Upstream call latency", ["upstream", "model"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 30),
+)
+UPSTREAM_HEDGES = Counter("upstream_hedges_total", "Hedged requests sent and which attempt won", ["upstream", "result"])
+UPSTREAM_CIRCUIT = Counter("upstream_circuit_total", "Circuit breaker state changes", ["upstream", "model", "state"])
+UPSTREAM_CONCURRENCY = Gauge(
+    "upstream_concurrency_limit", "Current adaptive concurrency limit", ["upstream"], multiprocess_mode="livemax",
+)
+MONGO_COMMAND_SECONDS = Histogram(
+    "mongo_command_seconds", "MongoDB command latency", ["command", "outcome"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+
+
+def observe_stage(stage, seconds):
+    RAG_STAGE_SECONDS.labels(stage).observe(seconds)
+    timings = stage_timings_var.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed_stage(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+def record_usage(message):
+    # Token counts from an AIMessage returned by CustomAPIChatLLM
+    usage = getattr(message, "usage_metadata", None) or {}
+    if usage.get("input_tokens"):
+        RAG_TOKENS.labels("prompt").inc(usage["input_tokens"])
+    if usage.get("output_tokens"):
+        RAG_TOKENS.labels("completion").inc(usage["output_tokens"])
+
+
+def record_context(docs, context, retrieved_tokens, context_tokens):
+    RAG_RETRIEVED_DOCS.observe(len(docs))
+    RAG_CONTEXT_CHARS.observe(len(context))
+    RAG_CONTEXT_TOKENS.labels("retrieved").observe(retrieved_tokens)
+    RAG_CONTEXT_TOKENS.labels("compressed").observe(context_tokens)
+
+
+def record_route(intent, embedded):
+    RAG_ROUTED.labels(intent).inc()
+    if not embedded:
+        RAG_AVOIDED_CALLS.labels("embed").inc()
+    RAG_AVOIDED_CALLS.labels("retrieve").inc()
+    RAG_AVOIDED_CALLS.labels("generate").inc()
+
+
+def metrics_response():
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_COMMAND_SECONDS.labels(event.command_name, "ok").observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        MONGO_COMMAND_SECONDS.labels(event.command_name, "error").observe(event.duration_micros / 1e6)
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware (unlike BaseHTTPMiddleware it does not buffer
+    # streaming responses)
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope.get("headers") or [])
+        trace_id = headers.get(TRACE_HEADER.encode(), b"").decode() or uuid.uuid4().hex
+        trace_token = trace_id_var.set(trace_id)
+        timings = {}
+        timings_token = stage_timings_var.set(timings)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                extra = [(TRACE_HEADER.encode(), trace_id.encode())]
+                if timings:
+                    server_timing = ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+                    extra.append((b"server-timing", server_timing.encode()))
+                message = {**message, "headers": list(message.get("headers", [])) + extra}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.labels(scope["method"], getattr(route, "path", "unmatched"), str(status)).observe(elapsed)
+            if timings:
+                logger.info("trace=%s %s %s %.1fms stages=%s", trace_id, scope["method"], scope["path"], elapsed * 1000,
+                            {stage: round(seconds * 1000, 1) for stage, seconds in timings.items()})
+            trace_id_var.reset(trace_token)
+            stage_timings_var.reset(timings_token)
@@ -0,0 +1,267 @@
+# Incrementally maintained BMI statistics for the dashboards.
+#
+# The `patient_stats` collection holds one counter document per
+# (dimension, value, bmi bin), e.g. {"dim": "city", "value": "Pune", "bin": 22.5}.
+# Create/update/delete apply +1/-1 deltas, so reading a histogram, verdict
+# counts or percentiles touches a few hundred tiny documents instead of the
+# whole patients collection. rebuild_stats() recomputes everything with
+# aggregation pipelines (used after bulk imports or to repair drift).
+#
+# Rebuilds take a lease document in `patient_stats_meta`, so one runs at a
+# time across workers. While it is held, deltas are written to
+# `patient_stats_journal` instead of the live collection (which is about to
+# be replaced) and are applied once the new collection is in place. A change
+# made while the aggregation is scanning may be counted twice; the next
+# rebuild corrects it.
+#
+# Bins are BIN_WIDTH wide and aligned so the verdict cut-offs (18.5, 25, 30)
+# fall on bin edges: verdict counts derived from bins are exact.
+
+import asyncio
+import math
+import time
+import uuid
+
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+import mongo_db
+from mongo_db import STATS_COLLECTION
+
+BIN_WIDTH = 0.5
+REBUILD_LEASE = 600  # seconds before a crashed rebuild's lease can be taken over
+DIMENSIONS = ["all", "city", "gender", "age_band"]
+AGE_BANDS = [(0, 17, "0-17"), (18, 29, "18-29"), (30, 44, "30-44"), (45, 59, "45-59"), (60, 200, "60+")]
+VERDICTS = ["Underweight", "Normal", "Overweight", "Obese"]
+
+
+# Upper (exclusive) BMI bound of each verdict; anything above is "Obese"
+VERDICT_BOUNDS = [(18.5, "Underweight"), (25, "Normal"), (30, "Overweight")]
+
+
+def verdict_for_bmi(bmi):
+    for bound, verdict in VERDICT_BOUNDS:
+        if bmi < bound:
+            return verdict
+    return "Obese"
+
+
+def computed_fields_pipeline():
+    # Update-pipeline stages recomputing bmi / verdict on the server from the
+    # stored height and weight, mirroring Patient.bmi / Patient.verdict
+    return [
+        {"$set": {"bmi": {"$round": [{"$divide": ["$weight", {"$multiply": ["$height", "$height"]}]}, 2]}}},
+        {"$set": {"verdict": {"$switch": {
+            "branches": [{"case": {"$lt": ["$bmi", bound]}, "then": verdict} for bound, verdict in VERDICT_BOUNDS],
+            "default": "Obese",
+        }}}},
+    ]
+
+
+def age_band(age):
+    for low, high, label in AGE_BANDS:
+        if low <= age <= high:
+            return label
+    return "unknown"
+
+
+def bmi_bin(bmi):
+    return math.floor(bmi / BIN_WIDTH) * BIN_WIDTH
+
+
+def dimension_values(doc):
+    return {
+        "all": "all",
+        "city": doc.get("city"),
+        "gender": doc.get("gender"),
+        "age_band": age_band(doc.get("age", 0)),
+    }
+
+
+def _deltas(doc, delta):
+    # [(counter _id, count delta, bmi_sum delta)]; plain data so it can be journaled
+    bmi = doc.get("bmi")
+    if bmi is None:
+        return []
+    return [
+        ({"dim": dim, "value": value, "bin": bmi_bin(bmi)}, delta, delta * bmi)
+        for dim, value in dimension_values(doc).items()
+    ]
+
+
+async def _apply_deltas(deltas):
+    await mongo_db.async_stats_collection.bulk_write([
+        UpdateOne({"_id": key}, {"$inc": {"count": count, "bmi_sum": bmi_sum}}, upsert=True)
+        for key, count, bmi_sum in deltas
+    ], ordered=False)
+
+
+def _meta():
+    return mongo_db.async_stats_collection.database[f"{STATS_COLLECTION}_meta"]
+
+
+def _journal():
+    return mongo_db.async_stats_collection.database[f"{STATS_COLLECTION}_journal"]
+
+
+async def record_patient_change(old=None, new=None):
+    # Apply the difference between the old and new version of a patient
+    # (old=None for a create, new=None for a delete) in one bulk_write.
+    deltas = (_deltas(old, -1) if old else []) + (_deltas(new, 1) if new else [])
+    if not deltas:
+        return
+
+    lease = await _meta().find_one({"_id": "rebuild"})
+    if lease is None:
+        await _apply_deltas(deltas)
+        return
+
+    # A rebuild is running: journal the deltas for it to apply after the swap.
+    # If it finished in the meantime, whoever deletes the entry applies it.
+    entry = {"token": lease["token"], "deltas": [[key, count, bmi_sum] for key, count, bmi_sum in deltas]}
+    await _journal().insert_one(entry)
+    if await _meta().find_one({"_id": "rebuild", "token": lease["token"]}) is None:
+        if await _journal().find_one_and_delete({"_id": entry["_id"]}) is not None:
+            await _apply_deltas(deltas)
+
+
+def _age_band_expression():
+    return {"$switch": {
+        "branches": [
+            {"case": {"$and": [{"$gte": ["$age", low]}, {"$lte": ["$age", high]}]}, "then": label}
+            for low, high, label in AGE_BANDS
+        ],
+        "default": "unknown",
+    }}
+
+
+async def _acquire_rebuild_lease(token, poll=0.5):
+    # Waits for a running rebuild instead of skipping: it may have started
+    # before the changes this caller wants reflected
+    while True:
+        now = time.time()
+        try:
+            await _meta().update_one(
+                {"_id": "rebuild", "expires": {"$lt": now}},
+                {"$set": {"token": token, "expires": now + REBUILD_LEASE}},
+                upsert=True,
+            )
+            return
+        except DuplicateKeyError:
+            await asyncio.sleep(poll)
+
+
+async def _drain_journal(token):
+    while (entry := await _journal().find_one_and_delete({"token": token}, sort=[("_id", 1)])) is not None:
+        await _apply_deltas([(key, count, bmi_sum) for key, count, bmi_sum in entry["deltas"]])
+
+
+async def rebuild_stats():
+    # Full recompute on the server. Each dimension is grouped by its own
+    # pipeline and $merge'd into a staging collection -- a single $facet
+    # would put every group into one document, capped at 16MB -- which is
+    # then renamed over the live one, so readers switch over atomically.
+    token = uuid.uuid4().hex
+    await _acquire_rebuild_lease(token)
+    try:
+        # Left by a rebuild that died holding the lease; the scan below sees those changes
+        await _journal().delete_many({"token": {"$ne": token}})
+        await _rebuild(token)
+    finally:
+        await _meta().delete_one({"_id": "rebuild", "token": token})
+        # On failure this lands on the old collection, which is still live
+        await _drain_journal(token)
+
+
+async def _rebuild(token):
+    stats = mongo_db.async_stats_collection
+    staging_name = f"{STATS_COLLECTION}_rebuild_{token}"
+    staging = stats.database[staging_name]
+    await stats.database.create_collection(staging_name)
+
+    try:
+        await _merge_dimensions(token, staging_name)
+        await staging.rename(STATS_COLLECTION, dropTarget=True)
+    except BaseException:
+        await staging.drop()
+        raise
+
+
+async def _merge_dimensions(token, staging_name):
+    values = {"all": {"$literal": "all"}, "city": "$city", "gender": "$gender", "age_band": "$age_band"}
+    for dim in DIMENSIONS:
+        # Each dimension is one full scan; keep the lease from expiring under us
+        await _meta().update_one({"_id": "rebuild", "token": token}, {"$set": {"expires": time.time() + REBUILD_LEASE}})
+        pipeline = [
+            {"$match": {"bmi": {"$type": "number"}}},
+            {"$project": {
+                "_id": 0, "bmi": 1, "city": 1, "gender": 1,
+                "age_band": _age_band_expression(),
+                "bin": {"$multiply": [{"$floor": {"$divide": ["$bmi", BIN_WIDTH]}}, BIN_WIDTH]},
+            }},
+            {"$group": {
+                "_id": {"dim": dim, "value": values[dim], "bin": "$bin"},
+                "count": {"$sum": 1},
+                "bmi_sum": {"$sum": "$bmi"},
+            }},
+            {"$merge": {"into": staging_name, "whenMatched": "replace", "whenNotMatched": "insert"}},
+        ]
+        async for _ in mongo_db.async_patients_collection.aggregate(pipeline):
+            pass
+
+
+async def _load_bins(dim, value=None):
+    # {group value: [(bin, count, bmi_sum), ...] sorted by bin}
+    query = {"_id.dim": dim, "count": {"$gt": 0}}
+    if value is not None:
+        query["_id.value"] = value
+
+    groups = {}
+    async for doc in mongo_db.async_stats_collection.find(query):
+        groups.setdefault(doc["_id"]["value"], []).append((doc["_id"]["bin"], doc["count"], doc.get("bmi_sum", 0.0)))
+    for bins in groups.values():
+        bins.sort()
+    return groups
+
+
+async def verdict_counts(dim="all", value=None):
+    result = {}
+    for group, bins in (await _load_bins(dim, value)).items():
+        counts = dict.fromkeys(VERDICTS, 0)
+        for bin_start, count, _ in bins:
+            counts[verdict_for_bmi(bin_start)] += count
+        result[group] = counts
+    return result
+
+
+async def bmi_histogram(dim="all", value=None, width=BIN_WIDTH):
+    # Re-bins the stored BIN_WIDTH bins into `width`-wide ones (a multiple of BIN_WIDTH)
+    result = {}
+    for group, bins in (await _load_bins(dim, value)).items():
+        merged = {}
+        for bin_start, count, _ in bins:
+            start = math.floor(round(bin_start / width, 6)) * width
+            merged[start] = merged.get(start, 0) + count
+        result[group] = [{"bin_start": round(start, 2), "bin_end": round(start + width, 2), "count": count}
+                         for start, count in sorted(merged.items())]
+    return result
+
+
+async def bmi_percentiles(dim="all", value=None, percentiles=(25, 50, 75, 90)):
+    # Interpolated within a bin, so accurate to BIN_WIDTH
+    result = {}
+    for group, bins in (await _load_bins(dim, value)).items():
+        total = sum(count for _, count, _ in bins)
+        if not total:
+            continue
+        report = {"count": total, "mean": round(sum(s for _, _, s in bins) / total, 2)}
+        for p in percentiles:
+            target = p / 100 * total
+            seen = 0
+            for bin_start, count, _ in bins:
+                if seen + count >= target:
+                    report[f"p{p:g}"] = round(bin_start + BIN_WIDTH * (target - seen) / count, 2)
+                    break
+                seen += count
+        result[group] = report
+    return result
@@ -1,171 +1,453 @@
-from fastapi import FastAPI, Path, HTTPException, Query
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, Field, computed_field
-from typing import Annotated, Literal, Optional
-import json
-from rag_model import ask_question
-from mongo_db import load_data, patients_collection
-
-app = FastAPI()
-
-class Patient(BaseModel):
-
-    id : Annotated[str, Field(..., description="Id of the patient", examples=["P001"])]
-    name: Annotated[str, Field(..., description="Name of the patient")]
-    city: Annotated[str, Field(..., description="City where the patient is living")]
-    age: Annotated[int, Field(..., gt=0, lt=120, description="Age of the patient")]
-    gender: Annotated[Literal["male", "female", "others"], Field(..., description="Gender of the patient")]
-    height: Annotated[float, Field(..., gt=0, description="height of the patient in meters")]
-    weight: Annotated[float, Field(..., gt=0, description="weight of the patient in kgs")]
-
-    @computed_field()
-    @property
-    def bmi(self) -> float:
-        bmi = round(self.weight/(self.height**2), 2)
-
-        return bmi
-    
-    @computed_field
-    @property
-    def verdict(self) -> str:
-
-        if self.bmi < 18.5:
-            return "Underweight"
-        elif self.bmi < 25:
-            return "Normal"
-        elif self.bmi < 30:
-            return "Overweight"
-        else:
-            return "Obese"
-        
-
-class PatientUpdate(BaseModel):
-    name: Annotated[Optional[str], Field(default=None)]
-    city: Annotated[Optional[str], Field(default=None)]
-    age: Annotated[Optional[int], Field(default=None, gt=0)]
-    gender: Annotated[Optional[Literal['male', 'female', "others"]], Field(default=None)]
-    height: Annotated[Optional[float], Field(default=None, gt=0)]
-    weight: Annotated[Optional[float], Field(default=None, gt=0)]
-
-
-@app.get("/")
-def hello():
-    return {"message" : "Hello World!"}
-
-
-@app.get("/view")
-def view():
-    data = load_data()
-
-    return data
-
-
-@app.get("/health", tags=["System"])
-def health_check():
-    try:
-        data = load_data()  # optional: just to verify file/db access
-        return {"status": "ok", "message": "API is healthy", "patients_count": len(data)}
-    except Exception as e:
-        return JSONResponse(status_code=500, content={
-            "status": "error", 
-            "message": "Something went wrong", 
-            "details": str(e)
-        })
-    
-
-@app.get("/patient/{patient_id}")
-def view_patient(patient_id : str = Path(..., description="ID of the patient in the DB", example="P001")):
-    data = load_data()
-
-    if patient_id in data:
-        return data[patient_id]
-    
-    raise HTTPException(status_code=404, detail="patient not found")
-
-
-@app.get("/sort")
-def sort_patients(sort_by : str = Query(..., description="Sort on the basis on Height, Weight or BMI"),
-                order: str = Query("desc", description="Sort in asc or desc order")):
-    
-    valid_fields = ["height", "weight", "bmi"]
-
-    sort_by = sort_by.lower()
-    order = order.lower()
-
-    if sort_by not in valid_fields:
-        raise HTTPException(status_code=400, detail=f"invalid field select from {valid_fields}")
-    
-    if order not in ["asc", "desc"]:
-        raise HTTPException(status_code=400, detail="invalid order select between asc and desc")
-    
-    data = load_data()
-
-    sort_order = True if order == "desc" else False
-
-    sorted_data = sorted(data.values(), key= lambda x: x.get(sort_by, 0), reverse=sort_order)
-
-    return sorted_data
-
-
-@app.post("/create")
-def create_patient(patient: Patient):
-    if patients_collection.find_one({"id": patient.id}):
-        raise HTTPException(status_code=400, detail="Patient already exists")
-
-    patient_dict = patient.model_dump(exclude=["bmi", "verdict"])
-    patient_dict["bmi"] = patient.bmi
-    patient_dict["verdict"] = patient.verdict
-
-    patients_collection.insert_one(patient_dict)
-
-    return JSONResponse(status_code=201, content={"message": "Patient created successfully"})
-
-
-@app.put("/edit/{patient_id}")
-def update_patient(patient_id: str, patient_update: PatientUpdate):
-    existing_patient = patients_collection.find_one({"id": patient_id})
-
-    if not existing_patient:
-        raise HTTPException(status_code=404, detail="Patient not found")
-
-    # Merge existing data with the update
-    updated_fields = patient_update.model_dump(exclude_unset=True)
-    existing_patient.update(updated_fields)
-
-    # Ensure 'id' is included for model validation
-    existing_patient["id"] = patient_id
-
-    try:
-        # Create a new Patient object (auto-computes BMI and verdict)
-        patient_obj = Patient(**existing_patient)
-    except Exception as e:
-        raise HTTPException(status_code=422, detail=f"Invalid data: {str(e)}")
-
-    # Convert to dict and exclude 'id' before saving
-    updated_data = patient_obj.model_dump(exclude={"id"})
-
-    patients_collection.update_one({"id": patient_id}, {"$set": updated_data})
-
-    return JSONResponse(status_code=200, content={"message": "Patient Details Updated"})
-
-
-@app.delete("/delete/{patient_id}")
-def delete_patient(patient_id: str):
-    result = patients_collection.delete_one({"id": patient_id})
-
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Patient not found")
-
-    return JSONResponse(status_code=200, content={"message": "Patient Deleted"})
-
-
-class Query(BaseModel):
-    question : str
-
-@app.post("/ask")
-def ask_ques(q: Query):
-    try:
-        answer = ask_question(q.question)
-        return {"query": q.question, "answer": answer}
-    except Exception as e:
-        return {"error": str(e)}
+from fastapi import FastAPI, Path, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from pydantic import BaseModel, Field, computed_field, ValidationError
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from typing import Annotated, Literal, Optional
+from contextlib import asynccontextmanager
+import asyncio
+import json
+import logging
+import os
+from metrics import MetricsMiddleware, metrics_response
+from rag_model import (
+    aask_question, aask_questions, astream_answer, ainit_rag, rag_status, aconversation_query, aremember_turn,
+    failed_answer,
+)
+from conversation_store import conversations
+from answer_cache import answer_cache
+from single_flight import SingleFlight
+from upstream import DeadlineMiddleware
+import mongo_db
+from mongo_db import (
+    ensure_indexes, get_patient, count_patients,
+    find_page, iter_patients, bulk_upsert_patients, SORTABLE_FIELDS, PATIENT_FIELDS, PATIENT_PROJECTION,
+)
+from bulk_io import iter_records, csv_line
+from patient_stats import (
+    verdict_for_bmi, computed_fields_pipeline, record_patient_change, rebuild_stats,
+    verdict_counts, bmi_histogram, bmi_percentiles, BIN_WIDTH,
+)
+
+
+logger = logging.getLogger(__name__)
+
+# Identical concurrent reads (dashboards polling /view, /sort, /stats) share one
+# Mongo query, keyed on the endpoint and its parameters. Every write forgets
+# the in-flight reads so nothing read after it can be older than it.
+patient_reads = SingleFlight("patient_reads")
+
+
+async def run_in_background(name, coro):
+    # Startup work must never keep the API from booting; failures are logged
+    # and the RAG stack retries on first /ask.
+    try:
+        await coro
+    except Exception as e:
+        logger.warning("%s failed: %s", name, e)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Clients are created here, in the worker process, never at import.
+    # Create the id / sort indexes (no-op if they already exist) and warm up the
+    # RAG stack in the background so patient routes are served immediately
+    mongo_db.connect()
+    tasks = [
+        asyncio.create_task(run_in_background("ensure_indexes", ensure_indexes())),
+        asyncio.create_task(run_in_background("RAG warm-up", ainit_rag())),
+    ]
+    yield
+    for task in tasks:
+        task.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(DeadlineMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+class Patient(BaseModel):
+
+    id : Annotated[str, Field(..., description="Id of the patient", examples=["P001"])]
+    name: Annotated[str, Field(..., description="Name of the patient")]
+    city: Annotated[str, Field(..., description="City where the patient is living")]
+    age: Annotated[int, Field(..., gt=0, lt=120, description="Age of the patient")]
+    gender: Annotated[Literal["male", "female", "others"], Field(..., description="Gender of the patient")]
+    height: Annotated[float, Field(..., gt=0, description="height of the patient in meters")]
+    weight: Annotated[float, Field(..., gt=0, description="weight of the patient in kgs")]
+
+    @computed_field()
+    @property
+    def bmi(self) -> float:
+        bmi = round(self.weight/(self.height**2), 2)
+
+        return bmi
+    
+    @computed_field
+    @property
+    def verdict(self) -> str:
+
+        return verdict_for_bmi(self.bmi)
+        
+
+class PatientUpdate(BaseModel):
+    name: Annotated[Optional[str], Field(default=None)]
+    city: Annotated[Optional[str], Field(default=None)]
+    age: Annotated[Optional[int], Field(default=None, gt=0, lt=120)]
+    gender: Annotated[Optional[Literal['male', 'female', "others"]], Field(default=None)]
+    height: Annotated[Optional[float], Field(default=None, gt=0)]
+    weight: Annotated[Optional[float], Field(default=None, gt=0)]
+
+
+def patient_document(patient):
+    # Stored shape: input fields plus the computed bmi / verdict
+    return patient.model_dump()
+
+
+@app.get("/")
+async def hello():
+    return {"message" : "Hello World!"}
+
+
+def ndjson_response(docs):
+    # One JSON document per line, written as the Mongo cursor produces them
+    async def lines():
+        async for doc in docs:
+            yield json.dumps(doc) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+async def page_response(sort_by, order, limit, cursor):
+    try:
+        patients, next_cursor = await patient_reads.acall(
+            ("page", sort_by, order, limit, cursor), find_page, sort_by, order, limit, cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return {"patients": patients, "next_cursor": next_cursor}
+
+
+@app.get("/view")
+async def view(limit: int = Query(50, ge=1, le=500, description="Number of patients per page"),
+               cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+               stream: bool = Query(False, description="Stream every patient as NDJSON instead of a page")):
+
+    if stream:
+        return ndjson_response(iter_patients())
+
+    return await page_response("id", "asc", limit, cursor)
+
+
+@app.get("/health", tags=["System"])
+async def health_check():
+    try:
+        patients_count = await count_patients()  # verifies db access without scanning the collection
+        return {"status": "ok", "message": "API is healthy", "patients_count": patients_count}
+    except Exception as e:
+        return JSONResponse(status_code=500, content={
+            "status": "error", 
+            "message": "Something went wrong", 
+            "details": str(e)
+        })
+    
+
+@app.get("/metrics", tags=["System"])
+async def metrics():
+    # Prometheus text format: request, RAG stage, token, cache and Mongo metrics
+    body, content_type = metrics_response()
+    return Response(content=body, media_type=content_type)
+
+
+@app.get("/ready", tags=["System"])
+async def readiness():
+    # The API itself is up once this answers; the RAG stack and the unique
+    # index on patient ids are reported separately
+    return {"status": "ok", "rag": rag_status, "id_index_ready": mongo_db.id_index_ready}
+
+
+@app.get("/ready/rag", tags=["System"])
+async def rag_readiness():
+    if not rag_status["ready"]:
+        return JSONResponse(status_code=503, content={"status": "starting", "rag": rag_status})
+    return {"status": "ok", "rag": rag_status}
+
+
+@app.get("/patient/{patient_id}")
+async def view_patient(patient_id : str = Path(..., description="ID of the patient in the DB", example="P001")):
+    patient = await patient_reads.acall(("patient", patient_id), get_patient, patient_id)
+
+    if patient:
+        return patient
+    
+    raise HTTPException(status_code=404, detail="patient not found")
+
+
+@app.get("/sort")
+async def sort_patients(sort_by : str = Query(..., description="Sort on the basis on Height, Weight or BMI"),
+                        order: str = Query("desc", description="Sort in asc or desc order"),
+                        limit: int = Query(50, ge=1, le=500, description="Number of patients per page"),
+                        cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+                        stream: bool = Query(False, description="Stream every patient as NDJSON instead of a page")):
+    
+    valid_fields = SORTABLE_FIELDS
+
+    sort_by = sort_by.lower()
+    order = order.lower()
+
+    if sort_by not in valid_fields:
+        raise HTTPException(status_code=400, detail=f"invalid field select from {valid_fields}")
+    
+    if order not in ["asc", "desc"]:
+        raise HTTPException(status_code=400, detail="invalid order select between asc and desc")
+    
+    if stream:
+        return ndjson_response(iter_patients(sort_by=sort_by, order=order))
+
+    return await page_response(sort_by, order, limit, cursor)
+
+
+@app.post("/create")
+async def create_patient(patient: Patient):
+    # One round trip: the unique index on "id" rejects duplicates atomically.
+    # Until ensure_indexes() has confirmed that index, fall back to a lookup
+    # first so a failed index build never lets duplicates in unnoticed.
+    if not mongo_db.id_index_ready and await get_patient(patient.id):
+        raise HTTPException(status_code=400, detail="Patient already exists")
+
+    patient_dict = patient_document(patient)
+    try:
+        await mongo_db.async_patients_collection.insert_one(patient_dict)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Patient already exists")
+
+    await record_patient_change(new=patient_dict)
+    patient_reads.forget()
+
+    return JSONResponse(status_code=201, content={"message": "Patient created successfully"})
+
+
+@app.put("/edit/{patient_id}")
+async def update_patient(patient_id: str, patient_update: PatientUpdate):
+    # Every field constraint is checked by PatientUpdate, so the merged record
+    # is valid without reading it first. The update is a single
+    # find_one_and_update whose pipeline sets the new fields and recomputes
+    # bmi / verdict from the stored values, so concurrent edits of different
+    # fields cannot overwrite each other.
+    updated_fields = patient_update.model_dump(exclude_unset=True, exclude_none=True)
+    if not updated_fields:
+        raise HTTPException(status_code=422, detail="No fields to update")
+
+    old_patient = await mongo_db.async_patients_collection.find_one_and_update(
+        {"id": patient_id},
+        [{"$set": {field: {"$literal": value} for field, value in updated_fields.items()}}] + computed_fields_pipeline(),
+        projection=PATIENT_PROJECTION,
+        return_document=ReturnDocument.BEFORE,
+    )
+
+    if not old_patient:
+        raise HTTPException(status_code=404, detail="Patient not found")
+
+    try:
+        new_patient = patient_document(Patient(**{**old_patient, **updated_fields}))
+    except ValidationError:
+        # Stored record predates validation; stats will pick it up on rebuild
+        new_patient = None
+    await record_patient_change(old=old_patient, new=new_patient)
+    patient_reads.forget()
+
+    return JSONResponse(status_code=200, content={"message": "Patient Details Updated"})
+
+
+@app.delete("/delete/{patient_id}")
+async def delete_patient(patient_id: str):
+    # find_one_and_delete hands back the removed document for the stats update
+    deleted = await mongo_db.async_patients_collection.find_one_and_delete({"id": patient_id})
+
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Patient not found")
+
+    await record_patient_change(old=deleted)
+    patient_reads.forget()
+
+    return JSONResponse(status_code=200, content={"message": "Patient Deleted"})
+
+
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "1000"))
+
+
+@app.post("/patients/bulk")
+async def bulk_import(request: Request,
+                      fmt: Optional[Literal["ndjson", "csv"]] = Query(None, alias="format", description="ndjson or csv, defaults from Content-Type"),
+                      max_errors: int = Query(1000, ge=0, description="Maximum number of row errors listed in the report")):
+    # Rows are parsed and validated as the body streams in and written in
+    # chunks of BULK_CHUNK_SIZE upserts; the next chunk is parsed while the
+    # previous one is being written.
+    if fmt is None:
+        fmt = "csv" if "csv" in request.headers.get("content-type", "") else "ndjson"
+
+    report = {"received": 0, "valid": 0, "upserted": 0, "modified": 0, "failed": 0, "errors": []}
+
+    def add_error(row, message):
+        report["failed"] += 1
+        if len(report["errors"]) < max_errors:
+            report["errors"].append({"row": row, "error": message})
+
+    async def write(batch):
+        result = await bulk_upsert_patients([doc for _, doc in batch])
+        report["upserted"] += result["upserted"]
+        report["modified"] += result["modified"]
+        for index, message in result["errors"]:
+            add_error(batch[index][0], message)
+
+    batch = []
+    pending = None
+    async for row, record in iter_records(request.stream(), fmt):
+        report["received"] += 1
+        if isinstance(record, Exception):
+            add_error(row, str(record))
+            continue
+
+        try:
+            patient = Patient(**record)
+        except ValidationError as e:
+            add_error(row, "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()))
+            continue
+
+        report["valid"] += 1
+        batch.append((row, patient_document(patient)))
+        if len(batch) >= BULK_CHUNK_SIZE:
+            if pending:
+                await pending
+            pending = asyncio.create_task(write(batch))
+            batch = []
+
+    if pending:
+        await pending
+    if batch:
+        await write(batch)
+
+    # Upserts can both add and replace patients; recompute the summary once
+    if report["upserted"] or report["modified"]:
+        await rebuild_stats()
+        patient_reads.forget()
+
+    return report
+
+
+@app.get("/patients/export")
+async def bulk_export(fmt: Literal["ndjson", "csv"] = Query("ndjson", alias="format", description="ndjson or csv")):
+    if fmt == "ndjson":
+        return ndjson_response(iter_patients())
+
+    async def lines():
+        yield csv_line(PATIENT_FIELDS)
+        async for doc in iter_patients():
+            yield csv_line([doc.get(field) for field in PATIENT_FIELDS])
+
+    return StreamingResponse(lines(), media_type="text/csv",
+                             headers={"Content-Disposition": "attachment; filename=patients.csv"})
+
+
+STAT_DIMENSIONS = Literal["all", "city", "gender", "age_band"]
+
+
+@app.get("/stats/verdicts", tags=["Stats"])
+async def stats_verdicts(group_by: STAT_DIMENSIONS = Query("all", description="all, city, gender or age_band"),
+                         value: Optional[str] = Query(None, description="Only this city / gender / age band")):
+    return await patient_reads.acall(("verdicts", group_by, value), verdict_counts, group_by, value)
+
+
+@app.get("/stats/bmi-histogram", tags=["Stats"])
+async def stats_bmi_histogram(group_by: STAT_DIMENSIONS = Query("all", description="all, city, gender or age_band"),
+                              value: Optional[str] = Query(None, description="Only this city / gender / age band"),
+                              bin_width: float = Query(1.0, description=f"Bin width, a multiple of {BIN_WIDTH}")):
+    if bin_width <= 0 or round(bin_width / BIN_WIDTH, 6) % 1:
+        raise HTTPException(status_code=400, detail=f"bin_width must be a positive multiple of {BIN_WIDTH}")
+    return await patient_reads.acall(("bmi_histogram", group_by, value, bin_width),
+                                     bmi_histogram, group_by, value, bin_width)
+
+
+@app.get("/stats/bmi-percentiles", tags=["Stats"])
+async def stats_bmi_percentiles(group_by: STAT_DIMENSIONS = Query("all", description="all, city, gender or age_band"),
+                                value: Optional[str] = Query(None, description="Only this city / gender / age band"),
+                                p: list[float] = Query([25, 50, 75, 90], description="Percentiles to report")):
+    if any(not 0 < x <= 100 for x in p):
+        raise HTTPException(status_code=400, detail="percentiles must be in (0, 100]")
+    return await patient_reads.acall(("bmi_percentiles", group_by, value, tuple(p)),
+                                     bmi_percentiles, group_by, value, p)
+
+
+@app.post("/stats/rebuild", tags=["Stats"])
+async def stats_rebuild():
+    # Full recompute through an aggregation pipeline, e.g. after manual DB edits
+    await rebuild_stats()
+    patient_reads.forget()
+    return {"message": "Statistics rebuilt"}
+
+
+class Query(BaseModel):
+    question : str
+    # Follow-ups are resolved against this session's conversation, kept server-side
+    session_id : Optional[str] = None
+
+@app.post("/ask")
+async def ask_ques(q: Query):
+    try:
+        answer = await aask_question(await aconversation_query(q.question, q.session_id))
+        # A failed turn would otherwise become the topic of the next follow-up
+        if not failed_answer(answer):
+            await aremember_turn(q.session_id, q.question, answer)
+        return {"query": q.question, "answer": answer}
+    except Exception as e:
+        return {"error": str(e)}
+
+
+@app.post("/ask/stream")
+async def ask_stream(q: Query):
+    # Server-sent events: one "data: {"token": ...}" event per chunk, then "event: done"
+    async def events():
+        parts = []
+        async for token in astream_answer(await aconversation_query(q.question, q.session_id)):
+            parts.append(token)
+            yield f"data: {json.dumps({'token': token})}\n\n"
+        if parts and not failed_answer(parts[-1]):
+            await aremember_turn(q.session_id, q.question, "".join(parts))
+        yield "event: done\ndata: {}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+class BatchQuery(BaseModel):
+    questions: Annotated[list[str], Field(..., min_length=1, max_length=1000)]
+
+@app.post("/ask/batch")
+async def ask_batch(q: BatchQuery):
+    # Results are in request order, each with either "answer" or "error"
+    return {"results": await aask_questions(q.questions)}
+
+
+@app.get("/conversation/{session_id}")
+async def conversation_history(session_id: str):
+    # Last messages of the session (oldest first) and its current topic
+    return await conversations.ahistory(session_id)
+
+
+@app.delete("/conversation/{session_id}")
+async def conversation_clear(session_id: str):
+    await conversations.aclear(session_id)
+    return {"message": "Conversation cleared"}
+
+
+@app.get("/cache/stats", tags=["System"])
+async def cache_stats():
+    return answer_cache.snapshot()
+
+
+@app.post("/cache/invalidate", tags=["System"])
+async def cache_invalidate():
+    # Call after re-ingesting the Pinecone index so stale answers are dropped
+    await answer_cache.ainvalidate()
+    return {"message": "Answer cache invalidated", "generation": answer_cache.generation}
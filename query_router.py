@@ -0,0 +1,160 @@
+# Answers greetings, thanks and off-topic questions without retrieval or an
+# LLM call, using the canned replies from the RAG prompt template.
+#
+# Two stages:
+#   - route_text(): word rules for messages made only of greeting / thanks
+#     phrases ("hi", "thank you doctor", "ok"). Runs before anything else.
+#   - route_vector(): nearest-prototype classifier over the query embedding
+#     (which retrieval needs anyway). A question is routed as non-medical
+#     only when it is clearly closer to the non-medical examples than to the
+#     medical ones, so borderline questions still reach the RAG chain.
+#     Off unless ROUTER_MARGIN is set: pick the margin from
+#     benchmarks/eval_router.py run against the Gemini embeddings, and record
+#     its precision numbers next to the setting, before turning it on.
+
+import os
+import re
+
+import numpy as np
+
+from local_index import normalize_rows
+
+ROUTER_MARGIN = float(os.environ["ROUTER_MARGIN"]) if os.getenv("ROUTER_MARGIN") else None
+
+GREETING_WORDS = {
+    "hi", "hii", "hiii", "hello", "helo", "hey", "heya", "hiya", "howdy", "greetings", "namaste", "yo",
+    "morning", "afternoon", "evening",
+}
+GRATITUDE_WORDS = {
+    "thanks", "thank", "thankyou", "thx", "thnx", "ty", "tysm", "appreciate", "appreciated",
+    "ok", "okay", "okk", "k", "alright", "cool", "great", "perfect", "got",
+}
+# Words that may accompany the phrases above without changing the intent
+FILLER_WORDS = {
+    "good", "there", "doctor", "doc", "assistant", "bot", "everyone", "all", "again", "so", "much", "a", "lot",
+    "you", "u", "very", "and", "it", "that", "for", "the", "help", "your", "dear", "sir", "madam", "oh",
+}
+MAX_RULE_WORDS = 8
+
+# Prototypes for the embedding stage; the labeled evaluation set lives in
+# benchmarks/router_labels.jsonl and does not overlap these
+MEDICAL_EXAMPLES = [
+    "What are the symptoms of dengue fever?",
+    "How is type 2 diabetes treated?",
+    "Is it safe to take ibuprofen with paracetamol?",
+    "What causes high blood pressure?",
+    "How long does a cold usually last?",
+    "What is a normal resting heart rate?",
+    "Can antibiotics treat a viral infection?",
+    "What are the side effects of metformin?",
+    "How do I know if a cut is infected?",
+    "What vaccines does a newborn need?",
+    "Why do I get headaches every morning?",
+    "What is the recommended dose of vitamin D?",
+    "How is malaria transmitted?",
+    "What are early signs of a heart attack?",
+    "How can I lower my cholesterol?",
+    "Is chest pain after exercise dangerous?",
+    "What does a high BMI mean for my health?",
+    "How is asthma diagnosed?",
+    "What should I eat during pregnancy?",
+    "What are the stages of chronic kidney disease?",
+]
+NON_MEDICAL_EXAMPLES = [
+    "Who won the football world cup?",
+    "What is the capital of France?",
+    "Write a poem about the ocean.",
+    "How do I reverse a linked list in Python?",
+    "What is the weather like tomorrow?",
+    "Recommend a good movie to watch tonight.",
+    "How much is bitcoin worth today?",
+    "Tell me a joke.",
+    "How do I file my income tax return?",
+    "What is the best smartphone to buy?",
+    "Translate hello into Spanish.",
+    "Who is the prime minister of India?",
+    "How do I bake chocolate chip cookies?",
+    "Explain the theory of relativity.",
+    "What time is it in New York?",
+    "Can you help me write a cover letter?",
+    "Which stocks should I invest in?",
+    "How do I fix my wifi router?",
+    "What are the rules of cricket?",
+    "Plan a trip to Goa for me.",
+]
+
+_WORDS = re.compile(r"[a-z]+")
+
+
+def canned_responses(template):
+    # The quoted reply that closes each rule of the prompt template, so the
+    # router and the LLM give the same answers
+    responses = {}
+    for intent, heading in (("non_medical", "Non-medical questions"), ("greeting", "Greetings"),
+                            ("gratitude", "Gratitude")):
+        section = template.split(f"**{heading}**", 1)[1].split("**", 1)[0]
+        responses[intent] = re.findall(r'^\s*"(.+)"\s*$', section, re.MULTILINE)[-1]
+    return responses
+
+
+class QueryRouter:
+    def __init__(self, responses, margin=ROUTER_MARGIN, top=3):
+        self.responses = responses
+        self.margin = margin
+        self.top = top
+        self.medical = None
+        self.non_medical = None
+
+    @property
+    def enabled(self):
+        return self.margin is not None
+
+    @property
+    def fitted(self):
+        return self.medical is not None
+
+    def fit(self, embeddings, medical=MEDICAL_EXAMPLES, non_medical=NON_MEDICAL_EXAMPLES):
+        # Embedded like queries so they are comparable with route_vector()
+        # inputs; CachedEmbeddings keeps them on disk across restarts
+        texts = list(medical) + list(non_medical)
+        if hasattr(embeddings, "embed_queries"):
+            vectors = embeddings.embed_queries(texts)
+        else:
+            vectors = [embeddings.embed_query(t) for t in texts]
+        vectors = normalize_rows(np.asarray(vectors, dtype=np.float32))
+        self.medical = vectors[:len(medical)]
+        self.non_medical = vectors[len(medical):]
+        return self
+
+    def route_text(self, query):
+        words = _WORDS.findall(query.lower())
+        if not words or len(words) > MAX_RULE_WORDS:
+            return None
+        if any(w not in GREETING_WORDS and w not in GRATITUDE_WORDS and w not in FILLER_WORDS for w in words):
+            return None
+        if any(w in GRATITUDE_WORDS for w in words):
+            return "gratitude"
+        if any(w in GREETING_WORDS for w in words):
+            return "greeting"
+        return None
+
+    def _closeness(self, prototypes, vector):
+        scores = prototypes @ vector
+        top = min(self.top, len(scores))
+        return float(np.partition(scores, -top)[-top:].mean())
+
+    def margin_for(self, query_vector):
+        vector = np.asarray(query_vector, dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) or 1.0)
+        return self._closeness(self.non_medical, vector) - self._closeness(self.medical, vector)
+
+    def route_vector(self, query_vector):
+        if not self.enabled or not self.fitted:
+            return None
+        return "non_medical" if self.margin_for(query_vector) >= self.margin else None
+
+    def route(self, query, query_vector=None):
+        intent = self.route_text(query)
+        if intent is None and query_vector is not None:
+            intent = self.route_vector(query_vector)
+        return intent
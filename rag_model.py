@@ -1,63 +1,77 @@
 from langchain_core.prompts import PromptTemplate
-from langchain.chains import RetrievalQA
 from dotenv import load_dotenv
-import pinecone 
-from langchain_pinecone import Pinecone as LangchainPinecone
-from langchain_core.language_models.chat_models import BaseChatModel
-from langchain_core.messages import AIMessage
 from langchain.embeddings.base import Embeddings
-from openai import OpenAI
-from langchain_core.outputs import ChatResult, ChatGeneration
-from pydantic import PrivateAttr
 import os
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from pinecone import Pinecone, ServerlessSpec
+import threading
+import time
+import asyncio
+from custom_llm import CustomAPIChatLLM
+from answer_cache import answer_cache, normalize_query
+from embedding_cache import CachedEmbeddings
+from local_index import LocalVectorStore
+from lexical_index import BM25Index
+from hybrid_retriever import HybridRetriever
+from reranker import Reranker
+from context_builder import build_context, estimate_tokens
+from query_router import QueryRouter, canned_responses
+from conversation_store import conversations
+from rate_limit import token_bucket
+from single_flight import SingleFlight
+from upstream import ManagedEmbeddings, Upstream
+from metrics import timed_stage, observe_stage, record_usage, record_context, record_route, RAG_CACHE_LOOKUPS
 
 load_dotenv()
 
+# The RAG stack (LLM clients, embeddings, vector store, retriever) is built on
+# first use by init_rag(), or by the warm-up task started with the API, so
+# importing this module does no network I/O and patient routes come up
+# immediately. Heavy SDK imports live inside the builders for the same reason.
+llm = None
+embedding_model = None
+db = None
+retriever = None
 
-class CustomAPIChatLLM(BaseChatModel):
-    model_id: str  # Pydantic field
-    _client: any = PrivateAttr()  # Private attribute (not a model field)
-
-    def __init__(self, client, model_id, **kwargs):
-        super().__init__(model_id=model_id, **kwargs)
-        self._client = client  # store in private attr
-
-    @property
-    def _llm_type(self) -> str:
-        return "custom_api_chat_llm"
-
-    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
-        # Convert messages to dict
-        text_messages = [
-                {
-                    "role": "user" if m.type == "human" else "assistant",
-                    "content": m.content
-                }
-                for m in messages
-            ]
-
-        # Call your API
-        completion = self._client.chat.completions.create(
-            model=self.model_id,
-            messages=text_messages,
-        )
-        
-        content = completion.choices[0].message.content
-        # Return as ChatResult
-        return ChatResult(
-            generations=[ChatGeneration(message=AIMessage(content=content))]
-        )
+# rag_status["ready"] is the flag the answer paths check before building the stack
+rag_status = {"ready": False, "error": None, "init_seconds": None}
+_init_lock = threading.Lock()
 
 llm_key = os.getenv("OPENAI_API_KEY")
+llm_model_id = "provider-3/claude-3.5-haiku"
+# Second model on the same gateway for hedged requests and failover; off when unset
+llm_fallback_model = os.getenv("LLM_FALLBACK_MODEL")
+
+# Upstream limits (see upstream.py): requests per second, starting
+# concurrency and the longest a single call may take
+upstream_llm_rate = float(os.getenv("LLM_RATE", "10"))
+upstream_llm_concurrency = int(os.getenv("LLM_CONCURRENCY", "8"))
+upstream_llm_timeout = float(os.getenv("LLM_TIMEOUT", "30"))
+upstream_embed_rate = float(os.getenv("EMBED_RATE", "20"))
+
+
+def create_llm():
+    from openai import OpenAI, AsyncOpenAI
+
+    # Retries are left to the upstream manager, which sees every 429
+    client = OpenAI(
+      base_url="https://api.a4f.co/v1",
+      api_key=llm_key,
+      max_retries=0,
+    )
 
-client = OpenAI(
-  base_url="https://api.a4f.co/v1",
-  api_key=llm_key,
-)
+    async_client = AsyncOpenAI(
+      base_url="https://api.a4f.co/v1",
+      api_key=llm_key,
+      max_retries=0,
+    )
 
-llm = CustomAPIChatLLM(client=client, model_id="provider-3/claude-3.5-haiku")
+    upstream = Upstream(
+        "llm",
+        [llm_model_id] + ([llm_fallback_model] if llm_fallback_model else []),
+        rate=upstream_llm_rate,
+        concurrency=upstream_llm_concurrency,
+        timeout=upstream_llm_timeout,
+    )
+    return CustomAPIChatLLM(client=client, async_client=async_client, model_id=llm_model_id, upstream=upstream)
 
 
 
@@ -102,65 +116,353 @@ def set_custom_prompt(custom_prompt_template):
     prompt = PromptTemplate(template=custom_prompt_template, input_variables=["context", "query"])
     return prompt
 
+
+rag_prompt = set_custom_prompt(CUSTOM_PROMPT_TEMPLATE)
+
+router = QueryRouter(canned_responses(CUSTOM_PROMPT_TEMPLATE))
+
+
+NO_ANSWER = "Sorry, I couldn't understand that."
+# Failures come back as answer text starting with this (and streams end with it)
+ERROR_PREFIX = "An error occurred: "
+
+
+def failed_answer(answer):
+    return not answer or answer == NO_ANSWER or answer.startswith(ERROR_PREFIX)
+
+
+def build_prompt(docs, user_query):
+    # Same layout as the "stuff" chain, but only the sentences relevant to the
+    # question are kept, within CONTEXT_TOKEN_BUDGET
+    with timed_stage("prompt"):
+        context = build_context(docs, user_query)
+        retrieved_tokens = sum(estimate_tokens(doc.page_content) for doc in docs)
+        record_context(docs, context, retrieved_tokens, estimate_tokens(context))
+        return rag_prompt.format(context=context, question=user_query)
+
+
+def answer_text(message):
+    record_usage(message)
+    return message.content or NO_ANSWER
+
+
+def routed_answer(user_query, query_vector=None):
+    # Canned reply for greetings / thanks (text rules) or off-topic questions
+    # (embedding classifier, once the vector is known); None means "run RAG"
+    if query_vector is None:
+        intent = router.route_text(user_query)
+    else:
+        intent = router.route_vector(query_vector)
+    if intent is None:
+        return None
+    record_route(intent, embedded=query_vector is not None)
+    return router.responses[intent]
+
+
+# Standalone form of a follow-up question ("what about for children?"), used
+# for routing, caching, retrieval and the prompt. With a shared store the
+# conversation and cache calls are SQLite I/O and run in a thread
+async def aconversation_query(user_query, session_id=None):
+    if session_id is None or router.route_text(user_query) is not None:
+        return user_query
+    return await conversations.acondense(session_id, user_query)
+
+
+async def aremember_turn(session_id, user_query, answer):
+    if session_id is not None:
+        await conversations.arecord(session_id, user_query, answer, topical=router.route_text(user_query) is None)
+
+
+async def acached_exact(user_query):
+    with timed_stage("cache"):
+        answer = await answer_cache.aget_exact(user_query)
+    if answer is not None:
+        RAG_CACHE_LOOKUPS.labels("exact_hit").inc()
+    return answer
+
+
+async def acached_similar(user_query, query_vector):
+    with timed_stage("cache"):
+        answer = await answer_cache.aget_similar(user_query, query_vector)
+    RAG_CACHE_LOOKUPS.labels("semantic_hit" if answer is not None else "miss").inc()
+    return answer
+
 # ============================================================================
 
 # api_key = os.getenv("PINECONE_API_KEY")
 
 api_key = os.getenv("PINECONE_API_KEY")
 
-# Step 1: Create Pinecone client
-pc = pinecone.Pinecone(api_key=api_key)
-
-# Step 2: Create index (if not exists)
 index_name = "rag-index3"
-# index = pc.Index(index_name)
 dimension = 768  # Update to your embedding model dimension
 
+# "pinecone" (default) or "local" for the in-process store in local_index.py
+retriever_backend = os.getenv("RETRIEVER_BACKEND", "pinecone")
+local_index_dir = os.getenv("LOCAL_INDEX_DIR", "local_index")
+lexical_index_dir = os.getenv("LEXICAL_INDEX_DIR", "lexical_index")
+# Candidates fetched for reranking; 0 disables the rerank stage. Off by
+# default with Pinecone: its hits carry no vectors, so the reranker would
+# embed up to RERANK_FETCH_K chunks on every embedding-cache miss
+rerank_fetch_k = int(os.getenv("RERANK_FETCH_K", "30" if retriever_backend == "local" else "0"))
+
+# Limits for ask_questions(): parallel vector queries, parallel LLM calls and
+# LLM requests per second
+batch_retrieval_concurrency = int(os.getenv("BATCH_RETRIEVAL_CONCURRENCY", "16"))
+batch_llm_concurrency = int(os.getenv("BATCH_LLM_CONCURRENCY", "8"))
+batch_llm_rate = float(os.getenv("BATCH_LLM_RATE", "5"))
+# One bucket per process (or per host with SHARED_STATE_PATH), so the rate
+# holds across concurrent and successive batches
+batch_llm_bucket = token_bucket("batch_llm", batch_llm_rate)
+
+
+def create_embedding_model():
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+    # Embedding model
+    # embedding_model = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+    embedding_model = GoogleGenerativeAIEmbeddings(
+        model = "models/embedding-001",
+        google_api_key=os.getenv("GEMINI_API_KEY"),
+        dimension=384
+    )
+
+    # Memoize vectors in-process and in a memory-mapped store shared by all
+    # workers; only cache misses reach the managed upstream
+    upstream = Upstream("embed", ["models/embedding-001"], rate=upstream_embed_rate)
+    return CachedEmbeddings(
+        ManagedEmbeddings(embedding_model, upstream),
+        model_name="models/embedding-001",
+        dimension=dimension,
+        cache_dir=os.getenv("EMBEDDING_CACHE_DIR", ".embedding_cache"),
+        query_batch_kwargs={"task_type": "RETRIEVAL_QUERY"},
+    )
+
 
-# Check if index already exists
-if index_name not in [index.name for index in pc.list_indexes()]:
-    # Recreate with correct dimension
-    pc.create_index(
-        name=index_name,
-        dimension=768,
-        metric="cosine",
-        spec=ServerlessSpec(
-            cloud="aws",  # or "gcp"
-            region="us-east-1"  # adjust based on your Pinecone region
+def create_pinecone_index():
+    import pinecone
+    from pinecone import ServerlessSpec
+
+    # Step 1: Create Pinecone client
+    pc = pinecone.Pinecone(api_key=api_key)
+
+    # Step 2: Create index (if not exists)
+    # Check if index already exists
+    if index_name not in [index.name for index in pc.list_indexes()]:
+        # Recreate with correct dimension
+        pc.create_index(
+            name=index_name,
+            dimension=768,
+            metric="cosine",
+            spec=ServerlessSpec(
+                cloud="aws",  # or "gcp"
+                region="us-east-1"  # adjust based on your Pinecone region
+            )
         )
+
+    return pc.Index(index_name)
+
+
+def create_vector_store(embedding_model):
+    from langchain_pinecone import Pinecone as LangchainPinecone
+
+    if retriever_backend == "local":
+        # Memory-mapped local copy, see LocalVectorStore.from_pinecone / save
+        return LocalVectorStore.load(local_index_dir, embedding_model)
+
+    # Langchain Pinecone DB
+    return LangchainPinecone(
+        index=create_pinecone_index(),
+        embedding=embedding_model,
+        text_key="text"  # make sure your vectors have this metadata field
     )
 
-index = pc.Index(index_name)
 
-# Embedding model
-# embedding_model = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-embedding_model = GoogleGenerativeAIEmbeddings(
-    model = "models/embedding-001",
-    google_api_key=os.getenv("GEMINI_API_KEY"),
-    dimension=384
-)
+def create_retriever(vector_store):
+    # BM25 + vector fusion when a lexical index exists (see lexical_index.py);
+    # a local vector store can index its own chunks at startup
+    if os.path.isdir(lexical_index_dir):
+        lexical = BM25Index.load(lexical_index_dir)
+    elif isinstance(vector_store, LocalVectorStore):
+        lexical = BM25Index.from_texts(vector_store.texts, vector_store.metadatas)
+    else:
+        lexical = None
+    if rerank_fetch_k:
+        reranker = Reranker(vector_store.embeddings, vector_store)
+        return HybridRetriever(vector_store=vector_store, lexical=lexical, k=3, fetch_k=rerank_fetch_k, reranker=reranker)
+    return HybridRetriever(vector_store=vector_store, lexical=lexical, k=3)
+
+
+def init_rag():
+    # Builds the stack once; safe to call from several threads
+    global llm, embedding_model, db, retriever
+
+    if rag_status["ready"]:
+        return
+
+    with _init_lock:
+        if rag_status["ready"]:
+            return
+
+        start = time.perf_counter()
+        try:
+            llm = create_llm()
+            embedding_model = create_embedding_model()
+            db = create_vector_store(embedding_model)
+            retriever = create_retriever(db)
+            if router.enabled:
+                router.fit(embedding_model)
+        except Exception as e:
+            rag_status["error"] = str(e)
+            raise
+
+        rag_status.update(ready=True, error=None, init_seconds=round(time.perf_counter() - start, 3))
+
+
+async def ainit_rag():
+    if not rag_status["ready"]:
+        await asyncio.to_thread(init_rag)
+
+
+# Identical questions asked at the same time (e.g. right after a health
+# alert) share one run of the pipeline, keyed like the exact answer cache
+question_flights = SingleFlight("ask")
+
+
+async def aask_question(user_query):
+    return await question_flights.acall(normalize_query(user_query), _aask_question, user_query)
 
 
-# Langchain Pinecone DB
-db = LangchainPinecone(
-    index=index,
-    embedding=embedding_model,
-    text_key="text"  # make sure your vectors have this metadata field
-)
+# Pipeline steps shared by single, streamed and batched answers
+async def answer_before_embedding(user_query):
+    # Text-rule route or exact cache hit; None when the question needs its vector
+    return routed_answer(user_query) or await acached_exact(user_query)
 
 
-qa_chain = RetrievalQA.from_chain_type(
-    llm=llm,
-    chain_type="stuff",
-    retriever=db.as_retriever(search_kwargs={"k": 3}),
-    return_source_documents=True,
-    chain_type_kwargs={"prompt": set_custom_prompt(CUSTOM_PROMPT_TEMPLATE)}
-)
+async def answer_from_vector(user_query, query_vector):
+    # Embedding route or semantic cache hit; None means "retrieve and generate"
+    return routed_answer(user_query, query_vector) or await acached_similar(user_query, query_vector)
+
+
+async def retrieve_prompt(user_query, query_vector):
+    with timed_stage("retrieve"):
+        docs = await retriever.asearch(user_query, query_vector)
+    return build_prompt(docs, user_query)
+
+
+async def store_answer(user_query, query_vector, answer, generation):
+    # An empty completion is not an answer worth keeping for the cache TTL
+    if answer and answer != NO_ANSWER:
+        await answer_cache.aput(user_query, query_vector, answer, generation=generation)
+
+
+async def prepare_answer(user_query):
+    # Everything before the LLM call. Returns (answer, None) when routing or a
+    # cache settles the question, else (None, (prompt, query_vector, generation))
+    answer = await answer_before_embedding(user_query)
+    if answer is not None:
+        return answer, None
+
+    await ainit_rag()
+    # Embed once: the vector serves both the semantic cache and retrieval
+    generation = answer_cache.generation
+    with timed_stage("embed"):
+        query_vector = await embedding_model.aembed_query(user_query)
+    answer = await answer_from_vector(user_query, query_vector)
+    if answer is not None:
+        return answer, None
+    return None, (await retrieve_prompt(user_query, query_vector), query_vector, generation)
+
+
+async def _aask_question(user_query):
+    try:
+        answer, pending = await prepare_answer(user_query)
+        if answer is not None:
+            return answer
+
+        prompt, query_vector, generation = pending
+        with timed_stage("generate"):
+            answer = answer_text(await llm.ainvoke(prompt))
+        await store_answer(user_query, query_vector, answer, generation)
+        return answer
+    except Exception as e:
+        return f"{ERROR_PREFIX}{e}"
+
+
+async def astream_answer(user_query):
+    # Yields the answer in pieces as the LLM produces them; cached answers
+    # come back as a single piece
+    try:
+        answer, pending = await prepare_answer(user_query)
+        if answer is not None:
+            yield answer
+            return
+
+        prompt, query_vector, generation = pending
+        parts = []
+        start = time.perf_counter()
+        async for chunk in llm.astream(prompt):
+            if chunk.content:
+                if not parts:
+                    # Time to first token is what the user feels for streamed answers
+                    observe_stage("first_token", time.perf_counter() - start)
+                parts.append(chunk.content)
+                yield chunk.content
+        # Includes time the client took to consume the chunks
+        observe_stage("generate", time.perf_counter() - start)
+
+        await store_answer(user_query, query_vector, "".join(parts), generation)
+    except Exception as e:
+        yield f"{ERROR_PREFIX}{e}"
+
 
-# Now invoke with a single query
-def ask_question(user_query):
+async def aask_questions(questions):
+    # Answers many questions at once: one batched embedding call, concurrent
+    # vector queries and rate-limited, bounded-concurrency LLM calls. Results
+    # keep the input order; a failing item gets an "error" instead of an answer.
+    results = [{"query": q} for q in questions]
     try:
-        response = qa_chain.invoke({'query': user_query})
-        return response.get("result", "Sorry, I couldn't understand that.")
+        await ainit_rag()
+
+        pending = []
+        for i, question in enumerate(questions):
+            answer = await answer_before_embedding(question)
+            if answer is not None:
+                results[i]["answer"] = answer
+            else:
+                pending.append(i)
+
+        generation = answer_cache.generation
+        with timed_stage("embed"):
+            vectors = await embedding_model.aembed_queries([questions[i] for i in pending]) if pending else []
     except Exception as e:
-        return f"An error occurred: {str(e)}"
\ No newline at end of file
+        for result in results:
+            if "answer" not in result:
+                result["error"] = str(e)
+        return results
+
+    retrieval_slots = asyncio.Semaphore(batch_retrieval_concurrency)
+    llm_slots = asyncio.Semaphore(batch_llm_concurrency)
+
+    async def answer_one(i, query_vector):
+        question = questions[i]
+        try:
+            answer = await answer_from_vector(question, query_vector)
+            if answer is None:
+                async with retrieval_slots:
+                    prompt = await retrieve_prompt(question, query_vector)
+                async with llm_slots:
+                    await batch_llm_bucket.acquire()
+                    with timed_stage("generate"):
+                        answer = answer_text(await llm.ainvoke(prompt))
+                await store_answer(question, query_vector, answer, generation)
+            results[i]["answer"] = answer
+        except Exception as e:
+            results[i]["error"] = str(e)
+
+    await asyncio.gather(*(answer_one(i, v) for i, v in zip(pending, vectors)))
+    return results
+
+
+def ask_questions(questions):
+    # Blocking wrapper for scripts and nightly jobs
+    return asyncio.run(aask_questions(questions))
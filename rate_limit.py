@@ -0,0 +1,93 @@
+# Token-bucket rate limiter for calls to upstream providers.
+
+import asyncio
+import threading
+import time
+
+from shared_store import shared_store
+
+
+class AsyncTokenBucket:
+    def __init__(self, rate, capacity=None):
+        # `rate` tokens per second, bursts of up to `capacity`
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        # A threading lock rather than an asyncio.Lock: the latter binds to
+        # the first event loop it is contended on, and one bucket outlives
+        # loops (ask_questions runs asyncio.run per call) and spans threads
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, tokens=1):
+        # Non-blocking: 0 when the tokens were taken, otherwise the seconds to
+        # wait before trying again (nothing is taken in that case)
+        with self._lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0.0
+            return (tokens - self.tokens) / self.rate
+
+    def reserve(self, tokens=1):
+        # Takes the tokens now, going into debt if needed, and returns the
+        # seconds until the debt is paid off. Later callers queue behind the
+        # debt, so waiters are served in arrival order.
+        with self._lock:
+            self._refill()
+            self.tokens -= tokens
+            return max(0.0, -self.tokens / self.rate)
+
+    def refund(self, tokens=1):
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + tokens)
+
+    async def atake(self, tokens=1):
+        return self.take(tokens)
+
+    async def acquire(self, tokens=1):
+        wait = self.reserve(tokens)
+        if not wait:
+            return
+        try:
+            await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            self.refund(tokens)  # e.g. the caller's deadline passed while queued
+            raise
+
+
+class SharedTokenBucket:
+    # Same interface, but the bucket lives in a SharedStore so the limit holds
+    # across all worker processes
+    def __init__(self, store, name, rate, capacity=None):
+        self.store = store
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+
+    def take(self, tokens=1):
+        return self.store.take_tokens(self.name, self.rate, self.capacity, tokens)
+
+    async def atake(self, tokens=1):
+        # take() is a SQLite transaction: keep it off the event loop
+        return await asyncio.to_thread(self.take, tokens)
+
+    async def acquire(self, tokens=1):
+        while True:
+            wait = await self.atake(tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+
+def token_bucket(name, rate, capacity=None):
+    # Shared across workers when SHARED_STATE_PATH is set, in-process otherwise
+    if shared_store is not None:
+        return SharedTokenBucket(shared_store, name, rate, capacity)
+    return AsyncTokenBucket(rate, capacity)
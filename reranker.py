@@ -0,0 +1,81 @@
+# Rerank over-fetched candidates locally before they are stuffed into the prompt.
+#
+# Relevance blends cosine similarity to the query with the share of query
+# terms a chunk contains; MMR then picks the final chunks, trading relevance
+# against similarity to chunks already picked so near-duplicates don't crowd
+# out other evidence. Chunk vectors come from the local vector store when
+# the chunk lives there, otherwise from the embedding cache (warmed by
+# ingest.py, but a miss costs an API call per chunk -- which is why
+# rag_model only enables reranking by default for the local backend).
+
+import numpy as np
+
+from context_builder import terms
+from local_index import LocalVectorStore, normalize_rows
+
+
+class Reranker:
+    def __init__(self, embeddings, vector_store=None, lexical_weight=0.3, diversity=0.3):
+        self.embeddings = embeddings
+        self.vector_store = vector_store if isinstance(vector_store, LocalVectorStore) else None
+        self.lexical_weight = lexical_weight
+        self.diversity = diversity
+        self._rows = {}
+        self._indexed = 0
+
+    def _stored_vectors(self, texts):
+        if self.vector_store is None:
+            return None
+        if self._indexed != len(self.vector_store):
+            self._rows = {text: row for row, text in enumerate(self.vector_store.texts)}
+            self._indexed = len(self.vector_store)
+        rows = [self._rows.get(text) for text in texts]
+        if None in rows:
+            return None
+        return np.asarray(self.vector_store.vectors[rows], dtype=np.float32)
+
+    def chunk_vectors(self, texts):
+        vectors = self._stored_vectors(texts)
+        return vectors if vectors is not None else normalize_rows(self.embeddings.embed_documents(texts))
+
+    async def achunk_vectors(self, texts):
+        vectors = self._stored_vectors(texts)
+        return vectors if vectors is not None else normalize_rows(await self.embeddings.aembed_documents(texts))
+
+    def scores(self, query, query_vector, vectors, texts):
+        query_vector = normalize_rows(query_vector)
+        cosine = vectors @ query_vector
+        query_terms = terms(query)
+        if query_terms:
+            overlap = np.array([len(query_terms & terms(t)) for t in texts], dtype=np.float32) / len(query_terms)
+        else:
+            overlap = np.zeros(len(texts), dtype=np.float32)
+        return (1 - self.lexical_weight) * cosine + self.lexical_weight * overlap
+
+    def rerank(self, query, query_vector, docs, k):
+        if len(docs) <= 1:
+            return docs[:k]
+        return self.select(query, query_vector, docs, self.chunk_vectors([d.page_content for d in docs]), k)
+
+    async def arerank(self, query, query_vector, docs, k):
+        if len(docs) <= 1:
+            return docs[:k]
+        return self.select(query, query_vector, docs, await self.achunk_vectors([d.page_content for d in docs]), k)
+
+    def select(self, query, query_vector, docs, vectors, k):
+        texts = [doc.page_content for doc in docs]
+        relevance = self.scores(query, query_vector, vectors, texts)
+        similarity = vectors @ vectors.T
+
+        selected = [int(np.argmax(relevance))]
+        redundancy = similarity[selected[0]].copy()
+        available = np.ones(len(docs), dtype=bool)
+        available[selected[0]] = False
+        while len(selected) < min(k, len(docs)):
+            mmr = (1 - self.diversity) * relevance - self.diversity * redundancy
+            mmr[~available] = -np.inf
+            best = int(np.argmax(mmr))
+            selected.append(best)
+            available[best] = False
+            redundancy = np.maximum(redundancy, similarity[best])
+        return [docs[i] for i in selected]
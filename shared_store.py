@@ -0,0 +1,147 @@
+# Small key/value store shared by all worker processes on one host.
+#
+# Multi-worker deployments (start.sh) point SHARED_STATE_PATH at a SQLite
+# file in WAL mode: readers never block, writers serialize on a short
+# IMMEDIATE transaction, and every worker sees the same answer cache entries,
+# conversations and rate-limit buckets. Without SHARED_STATE_PATH everything
+# stays in-process as before.
+
+import os
+import sqlite3
+import threading
+import time
+
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH")
+
+
+class SharedStore:
+    def __init__(self, path, purge_every=1000):
+        self.path = path
+        self.purge_every = purge_every
+        self._local = threading.local()
+        self._puts = 0
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv (namespace TEXT, key TEXT, value BLOB, expires REAL, "
+                "updated REAL, PRIMARY KEY (namespace, key))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL, updated REAL)"
+            )
+
+    def _connection(self):
+        # One connection per thread (and per process: a forked child gets a new one)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    # -------------------------------------------------------------- key/value
+
+    def get(self, namespace, key):
+        row = self._connection().execute(
+            "SELECT value FROM kv WHERE namespace = ? AND key = ? AND expires > ?", (namespace, key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, namespace, key, value, ttl):
+        now = time.time()
+        self._connection().execute(
+            "INSERT OR REPLACE INTO kv (namespace, key, value, expires, updated) VALUES (?, ?, ?, ?, ?)",
+            (namespace, key, value, now + ttl, now),
+        )
+        self._puts += 1
+        if self._puts % self.purge_every == 0:
+            self.purge()
+
+    def delete(self, namespace, key=None):
+        if key is None:
+            self._connection().execute("DELETE FROM kv WHERE namespace = ?", (namespace,))
+        else:
+            self._connection().execute("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def count(self, namespace):
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM kv WHERE namespace = ? AND expires > ?", (namespace, time.time())
+        ).fetchone()[0]
+
+    def trim(self, namespace, max_entries):
+        # Least recently written entries go first
+        self._connection().execute(
+            "DELETE FROM kv WHERE namespace = ? AND key IN (SELECT key FROM kv WHERE namespace = ? "
+            "ORDER BY updated DESC LIMIT -1 OFFSET ?)",
+            (namespace, namespace, max_entries),
+        )
+
+    def purge(self):
+        self._connection().execute("DELETE FROM kv WHERE expires <= ?", (time.time(),))
+
+    def incr(self, namespace, key, amount=1, ttl=10 * 365 * 86400):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value FROM kv WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+            value = int(row[0]) + amount if row else amount
+            now = time.time()
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (namespace, key, value, expires, updated) VALUES (?, ?, ?, ?, ?)",
+                (namespace, key, value, now + ttl, now),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return value
+
+    def update(self, namespace, key, fn, ttl):
+        # Read-modify-write in one IMMEDIATE transaction: fn(current value or
+        # None) returns the new value, so updates from several workers to the
+        # same key apply one after another instead of overwriting each other
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            row = conn.execute(
+                "SELECT value FROM kv WHERE namespace = ? AND key = ? AND expires > ?", (namespace, key, now)
+            ).fetchone()
+            value = fn(row[0] if row else None)
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (namespace, key, value, expires, updated) VALUES (?, ?, ?, ?, ?)",
+                (namespace, key, value, now + ttl, now),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return value
+
+    # ----------------------------------------------------------- token bucket
+
+    def take_tokens(self, name, rate, capacity, tokens=1):
+        # Returns 0 when the tokens were taken, otherwise the seconds to wait
+        # before trying again (nothing is taken in that case)
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+            available = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+            wait = 0.0
+            if available >= tokens:
+                available -= tokens
+            else:
+                wait = (tokens - available) / rate
+            conn.execute("INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)",
+                         (name, available, now))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+
+shared_store = SharedStore(SHARED_STATE_PATH) if SHARED_STATE_PATH else None
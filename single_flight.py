@@ -0,0 +1,73 @@
+# Request coalescing ("single flight") for identical concurrent work.
+#
+# The first caller for a key runs the work; callers arriving with the same
+# key while it is in flight wait for that result (or exception) instead of
+# repeating it. Nothing is kept once the work finishes -- caching finished
+# results is the answer cache's job. The async work runs as its own task, so
+# a leader whose request is cancelled does not cancel it for the waiters.
+#
+# forget() drops in-flight keys without stopping the work: writers call it so
+# that a read started after the write never joins a read started before it.
+
+import asyncio
+import threading
+from concurrent.futures import Future
+
+from metrics import SINGLE_FLIGHT_CALLS
+
+
+class SingleFlight:
+    def __init__(self, group):
+        self.group = group
+        self._lock = threading.Lock()
+        self._futures = {}  # key -> concurrent Future (threads)
+        self._tasks = {}    # key -> asyncio Task (event loop)
+
+    def __len__(self):
+        return len(self._futures) + len(self._tasks)
+
+    def call(self, key, fn, *args):
+        with self._lock:
+            future = self._futures.get(key)
+            leader = future is None
+            if leader:
+                future = self._futures[key] = Future()
+        SINGLE_FLIGHT_CALLS.labels(self.group, "leader" if leader else "coalesced").inc()
+        if not leader:
+            return future.result()
+
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                if self._futures.get(key) is future:
+                    del self._futures[key]
+        return future.result()
+
+    async def acall(self, key, fn, *args):
+        # `fn(*args)` must return an awaitable
+        loop = asyncio.get_running_loop()
+        task = self._tasks.get(key)
+        leader = task is None or task.get_loop() is not loop
+        if leader:
+            task = self._tasks[key] = asyncio.ensure_future(fn(*args))
+            task.add_done_callback(lambda done: self._discard(key, done))
+        SINGLE_FLIGHT_CALLS.labels(self.group, "leader" if leader else "coalesced").inc()
+        return await asyncio.shield(task)
+
+    def _discard(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            task.exception()  # retrieved here so an unawaited failure is not logged
+
+    def forget(self, key=None):
+        with self._lock:
+            if key is None:
+                self._futures.clear()
+                self._tasks.clear()
+            else:
+                self._futures.pop(key, None)
+                self._tasks.pop(key, None)
@@ -1,12 +1,44 @@
 #!/bin/bash
 
-# Start FastAPI backend on port 8000
-uvicorn patients_api:app --host 0.0.0.0 --port 8000 &
+# SERVE_MODE=dev runs the single-process dev servers. The default production
+# mode runs gunicorn: uvicorn workers for the FastAPI backend and threaded
+# workers for the Flask frontend. Workers share caches, conversations and rate
+# limits through SHARED_STATE_PATH, and Prometheus samples through
+# PROMETHEUS_MULTIPROC_DIR.
+
+if [ "${SERVE_MODE:-prod}" = "dev" ]; then
+    # prometheus_client requires the directory to exist if the variable is set
+    if [ -n "$PROMETHEUS_MULTIPROC_DIR" ]; then
+        mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+    fi
+
+    # Start FastAPI backend on port 8000
+    uvicorn patients_api:app --host 0.0.0.0 --port 8000 &
+
+    # Give FastAPI time to start
+    sleep 3
+
+    # Start Flask frontend on port 7860 (required by HF Spaces)
+    export FLASK_RUN_PORT=7860
+    export FLASK_RUN_HOST=0.0.0.0
+    exec python app.py
+fi
+
+export SHARED_STATE_PATH="${SHARED_STATE_PATH:-/tmp/medirag-state.db}"
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/medirag-metrics}"
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
+API_WORKERS="${API_WORKERS:-$(nproc)}"
+FRONTEND_WORKERS="${FRONTEND_WORKERS:-2}"
+FRONTEND_THREADS="${FRONTEND_THREADS:-8}"
+# One pooled backend connection per frontend thread
+export BACKEND_POOL_SIZE="${BACKEND_POOL_SIZE:-$FRONTEND_THREADS}"
+
+gunicorn patients_api:app -c gunicorn_conf.py -k uvicorn.workers.UvicornWorker \
+    -w "$API_WORKERS" -b 0.0.0.0:8000 &
 
-# Give FastAPI time to start
 sleep 3
 
-# Start Flask frontend on port 7860 (required by HF Spaces)
-export FLASK_RUN_PORT=7860
-export FLASK_RUN_HOST=0.0.0.0
-python app.py
\ No newline at end of file
+# Flask frontend on port 7860 (required by HF Spaces)
+exec gunicorn app:app -c gunicorn_conf.py -k gthread \
+    -w "$FRONTEND_WORKERS" --threads "$FRONTEND_THREADS" -b 0.0.0.0:7860
@@ -0,0 +1,472 @@
+# Manages calls to upstream providers (the LLM gateway, the embedding API).
+#
+# Every call goes through, in order:
+#   - the request deadline: DeadlineMiddleware takes it from the
+#     X-Request-Timeout header (the Flask client sends its own read timeout),
+#     and no upstream call outlives it. Requests without the header (batch
+#     jobs, scripts) get none; each call is still bounded by its own timeout
+#   - a circuit breaker per model: after `failures` consecutive errors or
+#     timeouts the model is skipped for `reset_after` seconds, then a single
+#     trial call decides whether it is closed again
+#   - a token bucket (rate_limit.token_bucket, shared across workers)
+#   - an adaptive concurrency limit: grows by about one per round of calls
+#     while latency stays within `tolerance` x the best observed latency,
+#     shrinks gently when it does not and halves on a 429 or a timeout
+#   - a hedge: when the primary model has not answered by its p95 latency the
+#     same request goes to the fallback model and the first answer wins
+# Errors and timeouts are retried `retries` times while the deadline allows;
+# a model whose circuit is open is replaced by the fallback. A call cut short
+# by the request deadline rather than by `timeout` is recorded as "deadline"
+# and, like a 4xx, moves neither the circuit nor the limit.
+#
+# `request(model, timeout)` does the actual call and must honour `timeout`.
+# `kind` names the sort of call (a completion, a stream opening, a batch of
+# documents): each kind has its own latency window and limit baseline, so a
+# quick stream opening or a slow batch does not skew the other kinds' hedge
+# delay and latency target.
+
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from langchain.embeddings.base import Embeddings
+
+from metrics import UPSTREAM_CALLS, UPSTREAM_CIRCUIT, UPSTREAM_CONCURRENCY, UPSTREAM_HEDGES, UPSTREAM_SECONDS
+from rate_limit import token_bucket
+
+DEADLINE_HEADER = "x-request-timeout"
+
+deadline_var = ContextVar("upstream_deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class UpstreamUnavailable(RuntimeError):
+    pass
+
+
+class _NoSpare(Exception):
+    # A hedge found no token or slot free and was not sent
+    pass
+
+
+def remaining():
+    # Seconds left before the current request's deadline, None without one
+    deadline_at = deadline_var.get()
+    return None if deadline_at is None else deadline_at - time.monotonic()
+
+
+@contextmanager
+def deadline(seconds):
+    # Nested deadlines can only shorten the outer one
+    deadline_at = time.monotonic() + seconds
+    outer = deadline_var.get()
+    token = deadline_var.set(deadline_at if outer is None else min(outer, deadline_at))
+    try:
+        yield
+    finally:
+        deadline_var.reset(token)
+
+
+class DeadlineMiddleware:
+    # Plain ASGI middleware, like MetricsMiddleware
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope.get("headers") or [])
+        try:
+            seconds = float(headers.get(DEADLINE_HEADER.encode(), b""))
+        except ValueError:
+            seconds = 0.0
+        if not seconds > 0:  # also rejects NaN
+            return await self.app(scope, receive, send)
+        with deadline(seconds):
+            await self.app(scope, receive, send)
+
+
+def classify(error):
+    # ok / throttled / timeout / error are the provider's side; "rejected"
+    # (other 4xx) is the request's fault and is neither retried nor counted
+    # against the circuit
+    name = type(error).__name__
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError)) or "Timeout" in name:
+        return "timeout"
+    if status == 429 or "RateLimit" in name or "ResourceExhausted" in name:
+        return "throttled"
+    if (isinstance(status, int) and status >= 500) or "Connection" in name or "Unavailable" in name:
+        return "error"
+    return "rejected"
+
+
+class CircuitBreaker:
+    def __init__(self, failures=5, reset_after=30.0):
+        self.failures = failures
+        self.reset_after = reset_after
+        self.state = "closed"
+        self.consecutive = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        # Once open, one trial call per `reset_after` seconds gets through
+        with self._lock:
+            if self.state == "closed":
+                return True
+            now = time.monotonic()
+            if now - self.opened_at >= self.reset_after:
+                self.state = "half_open"
+                self.opened_at = now
+                return True
+            return False
+
+    def record(self, failed):
+        # Returns the new state when it changed, else None
+        with self._lock:
+            if not failed:
+                self.consecutive = 0
+                if self.state != "closed":
+                    self.state = "closed"
+                    return "closed"
+                return None
+            self.consecutive += 1
+            if self.state == "half_open" or (self.state == "closed" and self.consecutive >= self.failures):
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                return "open"
+            return None
+
+
+class AdaptiveLimit:
+    # Concurrency limit shared by threads and event loops
+    def __init__(self, initial=8, minimum=1, maximum=64, tolerance=2.0, backoff=0.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.baselines = {}  # per kind: best recent latency, drifts up slowly
+        self.dropped_at = 0.0
+        self.inflight = 0
+        self._cond = threading.Condition()
+        self._waiters = deque()  # (loop, future) of async callers
+
+    def _free(self):
+        return self.inflight < int(self.limit)
+
+    def try_acquire(self):
+        with self._cond:
+            if self._free():
+                self.inflight += 1
+                return True
+            return False
+
+    def acquire(self, timeout):
+        with self._cond:
+            if not self._cond.wait_for(self._free, timeout):
+                raise DeadlineExceeded("no upstream slot before the deadline")
+            self.inflight += 1
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                if self._free():
+                    self.inflight += 1
+                    return
+                future = loop.create_future()
+                self._waiters.append((loop, future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                with self._cond:
+                    self._wake()  # pass on a wake-up this waiter may have received
+                raise
+
+    def _wake(self):
+        self._cond.notify_all()
+        free = int(self.limit) - self.inflight
+        while free > 0 and self._waiters:
+            loop, future = self._waiters.popleft()
+            if not future.done():
+                loop.call_soon_threadsafe(lambda f=future: f.done() or f.set_result(None))
+                free -= 1
+
+    def release(self):
+        with self._cond:
+            self.inflight -= 1
+            self._wake()
+
+    def update(self, latency, outcome, kind=None):
+        with self._cond:
+            baseline = self.baselines.get(kind)
+            if outcome in ("throttled", "timeout"):
+                # A burst of 429s from one round of calls counts as one signal
+                now = time.monotonic()
+                if now - self.dropped_at >= (baseline or 0.0):
+                    self.limit = max(self.minimum, self.limit * self.backoff)
+                    self.dropped_at = now
+            elif outcome == "ok":
+                if baseline is None or latency < baseline:
+                    baseline = latency
+                else:
+                    baseline += 0.01 * (latency - baseline)
+                self.baselines[kind] = baseline
+                if latency <= self.tolerance * baseline:
+                    self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+                else:
+                    self.limit = max(self.minimum, self.limit * 0.95)
+            self._wake()
+            return self.limit
+
+
+class LatencyWindow:
+    def __init__(self, size=200, min_samples=20):
+        self.samples = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, pct):
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+
+class Upstream:
+    def __init__(self, name, models, rate=None, concurrency=8, max_concurrency=64, timeout=30.0, retries=1,
+                 hedge_percentile=95, tolerance=2.0, failures=5, reset_after=30.0, limit=None):
+        # models[0] is the primary; models[1], if any, takes hedges and failover
+        self.name = name
+        self.models = list(models)
+        self.bucket = token_bucket(f"upstream_{name}", rate) if rate else None
+        self.limit = limit or AdaptiveLimit(concurrency, maximum=max_concurrency, tolerance=tolerance)
+        self.timeout = timeout
+        self.retries = retries
+        self.hedge_percentile = hedge_percentile
+        self.breakers = {m: CircuitBreaker(failures, reset_after) for m in self.models}
+        self.latency = {}  # (model, kind) -> LatencyWindow
+        UPSTREAM_CONCURRENCY.labels(name).set(self.limit.limit)
+
+    # ------------------------------------------------------------- helpers
+
+    def _budget(self, model):
+        left = remaining()
+        budget = self.timeout if left is None else min(self.timeout, left)
+        if budget <= 0:
+            UPSTREAM_CALLS.labels(self.name, model, "deadline").inc()
+            raise DeadlineExceeded(f"{self.name}: request deadline passed")
+        return budget
+
+    def _pick(self):
+        for model in self.models:
+            if self.breakers[model].allow():
+                return model
+        UPSTREAM_CALLS.labels(self.name, self.models[0], "unavailable").inc()
+        raise UpstreamUnavailable(f"{self.name}: every model's circuit is open")
+
+    def _hedge_model(self, model):
+        if len(self.models) < 2 or model != self.models[0]:
+            return None
+        return self.models[1]
+
+    def _window(self, model, kind):
+        return self.latency.setdefault((model, kind), LatencyWindow())
+
+    def _record(self, model, kind, seconds, outcome):
+        UPSTREAM_CALLS.labels(self.name, model, outcome).inc()
+        UPSTREAM_SECONDS.labels(self.name, model).observe(seconds)
+        if outcome == "ok":
+            self._window(model, kind).add(seconds)
+        if outcome in ("deadline", "rejected"):
+            return  # says nothing about the upstream's health or capacity
+        state = self.breakers[model].record(outcome in ("timeout", "error"))
+        if state:
+            UPSTREAM_CIRCUIT.labels(self.name, model, state).inc()
+        UPSTREAM_CONCURRENCY.labels(self.name).set(self.limit.update(seconds, outcome, kind))
+
+    def _raise_failure(self, model, kind, seconds, error, budget):
+        # Records a failed call; a timeout under a budget the request deadline
+        # shortened is the caller's, and surfaces as DeadlineExceeded
+        outcome = classify(error)
+        if outcome == "timeout" and budget < self.timeout:
+            self._record(model, kind, seconds, "deadline")
+            raise DeadlineExceeded(f"{self.name}: request deadline passed during the call") from error
+        self._record(model, kind, seconds, outcome)
+        raise error
+
+    def _backoff(self, attempt):
+        delay = 0.2 * 2 ** attempt
+        left = remaining()
+        return delay if left is None else max(0.0, min(delay, left))
+
+    def _retryable(self, error, attempt):
+        return attempt < self.retries and classify(error) in ("throttled", "timeout", "error") \
+            and not isinstance(error, DeadlineExceeded)
+
+    # ---------------------------------------------------------------- sync
+
+    def call(self, request, kind="call"):
+        # Blocking version for sync callers (no hedging: that needs a second thread)
+        attempt = 0
+        while True:
+            model = self._pick()
+            try:
+                return self._attempt(request, model, kind)
+            except Exception as e:
+                if not self._retryable(e, attempt):
+                    raise
+                attempt += 1
+                time.sleep(self._backoff(attempt))
+
+    def _attempt(self, request, model, kind):
+        budget = self._budget(model)
+        deadline_at = time.monotonic() + budget
+        while self.bucket is not None:
+            wait = self.bucket.take()
+            if not wait:
+                break
+            if time.monotonic() + wait >= deadline_at:
+                UPSTREAM_CALLS.labels(self.name, model, "deadline").inc()
+                raise DeadlineExceeded(f"{self.name}: rate limit wait exceeds the deadline")
+            time.sleep(wait)
+        self.limit.acquire(max(0.0, deadline_at - time.monotonic()))
+        start = time.monotonic()
+        try:
+            result = request(model, max(0.001, deadline_at - start))
+        except Exception as e:
+            self._raise_failure(model, kind, time.monotonic() - start, e, budget)
+        finally:
+            self.limit.release()
+        self._record(model, kind, time.monotonic() - start, "ok")
+        return result
+
+    # --------------------------------------------------------------- async
+
+    async def acall(self, request, hedge=True, kind="call"):
+        # `request(model, timeout)` returns an awaitable
+        attempt = 0
+        while True:
+            model = self._pick()
+            try:
+                if hedge:
+                    return await self._ahedged(request, model, kind)
+                return await self._aattempt(request, model, kind)
+            except Exception as e:
+                if not self._retryable(e, attempt):
+                    raise
+                attempt += 1
+                await asyncio.sleep(self._backoff(attempt))
+
+    async def _aattempt(self, request, model, kind, acquired=False):
+        # acquired=True: the caller already holds a token and a slot (hedges),
+        # which this releases
+        try:
+            budget = self._budget(model)
+        except DeadlineExceeded:
+            if acquired:
+                self.limit.release()
+            raise
+        deadline_at = time.monotonic() + budget
+        if not acquired:
+            try:
+                if self.bucket is not None:
+                    await asyncio.wait_for(self.bucket.acquire(), budget)
+                await asyncio.wait_for(self.limit.aacquire(), max(0.0, deadline_at - time.monotonic()))
+            except asyncio.TimeoutError:
+                UPSTREAM_CALLS.labels(self.name, model, "deadline").inc()
+                raise DeadlineExceeded(f"{self.name}: no upstream slot before the deadline") from None
+        start = time.monotonic()
+        try:
+            timeout = max(0.001, deadline_at - start)
+            result = await asyncio.wait_for(request(model, timeout), timeout)
+        except asyncio.CancelledError:
+            raise  # lost a hedge race or the caller went away: says nothing about the upstream
+        except Exception as e:
+            self._raise_failure(model, kind, time.monotonic() - start, e, budget)
+        finally:
+            self.limit.release()
+        self._record(model, kind, time.monotonic() - start, "ok")
+        return result
+
+    async def _ahedge(self, request, model, kind):
+        # The token and the slot are taken inside the hedge's own task, so a
+        # task cancelled before it starts holds neither
+        if not self.limit.try_acquire():
+            raise _NoSpare()
+        try:
+            if self.bucket is not None and await self.bucket.atake():
+                raise _NoSpare()
+            if not self.breakers[model].allow():
+                raise _NoSpare()
+        except BaseException:
+            self.limit.release()
+            raise
+        UPSTREAM_HEDGES.labels(self.name, "sent").inc()
+        return await self._aattempt(request, model, kind, acquired=True)
+
+    async def _ahedged(self, request, model, kind):
+        hedge_model = self._hedge_model(model)
+        delay = hedge_model and self._window(model, kind).percentile(self.hedge_percentile)
+        if not delay:
+            return await self._aattempt(request, model, kind)
+
+        primary = asyncio.ensure_future(self._aattempt(request, model, kind))
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return await primary
+
+            hedge = asyncio.ensure_future(self._ahedge(request, hedge_model, kind))
+            pending.add(hedge)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            UPSTREAM_HEDGES.labels(self.name, "won").inc()
+                        elif not (hedge.done() and isinstance(hedge.exception(), _NoSpare)):
+                            UPSTREAM_HEDGES.labels(self.name, "lost").inc()
+                        return task.result()
+                    if not isinstance(task.exception(), _NoSpare):
+                        error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+class ManagedEmbeddings(Embeddings):
+    # Embeddings whose upstream calls go through an Upstream. The provider
+    # client takes no per-call timeout, so sync calls are bounded only when
+    # they start; async calls are cancelled at the deadline.
+    def __init__(self, embeddings, upstream):
+        self.embeddings = embeddings
+        self.upstream = upstream
+
+    def embed_documents(self, texts, **kwargs):
+        return self.upstream.call(lambda model, timeout: self.embeddings.embed_documents(texts, **kwargs),
+                                  kind="documents")
+
+    def embed_query(self, text):
+        return self.upstream.call(lambda model, timeout: self.embeddings.embed_query(text), kind="query")
+
+    async def aembed_documents(self, texts, **kwargs):
+        return await self.upstream.acall(lambda model, timeout: self.embeddings.aembed_documents(texts, **kwargs),
+                                         kind="documents")
+
+    async def aembed_query(self, text):
+        return await self.upstream.acall(lambda model, timeout: self.embeddings.aembed_query(text), kind="query")